@@ -0,0 +1,88 @@
+"""
+Concurrency benchmark for the async LLM client path.
+
+Starts the local OpenAI stub, points the services at it and fires N
+concurrent calculate_body_fat / generate_advice calls. With a non-blocking
+client the wall time stays close to a single stub latency regardless of N,
+so throughput grows linearly with concurrency. Every call gets different
+inputs and the estimate cache and advice library are disabled, so each one
+reaches the stub instead of being coalesced or answered from a cache (the
+"upstream" column counts the calls the stub received).
+
+Usage (from the backend directory):
+    python benchmarks/bench_concurrency.py --latency 0.5 --levels 1 10 100 300
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_openai_server import start_subprocess  # noqa: E402
+from config import settings  # noqa: E402
+from models import AdviceRequest, BodyFatRequest, Gender  # noqa: E402
+from services.llm_client import get_pool_stats  # noqa: E402
+from services.openai_client import calculate_body_fat, generate_advice  # noqa: E402
+
+
+async def run_level(concurrency: int, offset: int) -> float:
+    calls = []
+    for i in range(concurrency):
+        # Разные параметры у каждого вызова: одинаковые склеились бы в один запрос к стабу
+        n = offset + i
+        if i % 2 == 0:
+            calls.append(calculate_body_fat(BodyFatRequest(
+                gender=Gender.MALE, age=20 + (n // 200) % 50, height=180, weight=50 + (n % 200) * 0.5, waist=85
+            )))
+        else:
+            calls.append(generate_advice(AdviceRequest(
+                body_fat_percent=round(8 + (n % 300) * 0.1, 1), gender=Gender.MALE, age=20 + (n // 300) % 50,
+                evaluation="Above Average"
+            )))
+
+    start = time.perf_counter()
+    await asyncio.gather(*calls)
+    return time.perf_counter() - start
+
+
+async def _stub_requests(port: int) -> int:
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://127.0.0.1:{port}/stats")).json()["requests"]
+
+
+async def main(levels: list[int], latency: float, port: int) -> None:
+    print(f"{'concurrency':>12} {'wall, s':>10} {'req/s':>10} {'speedup':>10} {'upstream':>10}")
+    offset = 0
+    for concurrency in levels:
+        before = await _stub_requests(port)
+        elapsed = await run_level(concurrency, offset)
+        upstream = await _stub_requests(port) - before
+        offset += concurrency
+        throughput = concurrency / elapsed
+        speedup = throughput * latency
+        print(f"{concurrency:>12} {elapsed:>10.3f} {throughput:>10.1f} {speedup:>10.1f}x {upstream:>10}")
+    print(f"Connection pool: {get_pool_stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 10, 50, 100, 300])
+    args = parser.parse_args()
+
+    stub = start_subprocess(args.port, args.latency)
+    settings.openai_api_key = "sk-stub"
+    settings.openai_base_url = f"http://127.0.0.1:{args.port}/v1"
+    # Кэши отключены: измеряется параллельность вызовов, а не попадания в кэш
+    settings.bodyfat_cache_backend = "none"
+    settings.advice_library_enabled = False
+
+    try:
+        asyncio.run(main(args.levels, args.latency, args.port))
+    finally:
+        stub.terminate()
@@ -0,0 +1,89 @@
+"""
+Throughput of the local estimator engine compared with the LLM path.
+
+Measures single-request latency of estimate_body_fat, rows/s of the
+vectorized estimate_batch API, and requests/s of calculate_body_fat against
+the local OpenAI stub (result cache disabled, so every call goes upstream).
+
+Usage (from the backend directory):
+    python benchmarks/bench_estimator.py --rows 1000000 --llm-calls 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_openai_server import start_subprocess  # noqa: E402
+from config import settings  # noqa: E402
+from models import BodyFatRequest, Gender  # noqa: E402
+from services.estimator import estimate_batch, estimate_body_fat  # noqa: E402
+
+
+def bench_single(iterations: int) -> None:
+    request = BodyFatRequest(gender=Gender.MALE, age=30, height=180, weight=80, waist=85, neck=38)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        estimate_body_fat(request)
+    elapsed = time.perf_counter() - start
+    print(f"local single : {elapsed / iterations * 1e6:8.1f} us/request, {iterations / elapsed:12.0f} req/s")
+
+
+def bench_batch(rows: int) -> None:
+    rng = np.random.default_rng(0)
+    is_male = rng.random(rows) < 0.5
+    age = rng.integers(18, 80, rows)
+    height = rng.normal(172, 9, rows)
+    weight = rng.normal(75, 14, rows)
+    waist = np.where(rng.random(rows) < 0.7, rng.normal(88, 12, rows), np.nan)
+    neck = np.where(rng.random(rows) < 0.5, rng.normal(37, 3, rows), np.nan)
+    hip = np.where(rng.random(rows) < 0.5, rng.normal(100, 8, rows), np.nan)
+
+    start = time.perf_counter()
+    estimate_batch(is_male, age, height, weight, waist, neck, hip)
+    elapsed = time.perf_counter() - start
+    print(f"local batch  : {rows} rows in {elapsed * 1000:.1f} ms, {rows / elapsed:12.0f} rows/s")
+
+
+async def bench_llm(calls: int, concurrency: int) -> None:
+    from services.openai_client import calculate_body_fat
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            # Разные веса - чтобы не попадать в кэш
+            await calculate_body_fat(BodyFatRequest(gender=Gender.MALE, age=30, height=180, weight=60 + i * 0.1))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    elapsed = time.perf_counter() - start
+    print(f"llm (stub)   : {elapsed / calls * 1e6:8.1f} us/request amortized, {calls / elapsed:12.0f} req/s "
+          f"(concurrency {concurrency})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--iterations", type=int, default=10_000)
+    parser.add_argument("--llm-calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.5, help="Stub LLM latency in seconds")
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+
+    bench_single(args.iterations)
+    bench_batch(args.rows)
+
+    stub = start_subprocess(args.port, args.latency)
+    settings.openai_api_key = "sk-stub"
+    settings.openai_base_url = f"http://127.0.0.1:{args.port}/v1"
+    settings.bodyfat_cache_backend = "none"
+    try:
+        asyncio.run(bench_llm(args.llm_calls, args.concurrency))
+    finally:
+        stub.terminate()
@@ -0,0 +1,254 @@
+"""
+End-to-end load benchmark for /api/bodyfat and /api/advice.
+
+Starts the OpenAI stub (any stub options can be passed through with
+--stub-args) and the app under uvicorn as separate processes, with the
+response caches, the advice library and the image result cache disabled so
+every request reaches the stub. Then, for each scenario and concurrency
+level, a closed loop of N clients sends requests for --seconds:
+    bodyfat_text    /api/bodyfat with form fields only
+    bodyfat_image   /api/bodyfat with one synthetic JPEG (different every request)
+    advice          /api/advice (JSON)
+    journey         the app flow: /api/bodyfat, then /api/advice with its result
+    combined        the same flow in one /api/bodyfat/advice request
+
+Reported per run: throughput, p50/p95/p99 latency, status codes, the share
+of estimates answered by the local fallback (X-Estimate-Source), and the app
+process RSS (peak) and CPU (share of one core) read from /proc. With
+--output, each run is appended as a JSON line tagged with the current git
+commit, so regressions can be tracked per commit.
+
+Usage (from the backend directory):
+    python benchmarks/bench_load.py --levels 1 8 32 --seconds 10
+    python benchmarks/bench_load.py --scenarios bodyfat_image --stub-args="--latency-dist lognormal --error-rate 0.05"
+    python benchmarks/bench_load.py --stub-args="--replay cassette.jsonl --latency-dist recorded" --output load.jsonl
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.stub_openai_server import start_subprocess  # noqa: E402
+
+SCENARIOS = ("bodyfat_text", "bodyfat_image", "advice", "journey", "combined")
+PHOTO_POOL = 32
+
+BODYFAT_FIELDS = {"gender": "male", "age": "30", "height": "180", "weight": "80", "waist": "85"}
+ADVICE_BODY = {"body_fat_percent": 21.5, "gender": "male", "age": 30, "evaluation": "Above Average"}
+
+
+def make_photos(count: int, size: tuple[int, int]) -> list[bytes]:
+    """Synthetic JPEGs: a gradient plus noise, so every photo (and its hash) is different."""
+    import numpy as np
+    from PIL import Image
+
+    width, height = size
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    photos = []
+    for _ in range(count):
+        pixels = gradient + rng.normal(0, 40, size=(height, width, 3))
+        buffer = io.BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=85)
+        photos.append(buffer.getvalue())
+    return photos
+
+
+def _proc_cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        # Имя процесса в скобках может содержать пробелы - считаем поля после ")"
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _proc_rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def _client_loop(client, scenario: str, worker: int, stop_at: float, photos: list[bytes], result: dict) -> None:
+    # Каждый клиент со своим IP в X-Forwarded-For: иначе сработает лимит на клиента в admission
+    headers = {"X-Forwarded-For": f"10.0.{worker // 250}.{worker % 250 + 1}"}
+    sent = 0
+    while time.perf_counter() < stop_at:
+        started = time.perf_counter()
+        try:
+            if scenario == "advice":
+                response = await client.post("/api/advice", json=ADVICE_BODY, headers=headers)
+            elif scenario == "journey":
+                response = await client.post("/api/bodyfat", data=BODYFAT_FIELDS, headers=headers)
+                estimate_response = response
+                if response.status_code == 200:
+                    estimate = response.json()
+                    response = await client.post("/api/advice", headers=headers, json={
+                        **ADVICE_BODY,
+                        "body_fat_percent": estimate["body_fat_percent"],
+                        "evaluation": estimate["evaluation"],
+                    })
+            elif scenario == "combined":
+                response = await client.post("/api/bodyfat/advice", data=BODYFAT_FIELDS, headers=headers)
+            elif scenario == "bodyfat_image":
+                photo = photos[(worker * 7 + sent) % len(photos)]
+                response = await client.post("/api/bodyfat", data=BODYFAT_FIELDS, headers=headers,
+                                             files=[("images", ("photo.jpg", photo, "image/jpeg"))])
+            else:
+                response = await client.post("/api/bodyfat", data=BODYFAT_FIELDS, headers=headers)
+            status = response.status_code
+            # В сценарии journey источник оценки - у первого ответа
+            source = (estimate_response if scenario == "journey" else response).headers.get("x-estimate-source")
+        except Exception as e:
+            status, source = type(e).__name__, None
+        result["latencies"].append(time.perf_counter() - started)
+        result["statuses"][status] = result["statuses"].get(status, 0) + 1
+        if source:
+            result["sources"][source] = result["sources"].get(source, 0) + 1
+        sent += 1
+
+
+async def _sample_rss(pid: int, stop: asyncio.Event, result: dict) -> None:
+    while not stop.is_set():
+        result["peak_rss_mb"] = max(result["peak_rss_mb"], _proc_rss_mb(pid))
+        try:
+            await asyncio.wait_for(stop.wait(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(port: int, pid: int, scenario: str, concurrency: int, seconds: float, photos: list[bytes]) -> dict:
+    import httpx
+
+    result = {"latencies": [], "statuses": {}, "sources": {}, "peak_rss_mb": 0.0}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120, limits=limits) as client:
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(_sample_rss(pid, stop, result))
+        cpu_before = _proc_cpu_seconds(pid)
+        started = time.perf_counter()
+        stop_at = started + seconds
+        await asyncio.gather(*[
+            _client_loop(client, scenario, worker, stop_at, photos, result) for worker in range(concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+        cpu = _proc_cpu_seconds(pid) - cpu_before
+        stop.set()
+        await sampler
+
+    latencies = result["latencies"]
+    estimates = sum(result["sources"].values())
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 1),
+        "statuses": {str(status): count for status, count in result["statuses"].items()},
+        "fallback_share": round(
+            (result["sources"].get("local-fallback", 0) / estimates) if estimates else 0.0, 4
+        ),
+        "peak_rss_mb": round(result["peak_rss_mb"], 1),
+        "cpu_percent": round(100 * cpu / elapsed, 1),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _start_app(port: int, stub_port: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="sk-stub",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{stub_port}/v1",
+        # Кэши отключены: каждый запрос должен дойти до стаба
+        BODYFAT_CACHE_BACKEND="none",
+        IMAGE_CACHE_ENABLED="false",
+        IMAGE_RESULT_CACHE_BACKEND="none",
+        ADVICE_LIBRARY_ENABLED="false",
+        ADMISSION_TRUST_FORWARDED_FOR="true",
+        LOG_LEVEL="WARNING",
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"App did not start on port {port}")
+
+
+def main(args) -> None:
+    photos = make_photos(PHOTO_POOL, (args.photo_width, args.photo_height)) if "bodyfat_image" in args.scenarios else []
+    stub = start_subprocess(args.stub_port, args.latency, shlex.split(args.stub_args))
+    app = _start_app(args.port, args.stub_port)
+    commit = _git_commit()
+    try:
+        print(f"commit {commit}, stub latency {args.latency}s {args.stub_args}".rstrip())
+        print(f"{'scenario':<14} {'conc':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+              f"{'RSS MB':>7} {'CPU %':>6} {'fallback':>8}  statuses")
+        for scenario in args.scenarios:
+            for concurrency in args.levels:
+                result = asyncio.run(run(args.port, app.pid, scenario, concurrency, args.seconds, photos))
+                print(f"{scenario:<14} {concurrency:>5} {result['rps']:>8.1f} {result['p50_ms']:>8.0f} "
+                      f"{result['p95_ms']:>8.0f} {result['p99_ms']:>8.0f} {result['peak_rss_mb']:>7.0f} "
+                      f"{result['cpu_percent']:>6.0f} {result['fallback_share']:>8.1%}  {result['statuses']}")
+                if args.output:
+                    with open(args.output, "a", encoding="utf-8") as f:
+                        f.write(json.dumps({
+                            "ts": int(time.time()),
+                            "commit": commit,
+                            "latency": args.latency,
+                            "stub_args": args.stub_args,
+                            "seconds": args.seconds,
+                            **result,
+                        }) + "\n")
+    finally:
+        app.terminate()
+        stub.terminate()
+        app.wait()
+        stub.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS[:3]))
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--seconds", type=float, default=10.0, help="Duration of each run")
+    parser.add_argument("--latency", type=float, default=0.3, help="Stub response delay (median), seconds")
+    parser.add_argument("--stub-args", default="", help="Extra stub options, e.g. \"--error-rate 0.05\"")
+    parser.add_argument("--photo-width", type=int, default=1280)
+    parser.add_argument("--photo-height", type=int, default=960)
+    parser.add_argument("--port", type=int, default=8120)
+    parser.add_argument("--stub-port", type=int, default=8121)
+    parser.add_argument("--output", help="Append results as JSON lines to this file")
+    main(parser.parse_args())
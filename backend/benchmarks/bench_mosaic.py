@@ -0,0 +1,155 @@
+"""
+Vision layout benchmark: separate photos vs per-photo detail vs a mosaic.
+
+Starts the OpenAI stub (any stub options, e.g. a recorded cassette, can be
+passed through with --stub-args) and sends the same front/side/back photo
+set through calculate_body_fat_with_image in each layout mode:
+    separate            one image_url part per photo, no detail field (the default)
+    heuristic           image_detail=heuristic
+    low                 image_detail=low for every photo
+    mosaic              image_mosaic_enabled, no detail field for separate parts
+    mosaic_heuristic    image_mosaic_enabled with image_detail=heuristic
+
+The stub counts image tokens with the gpt-4o tile formula, so the prompt
+tokens per request it reports are what the layout would be billed. The stub
+itself answers after a fixed delay regardless of the payload; pass
+--prefill-ms-per-1k to add a delay proportional to the prompt tokens, as the
+real vision prefill does, and --bandwidth-mbps to add the upload time of the
+request body. Response caches are disabled.
+
+Usage (from the backend directory):
+    python benchmarks/bench_mosaic.py --requests 20
+    python benchmarks/bench_mosaic.py --prefill-ms-per-1k 60 --bandwidth-mbps 20 --concurrency 4
+    python benchmarks/bench_mosaic.py --stub-args="--replay cassette.jsonl --latency-dist recorded"
+"""
+import argparse
+import asyncio
+import io
+import os
+import shlex
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_openai_server import start_subprocess  # noqa: E402
+from config import settings  # noqa: E402
+from models import BodyFatRequest, Gender  # noqa: E402
+from services.openai_client import calculate_body_fat_with_image  # noqa: E402
+from services.vision_layout import get_vision_layout_stats  # noqa: E402
+
+MODES = {
+    "separate": {"image_detail": "default", "image_mosaic_enabled": False},
+    "heuristic": {"image_detail": "heuristic", "image_mosaic_enabled": False},
+    "low": {"image_detail": "low", "image_mosaic_enabled": False},
+    "mosaic": {"image_detail": "default", "image_mosaic_enabled": True},
+    "mosaic_heuristic": {"image_detail": "heuristic", "image_mosaic_enabled": True},
+}
+
+
+def make_views(size: tuple[int, int]) -> list[bytes]:
+    """Three synthetic portrait 'views' with different silhouettes, so the quality gate keeps all of them."""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    width, height = size
+    rng = np.random.default_rng(0)
+    views = []
+    for view, (body_width, shift) in enumerate([(0.42, 0.0), (0.24, 0.12), (0.40, -0.1)]):
+        img = Image.new("RGB", size, (200 - 30 * view, 190, 170 + 25 * view))
+        draw = ImageDraw.Draw(img)
+        left = width * (0.5 + shift - body_width / 2)
+        draw.ellipse((left, height * 0.18, left + width * body_width, height * 0.95), fill=(170, 120, 95))
+        draw.ellipse((width * (0.42 + shift), height * 0.04, width * (0.58 + shift), height * 0.2), fill=(160, 115, 90))
+        pixels = np.asarray(img, dtype=np.float32) + rng.normal(0, 12, size=(height, width, 3))
+        buffer = io.BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=90)
+        views.append(buffer.getvalue())
+    return views
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def _stub_stats(client) -> dict:
+    return (await client.get("/stats")).json()
+
+
+async def run_mode(client, views: list[bytes], requests: int, concurrency: int) -> dict:
+    request = BodyFatRequest(gender=Gender.MALE, age=30, height=180, weight=80, waist=85)
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker() -> None:
+        while not queue.empty():
+            queue.get_nowait()
+            started = time.perf_counter()
+            await calculate_body_fat_with_image(request, list(views), ["image/jpeg"] * len(views))
+            latencies.append(time.perf_counter() - started)
+
+    stub_before = await _stub_stats(client)
+    layout_before = get_vision_layout_stats()
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    stub_after = await _stub_stats(client)
+    layout_after = get_vision_layout_stats()
+    calls = stub_after["requests"] - stub_before["requests"]
+    return {
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "rps": len(latencies) / elapsed,
+        "prompt_tokens": (stub_after["prompt_tokens"] - stub_before["prompt_tokens"]) / max(1, calls),
+        "upload_kb": (stub_after["request_bytes"] - stub_before["request_bytes"]) / max(1, calls) / 1024,
+        "mosaics": layout_after["mosaics"] - layout_before["mosaics"],
+    }
+
+
+async def main(args) -> None:
+    import httpx
+
+    views = make_views((args.photo_width, args.photo_height))
+    print(f"{len(views)} photos {args.photo_width}x{args.photo_height}, stub latency {args.latency}s, "
+          f"prefill {args.prefill_ms_per_1k} ms/1k tokens, upload {args.bandwidth_mbps or 'unlimited'} Mbit/s "
+          f"{args.stub_args}".rstrip())
+    print(f"{'mode':<17} {'p50 ms':>8} {'p95 ms':>8} {'req/s':>7} {'tokens/req':>11} {'upload KB':>10} {'mosaics':>8}")
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}") as client:
+        for mode in args.modes:
+            for name, value in MODES[mode].items():
+                setattr(settings, name, value)
+            result = await run_mode(client, views, args.requests, args.concurrency)
+            print(f"{mode:<17} {result['p50_ms']:>8.0f} {result['p95_ms']:>8.0f} {result['rps']:>7.1f} "
+                  f"{result['prompt_tokens']:>11.0f} {result['upload_kb']:>10.0f} {result['mosaics']:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--requests", type=int, default=20, help="Requests per mode")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.3, help="Stub response delay (median), seconds")
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=0.0, help="Stub delay per 1000 prompt tokens, ms")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0.0, help="Stub upload bandwidth, Mbit/s (0 - off)")
+    parser.add_argument("--stub-args", default="", help="Extra stub options, e.g. \"--replay cassette.jsonl\"")
+    parser.add_argument("--photo-width", type=int, default=1536)
+    parser.add_argument("--photo-height", type=int, default=2048)
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+
+    stub = start_subprocess(args.port, args.latency,
+                            ["--prefill-ms-per-1k", str(args.prefill_ms_per_1k),
+                             "--bandwidth-mbps", str(args.bandwidth_mbps), *shlex.split(args.stub_args)])
+    settings.openai_api_key = "sk-stub"
+    settings.openai_base_url = f"http://127.0.0.1:{args.port}/v1"
+    # Кэши отключены: каждый запрос должен дойти до стаба с новой раскладкой
+    settings.image_cache_enabled = False
+    settings.bodyfat_cache_backend = "none"
+
+    try:
+        asyncio.run(main(args))
+    finally:
+        stub.terminate()
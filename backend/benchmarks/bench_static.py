@@ -0,0 +1,153 @@
+"""
+Requests per second for the web UI at "/".
+
+Starts the app with uvicorn and, for comparison, a baseline server that
+serves web/index.html the old way (path checks + FileResponse from disk on
+every hit). A minimal keep-alive HTTP/1.1 client then hammers "/" with
+several connections for a few seconds per scenario:
+    baseline        FileResponse, uncompressed
+    identity        in-memory, uncompressed
+    gzip            in-memory, precompressed gzip
+    conditional     If-None-Match with the current ETag -> 304
+
+Usage (from the backend directory):
+    python benchmarks/bench_static.py --connections 32 --seconds 5
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def baseline_app():
+    """The / handler as it was before in-memory serving."""
+    from fastapi import FastAPI
+    from fastapi.responses import FileResponse
+
+    app = FastAPI()
+
+    @app.get("/")
+    async def root():
+        current_backend_dir = BACKEND_DIR
+        current_project_dir = os.path.dirname(current_backend_dir)
+        current_web_dir = os.path.join(current_project_dir, "web")
+        current_html_path = os.path.join(current_web_dir, "index.html")
+        if os.path.exists(current_html_path):
+            return FileResponse(current_html_path, media_type="text/html")
+        return {"message": "BodyFatAI API is running"}
+
+    return app
+
+
+async def _read_response(reader: asyncio.StreamReader) -> tuple[int, dict, int]:
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length:
+        await reader.readexactly(length)
+    return status, headers, length
+
+
+async def fetch_once(port: int, headers: dict) -> tuple[int, dict, int]:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(_request_bytes(headers))
+        return await _read_response(reader)
+    finally:
+        writer.close()
+
+
+def _request_bytes(headers: dict) -> bytes:
+    lines = ["GET / HTTP/1.1", "Host: 127.0.0.1"] + [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def _connection(port: int, request: bytes, stop_at: float, counters: dict) -> None:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        while time.perf_counter() < stop_at:
+            writer.write(request)
+            status, _, length = await _read_response(reader)
+            counters["requests"] += 1
+            counters["bytes"] += length
+            counters["statuses"][status] = counters["statuses"].get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run_scenario(port: int, headers: dict, connections: int, seconds: float) -> dict:
+    counters = {"requests": 0, "bytes": 0, "statuses": {}}
+    request = _request_bytes(headers)
+    started = time.perf_counter()
+    stop_at = started + seconds
+    await asyncio.gather(*[_connection(port, request, stop_at, counters) for _ in range(connections)])
+    elapsed = time.perf_counter() - started
+    return {
+        "rps": counters["requests"] / elapsed,
+        "bytes_per_response": counters["bytes"] / max(1, counters["requests"]),
+        "statuses": counters["statuses"],
+    }
+
+
+def _start_server(args: list[str], port: int, env: dict) -> subprocess.Popen:
+    process = subprocess.Popen(args, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+async def main(args) -> None:
+    uvicorn_args = ["--log-level", "warning", "--no-access-log"]
+    env = dict(os.environ, METRICS_ENABLED="false", LOG_LEVEL="WARNING")
+    app = _start_server([sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port)] + uvicorn_args,
+                        args.port, env)
+    baseline = _start_server([sys.executable, os.path.abspath(__file__), "--baseline-server", str(args.port + 1)],
+                             args.port + 1, env)
+    try:
+        _, headers, _ = await fetch_once(args.port, {"Accept-Encoding": "gzip"})
+        scenarios = [
+            ("baseline", args.port + 1, {}),
+            ("identity", args.port, {}),
+            ("gzip", args.port, {"Accept-Encoding": "gzip"}),
+            ("conditional", args.port, {"Accept-Encoding": "gzip", "If-None-Match": headers["etag"]}),
+        ]
+        print(f"{'scenario':<12} {'req/s':>9} {'bytes/resp':>11}  statuses")
+        for name, port, request_headers in scenarios:
+            result = await run_scenario(port, request_headers, args.connections, args.seconds)
+            print(f"{name:<12} {result['rps']:>9.0f} {result['bytes_per_response']:>11.0f}  {result['statuses']}")
+    finally:
+        app.terminate()
+        baseline.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=8110)
+    parser.add_argument("--baseline-server", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.baseline_server:
+        import uvicorn
+        uvicorn.run(baseline_app(), host="127.0.0.1", port=args.baseline_server, log_level="warning", access_log=False)
+    else:
+        asyncio.run(main(args))
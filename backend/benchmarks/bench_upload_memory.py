@@ -0,0 +1,150 @@
+"""
+Peak RSS benchmark for /api/bodyfat photo uploads.
+
+Runs the server in a subprocess twice: once with a replica of the old
+buffered handler (request.form() + image.read() + full-resolution PIL
+re-encode) and once with the current streaming endpoint, sends the same
+concurrent multi-photo uploads to both and compares the server's peak RSS.
+
+Usage (from the backend directory):
+    python benchmarks/bench_upload_memory.py --clients 8 --images 3
+"""
+import argparse
+import asyncio
+import base64
+import io
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STUB_PORT = 8099
+SERVER_PORT = 8100
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss в килобайтах на Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build_app(mode: str):
+    from fastapi import Request
+
+    import main
+    from PIL import Image
+
+    app = main.app
+
+    if mode == "buffered":
+        # Копия старого обработчика: вся форма и все файлы в памяти одновременно
+        app.router.routes = [r for r in app.router.routes if getattr(r, "path", None) != "/api/bodyfat"]
+
+        @app.post("/api/bodyfat")
+        async def buffered_bodyfat(request: Request):
+            form = await request.form()
+            images = [await image.read() for image in form.getlist("images")]
+            encoded = []
+            for image_data in images:
+                img = Image.open(io.BytesIO(image_data))
+                buffer = io.BytesIO()
+                img.convert("RGB").save(buffer, format="JPEG", quality=85, optimize=True)
+                encoded.append(base64.b64encode(buffer.getvalue()).decode("utf-8"))
+            await asyncio.sleep(0.05)  # Имитация вызова LLM, пока все буферы живы
+            return {"images": len(encoded)}
+
+    @app.get("/__peak_rss")
+    async def peak_rss():
+        return {"peak_rss_mb": _peak_rss_mb()}
+
+    return app
+
+
+def serve(mode: str) -> None:
+    import uvicorn
+
+    os.environ["OPENAI_API_KEY"] = "sk-stub"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{STUB_PORT}/v1"
+    # Ответы стаба не должны попасть в рабочую библиотеку советов
+    os.environ["ADVICE_LIBRARY_ENABLED"] = "false"
+    # Клиенты различаются по X-Forwarded-For, иначе все они - один 127.0.0.1 и упираются в лимит admission
+    os.environ["ADMISSION_TRUST_FORWARDED_FOR"] = "true"
+    uvicorn.run(build_app(mode), host="127.0.0.1", port=SERVER_PORT, log_level="warning")
+
+
+def make_photo(seed: int) -> bytes:
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    # Шум плохо сжимается - размер файла как у реального 12MP фото с телефона
+    pixels = rng.integers(0, 255, size=(3024, 4032, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=70)
+    return buffer.getvalue()
+
+
+async def drive(clients: int, photos: list[bytes]) -> float:
+    import httpx
+
+    async with httpx.AsyncClient(timeout=300) as client:
+        async def one(index: int):
+            headers = {"X-Forwarded-For": f"10.0.{index // 250}.{index % 250 + 1}"}
+            files = [("images", (f"photo{i}.jpg", photo, "image/jpeg")) for i, photo in enumerate(photos)]
+            data = {"gender": "male", "age": "30", "height": "180", "weight": "80"}
+            response = await client.post(f"http://127.0.0.1:{SERVER_PORT}/api/bodyfat", data=data, files=files,
+                                         headers=headers)
+            response.raise_for_status()
+
+        await asyncio.gather(*(one(index) for index in range(clients)))
+        response = await client.get(f"http://127.0.0.1:{SERVER_PORT}/__peak_rss")
+        return response.json()["peak_rss_mb"]
+
+
+def wait_for_port(port: int) -> None:
+    import socket
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+def main(clients: int, images_per_request: int) -> None:
+    from benchmarks.stub_openai_server import start_subprocess
+
+    # Разные фото: одинаковые проверка качества отбросила бы как повтор
+    photos = [make_photo(seed) for seed in range(images_per_request)]
+    print(f"Photo size: {len(photos[0]) / 1024 / 1024:.1f} MB, {clients} clients x {images_per_request} images")
+    stub = start_subprocess(STUB_PORT, 0.05)
+    try:
+        for mode in ("buffered", "streaming"):
+            server = subprocess.Popen([sys.executable, __file__, "--serve", mode])
+            try:
+                wait_for_port(SERVER_PORT)
+                peak = asyncio.run(drive(clients, photos))
+                print(f"{mode:>10}: peak RSS {peak:.0f} MB")
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--images", type=int, default=3)
+    parser.add_argument("--serve", choices=["buffered", "streaming"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+    else:
+        main(args.clients, args.images)
@@ -0,0 +1,389 @@
+"""
+OpenAI-compatible stand-in server for local benchmarks.
+
+Answers POST /v1/chat/completions with a JSON completion after an
+artificial delay, so the whole client, image and parse path of the app can
+be load-tested without paying for real API calls. Requests with
+"stream": true get the same completion as SSE chunks spread over the delay.
+Token usage is approximated as one token per four characters, so prompt
+variants can be compared offline; images are counted by their size and
+detail level with the gpt-4o tile formula.
+
+Behaviour is configurable:
+    --latency / --latency-dist   fixed, uniform (0..2x), lognormal (median
+                                 --latency, spread --latency-sigma) or
+                                 recorded (the latency stored in the cassette)
+    --error-rate                 fraction of calls answered with 500
+    --rate-limit-rate            fraction of calls answered with 429 + Retry-After
+    --max-concurrency            429 for calls beyond this many in flight
+    --prefill-ms-per-1k          extra delay per 1000 prompt tokens (images
+                                 included), so payload size shows in latency
+    --bandwidth-mbps             extra delay to upload the request body at
+                                 this rate (localhost uploads are free)
+    --record FILE --upstream URL proxy to a real API and append every
+                                 answer to a JSONL cassette
+    --replay FILE                answer with recorded completions, round-robin
+                                 per call kind (bodyfat_text, bodyfat_image, advice, ...)
+
+Run standalone:
+    python benchmarks/stub_openai_server.py --port 8099 --latency 0.5
+    python benchmarks/stub_openai_server.py --latency 0.8 --latency-dist lognormal --error-rate 0.02
+    python benchmarks/stub_openai_server.py --record cassette.jsonl --upstream https://api.openai.com/v1
+    python benchmarks/stub_openai_server.py --replay cassette.jsonl --latency-dist recorded
+"""
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image
+
+BODYFAT_CONTENT = {
+    "body_fat_percent": 21.5,
+    "comment": "Stub estimate for benchmarking.",
+    "evaluation": "Above Average"
+}
+
+ADVICE_CONTENT = {
+    "title": "Stub Advice",
+    "sections": [
+        {"title": "Nutrition", "content": "Eat well."},
+        {"title": "Exercise", "content": "Train often."}
+    ]
+}
+
+# Оценка и советы одним вызовом (/api/bodyfat/advice)
+BODYFAT_ADVICE_CONTENT = {
+    "body_fat_percent": BODYFAT_CONTENT["body_fat_percent"],
+    "comment": BODYFAT_CONTENT["comment"],
+    **ADVICE_CONTENT
+}
+
+STREAM_CHUNK_CHARS = 8
+
+
+def _image_tokens(image_url: dict) -> int:
+    # Формула тайлов gpt-4o: low - 85 токенов, high/auto - 85 + 170 за тайл 512px после приведения размера
+    if image_url.get("detail") == "low":
+        return 85
+    try:
+        data = base64.b64decode(image_url["url"].split(",", 1)[1])
+        with Image.open(io.BytesIO(data)) as img:
+            width, height = img.size
+    except Exception:
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def _usage(messages: list, completion: str) -> dict:
+    prompt_chars = 0
+    image_tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            for part in content:
+                if part["type"] == "text":
+                    prompt_chars += len(part["text"])
+                else:
+                    image_tokens += _image_tokens(part["image_url"])
+        else:
+            prompt_chars += len(content)
+    prompt_tokens = prompt_chars // 4 + image_tokens
+    completion_tokens = len(completion) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0}
+    }
+
+
+def call_kind(body: dict) -> str:
+    """bodyfat_text, bodyfat_image, advice or bodyfat_advice / bodyfat_image_advice, from the shape of the request."""
+    system = body["messages"][0]["content"]
+    combined = '"body_fat_percent"' in system and '"sections"' in system
+    for message in body["messages"]:
+        if isinstance(message["content"], list) and any(part["type"] == "image_url" for part in message["content"]):
+            return "bodyfat_image_advice" if combined else "bodyfat_image"
+    if combined:
+        return "bodyfat_advice"
+    if "fitness and nutrition coach" in system:
+        return "advice"
+    return "bodyfat_text"
+
+
+CANNED_CONTENT = {
+    "bodyfat_text": BODYFAT_CONTENT,
+    "bodyfat_image": BODYFAT_CONTENT,
+    "advice": ADVICE_CONTENT,
+    "bodyfat_advice": BODYFAT_ADVICE_CONTENT,
+    "bodyfat_image_advice": BODYFAT_ADVICE_CONTENT,
+}
+
+
+class LatencyModel:
+    def __init__(self, kind: str = "fixed", median: float = 0.5, sigma: float = 0.5):
+        self.kind = kind
+        self.median = median
+        self.sigma = sigma
+
+    def sample(self, recorded: Optional[float] = None) -> float:
+        if self.kind == "recorded" and recorded is not None:
+            return recorded
+        if self.kind == "uniform":
+            return random.uniform(0, 2 * self.median)
+        if self.kind == "lognormal":
+            # Медиана логнормального распределения равна exp(mu)
+            return random.lognormvariate(math.log(max(self.median, 1e-6)), self.sigma)
+        return self.median
+
+
+class Cassette:
+    """Recorded completions (JSONL), replayed round-robin per call kind."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: dict[str, list[dict]] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries.setdefault(entry["kind"], []).append(entry)
+        self._cycles: dict[str, itertools.cycle] = {kind: itertools.cycle(entries) for kind, entries in self.entries.items()}
+
+    def next(self, kind: str) -> Optional[dict]:
+        cycle = self._cycles.get(kind)
+        return next(cycle) if cycle is not None else None
+
+    def append(self, entry: dict) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.entries.setdefault(entry["kind"], []).append(entry)
+
+
+def _stream_chunks(model: str, text: str, latency: float, usage: dict | None):
+    pieces = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+
+    async def events():
+        for piece in pieces:
+            await asyncio.sleep(latency / len(pieces))
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        if usage is not None:
+            chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [], "usage": usage}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def _error(status_code: int, message: str, error_type: str, headers: Optional[dict] = None) -> JSONResponse:
+    return JSONResponse({"error": {"message": message, "type": error_type}}, status_code=status_code, headers=headers)
+
+
+def create_app(
+    latency: float = 0.5,
+    latency_dist: str = "fixed",
+    latency_sigma: float = 0.5,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    retry_after: float = 1.0,
+    max_concurrency: int = 0,
+    replay: Optional[str] = None,
+    record: Optional[str] = None,
+    upstream: Optional[str] = None,
+    prefill_ms_per_1k: float = 0.0,
+    bandwidth_mbps: float = 0.0
+) -> FastAPI:
+    app = FastAPI(title="OpenAI stub")
+    latency_model = LatencyModel(latency_dist, latency, latency_sigma)
+    cassette = Cassette(replay or record) if (replay or record) else None
+    proxy = httpx.AsyncClient(base_url=upstream, timeout=120) if record and upstream else None
+    stats = {"requests": 0, "errors": 0, "rate_limited": 0, "in_flight": 0, "max_in_flight": 0,
+             "request_bytes": 0, "prompt_tokens": 0}
+
+    async def _record(body: dict, kind: str, authorization: str):
+        # Запрос к настоящему API всегда без stream: в кассету пишется целый ответ
+        payload = {key: value for key, value in body.items() if key not in ("stream", "stream_options")}
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if api_key:
+            # Ключ из окружения важнее заглушки "sk-stub", с которой ходит приложение
+            authorization = f"Bearer {api_key}"
+        started = time.perf_counter()
+        upstream_response = await proxy.post(
+            "/chat/completions",
+            json=payload,
+            headers={"Authorization": authorization} if authorization else {}
+        )
+        elapsed = time.perf_counter() - started
+        if upstream_response.status_code != 200:
+            return None, upstream_response
+        data = upstream_response.json()
+        entry = {
+            "kind": kind,
+            "model": body.get("model"),
+            "content": data["choices"][0]["message"]["content"],
+            "usage": data.get("usage"),
+            "latency": round(elapsed, 4),
+        }
+        cassette.append(entry)
+        return entry, None
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        raw = await request.body()
+        body = json.loads(raw)
+        stats["requests"] += 1
+        stats["request_bytes"] += len(raw)
+        if max_concurrency and stats["in_flight"] >= max_concurrency:
+            stats["rate_limited"] += 1
+            return _error(429, "Rate limit reached (concurrency)", "rate_limit_error", {"retry-after": str(retry_after)})
+        roll = random.random()
+        if roll < rate_limit_rate:
+            stats["rate_limited"] += 1
+            return _error(429, "Rate limit reached", "rate_limit_error", {"retry-after": str(retry_after)})
+        if roll < rate_limit_rate + error_rate:
+            stats["errors"] += 1
+            await asyncio.sleep(latency_model.sample() / 2)
+            return _error(500, "Injected server error", "server_error")
+
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            kind = call_kind(body)
+            entry = None
+            if proxy is not None:
+                entry, failed = await _record(body, kind, request.headers.get("authorization", ""))
+                if failed is not None:
+                    return JSONResponse(failed.json(), status_code=failed.status_code)
+            elif cassette is not None:
+                entry = cassette.next(kind)
+
+            if entry is not None:
+                completion = entry["content"]
+                if proxy is not None:
+                    usage = entry.get("usage") or _usage(body["messages"], completion)
+                else:
+                    # Записанный usage относится к записанному запросу - при воспроизведении считаем по текущему
+                    usage = _usage(body["messages"], completion)
+                delay = 0.0 if proxy is not None else latency_model.sample(entry.get("latency"))
+            else:
+                completion = json.dumps(CANNED_CONTENT[kind], indent=2)
+                usage = _usage(body["messages"], completion)
+                delay = latency_model.sample()
+            stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+            if proxy is None:
+                delay += usage["prompt_tokens"] / 1000 * prefill_ms_per_1k / 1000
+                if bandwidth_mbps:
+                    delay += len(raw) * 8 / (bandwidth_mbps * 1_000_000)
+
+            if body.get("stream"):
+                include_usage = (body.get("stream_options") or {}).get("include_usage")
+                return _stream_chunks(body.get("model", "stub"), completion, delay, usage if include_usage else None)
+            await asyncio.sleep(delay)
+            return {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": completion},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            }
+        finally:
+            stats["in_flight"] -= 1
+
+    @app.get("/stats")
+    async def get_stats():
+        return {**stats, "cassette": {kind: len(entries) for kind, entries in cassette.entries.items()} if cassette else None}
+
+    return app
+
+
+def start_subprocess(port: int, latency: float, extra_args: tuple = ()) -> subprocess.Popen:
+    """
+    Start the stub in a separate process (so it does not compete with the
+    benchmarked code for the GIL) and wait until it accepts connections.
+    extra_args are passed to the command line (e.g. ["--error-rate", "0.05"]).
+    """
+    process = subprocess.Popen(
+        [sys.executable, __file__, "--port", str(port), "--latency", str(latency), *extra_args]
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"Stub server did not start on port {port}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.5, help="Response delay (median) in seconds")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal", "recorded"], default="fixed")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the lognormal distribution")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of calls answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of 429 answers, seconds")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="429 beyond this many calls in flight (0 - off)")
+    parser.add_argument("--replay", help="JSONL cassette to answer from")
+    parser.add_argument("--record", help="JSONL cassette to append upstream answers to")
+    parser.add_argument("--upstream", help="Real API base URL for --record, e.g. https://api.openai.com/v1")
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=0.0,
+                        help="Extra delay per 1000 prompt tokens, milliseconds")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0.0, help="Simulated upload bandwidth (0 - off)")
+    args = parser.parse_args()
+    if args.record and not args.upstream:
+        parser.error("--record needs --upstream")
+    uvicorn.run(
+        create_app(
+            latency=args.latency,
+            latency_dist=args.latency_dist,
+            latency_sigma=args.latency_sigma,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            retry_after=args.retry_after,
+            max_concurrency=args.max_concurrency,
+            replay=args.replay,
+            record=args.record,
+            upstream=args.upstream,
+            prefill_ms_per_1k=args.prefill_ms_per_1k,
+            bandwidth_mbps=args.bandwidth_mbps
+        ),
+        host="127.0.0.1",
+        port=args.port,
+        log_level="warning"
+    )
@@ -1,14 +1,66 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Request
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Request, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from models import BodyFatRequest, BodyFatResponse, Gender, AdviceRequest, AdviceResponse
-from services.openai_client import calculate_body_fat, calculate_body_fat_with_image, generate_advice
+from fastapi.responses import StreamingResponse
+from models import BodyFatRequest, BodyFatResponse, Gender, AdviceRequest, AdviceResponse, BodyFatAdviceResponse
+from services.openai_client import (
+    calculate_body_fat, calculate_body_fat_with_image, generate_advice, stream_advice,
+    calculate_body_fat_with_advice, local_body_fat_with_advice,
+    get_bodyfat_cache, get_image_result_cache, get_single_flight_stats
+)
+from services import llm_client, image_workers, jobs
+from services.image_workers import ImageQueueFullError
+from services.jobs import JobQueueFullError
+from services.photo_quality import PhotoQualityError, dropped_photos_var, get_photo_quality_stats
+from services.vision_layout import get_vision_layout_stats
+from services.circuit_breaker import CircuitOpenError, get_breaker_stats
+from services.usage import get_usage_stats
+from services import metrics
+from services.metrics import ERRORS, FALLBACKS, FORM_PARSE, MetricFamily, MetricsMiddleware
+from services.log import RequestIDMiddleware, get_log_stats, get_logger, setup_logging, should_log, shutdown_logging
+from services import static_assets, tracing
+from services.static_assets import get_static_assets
+from services.tracing import TracingMiddleware, span
+from services.admission import AdmissionLimiter, AdmissionRejectedError, client_id, get_admission_stats, get_limiter
+from services.estimator import estimate_body_fat
+from services.hedging import estimate_source, get_latency_stats
+from services.advice_library import get_advice_library
+from services.uploads import ParsedForm, UploadFormatError, UploadTooLargeError, parse_multipart, parse_urlencoded
+from services.batch import BatchFormatError, BatchTooLargeError, read_records, score_llm, score_local
+from pydantic import ValidationError
 from config import settings
-from typing import Optional
-import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Literal, Optional
+import asyncio
+import json
+import math
+import time
+
+# Логи пишет отдельный поток из очереди - настраиваем до первых записей
+setup_logging()
+logger = get_logger("api")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Один общий клиент OpenAI с keep-alive пулом на весь процесс
+    await llm_client.startup()
+    # Пул воркеров для обработки изображений вне event loop
+    image_workers.startup()
+    # Воркеры фоновых задач анализа фото
+    await jobs.startup()
+    # Веб-интерфейс в памяти, предсжатый
+    await static_assets.startup()
+    yield
+    await static_assets.shutdown()
+    await jobs.shutdown()
+    image_workers.shutdown()
+    await llm_client.shutdown()
+    await asyncio.to_thread(tracing.flush)
+    shutdown_logging()
+
 
-app = FastAPI(title="BodyFatAI API", version="1.0.0")
+app = FastAPI(title="BodyFatAI API", version="1.0.0", lifespan=lifespan)
 
 # CORS middleware для работы с мобильным приложением
 app.add_middleware(
@@ -19,107 +71,634 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Счетчики и время ответа по шаблонам маршрутов для /metrics
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+# Трассировка и профилирование выборки запросов (tracing_enabled, profile_sample_rate)
+app.add_middleware(TracingMiddleware)
+# Добавлен последним - внешний слой, ID запроса виден во всех остальных
+app.add_middleware(RequestIDMiddleware)
+
+
+# Веб-интерфейс раздается из памяти (файлы читаются и сжимаются при старте)
+@app.api_route("/", methods=["GET", "HEAD"])
+async def root(request: Request):
+    """
+    Web UI (index.html) with gzip/brotli, ETag and 304 support.
+    Always revalidated by the browser, so a new deploy is picked up at once.
+    """
+    assets = get_static_assets()
+    asset = assets.get("index.html")
+    if asset is not None:
+        return assets.response(request, asset, "no-cache")
+    return {"message": "BodyFatAI API is running", "docs": "/docs"}
+
 
-# Раздача статических файлов (веб-интерфейс)
-# Получаем абсолютный путь к папке web
-backend_dir = os.path.dirname(os.path.abspath(__file__))
-project_dir = os.path.dirname(backend_dir)
-web_dir = os.path.join(project_dir, "web")
-html_path = os.path.join(web_dir, "index.html")
-
-# Отладочная информация
-print(f"Backend dir: {backend_dir}")
-print(f"Project dir: {project_dir}")
-print(f"Web dir: {web_dir}")
-print(f"HTML path: {html_path}")
-print(f"HTML exists: {os.path.exists(html_path)}")
-
-if os.path.exists(web_dir):
-    app.mount("/static", StaticFiles(directory=web_dir), name="static")
-
-@app.get("/")
-async def root():
-    # Возвращаем HTML файл веб-интерфейса
-    # Вычисляем путь динамически на случай, если сервер запущен из другой директории
-    current_backend_dir = os.path.dirname(os.path.abspath(__file__))
-    current_project_dir = os.path.dirname(current_backend_dir)
-    current_web_dir = os.path.join(current_project_dir, "web")
-    current_html_path = os.path.join(current_web_dir, "index.html")
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def static_file(path: str, request: Request):
+    assets = get_static_assets()
+    asset = assets.get(path)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return assets.response(request, asset, f"public, max-age={settings.static_max_age_seconds}")
+
+
+# Схема multipart формы для /docs (форма разбирается вручную потоково)
+BODYFAT_FORM_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["gender", "age", "height", "weight"],
+                    "properties": {
+                        "gender": {"type": "string", "enum": ["male", "female"]},
+                        "age": {"type": "integer"},
+                        "height": {"type": "number"},
+                        "weight": {"type": "number"},
+                        "waist": {"type": "string"},
+                        "neck": {"type": "string"},
+                        "hip": {"type": "string"},
+                        "engine": {"type": "string", "enum": ["llm", "local"], "default": "llm"},
+                        "images": {"type": "array", "items": {"type": "string", "format": "binary"}}
+                    }
+                }
+            }
+        }
+    }
+}
+
+
+def _optional_float(value: Optional[str]) -> Optional[float]:
+    # Необязательные обхваты могут прийти пустой строкой
+    if value and value.strip():
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+async def _parse_bodyfat_form(request: Request) -> tuple[BodyFatRequest, ParsedForm]:
+    """
+    Stream the /api/bodyfat form with upload size limits and build a BodyFatRequest.
+    The caller must close the returned form to release spooled files.
+    """
+    started = time.perf_counter()
+    content_type = request.headers.get("content-type", "")
+    kind = "multipart" if content_type.startswith("multipart/form-data") else "urlencoded"
+    try:
+        with span("form.read", kind=kind):
+            if kind == "multipart":
+                form = await parse_multipart(request)
+            else:
+                # urlencoded формы без файлов небольшие, но тело все равно читаем с лимитом
+                form = await parse_urlencoded(request)
+    except UploadTooLargeError as e:
+        ERRORS.inc("bodyfat", "upload_too_large")
+        raise HTTPException(status_code=413, detail=str(e))
+    except UploadFormatError as e:
+        ERRORS.inc("bodyfat", "bad_form")
+        raise HTTPException(status_code=400, detail=str(e))
     
-    if os.path.exists(current_html_path):
-        return FileResponse(current_html_path, media_type="text/html")
-    return {"message": "BodyFatAI API is running", "docs": "/docs", "html_path": current_html_path, "exists": os.path.exists(current_html_path)}
+    # Создаем объект запроса
+    try:
+        body_fat_request = BodyFatRequest(
+            gender=form.fields.get("gender"),
+            age=form.fields.get("age"),
+            height=form.fields.get("height"),
+            weight=form.fields.get("weight"),
+            waist=_optional_float(form.fields.get("waist")),
+            neck=_optional_float(form.fields.get("neck")),
+            hip=_optional_float(form.fields.get("hip"))
+        )
+    except ValidationError as e:
+        form.close()
+        ERRORS.inc("bodyfat", "validation")
+        raise RequestValidationError(e.errors())
+    
+    FORM_PARSE.observe(time.perf_counter() - started, kind)
+    return body_fat_request, form
+
 
+def _sse(event: str, data: Any) -> str:
+    if hasattr(data, "model_dump"):
+        data = data.model_dump()
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-@app.post("/api/bodyfat", response_model=BodyFatResponse)
-async def calculate_body_fat_percent(
-    request: Request,
-    gender: Gender = Form(...),
-    age: int = Form(...),
-    height: float = Form(...),
-    weight: float = Form(...),
-    waist: Optional[str] = Form(None)
-):
+
+def _sse_response(events: AsyncIterator[str]) -> StreamingResponse:
+    # Отключаем буферизацию прокси, чтобы события уходили клиенту сразу
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def _bodyfat_events(body_fat_request: BodyFatRequest, form: ParsedForm) -> AsyncIterator[str]:
+    """
+    SSE events of a streamed estimate: an instant local "estimate",
+    then the LLM "result" (or "error" if it failed and the local fallback is off).
+    """
+    try:
+        yield _sse("estimate", {"source": "local", **estimate_body_fat(body_fat_request).model_dump()})
+        images = form.get_files("images")
+        try:
+            if images:
+                result = await calculate_body_fat_with_image(
+                    body_fat_request,
+                    [image.file for image in images],
+                    [image.content_type or "image/jpeg" for image in images]
+                )
+            else:
+                result = await calculate_body_fat(body_fat_request)
+            source = estimate_source()
+        except PhotoQualityError as e:
+            ERRORS.inc("bodyfat", "photo_quality")
+            yield _sse("error", {"detail": str(e), "photos": e.issues})
+            return
+        except Exception as e:
+            if not settings.local_fallback_enabled:
+                ERRORS.inc("bodyfat", "llm_error")
+                logger.exception("Error calculating body fat")
+                yield _sse("error", {"detail": f"Error calculating body fat: {str(e)}"})
+                return
+            logger.warning("LLM unavailable, answering from local estimator: %s", e)
+            FALLBACKS.inc("bodyfat", "error")
+            result = estimate_body_fat(body_fat_request)
+            source = "local-fallback"
+        yield _sse("result", {"source": source, "dropped_photos": dropped_photos_var.get() or [], **result.model_dump()})
+    finally:
+        form.close()
+
+
+def _report_dropped_photos(response: Response) -> None:
+    """X-Photos-Dropped: photos the quality gate did not send to the model, as "index:issue+issue, ..."."""
+    dropped = dropped_photos_var.get()
+    if dropped:
+        response.headers["X-Photos-Dropped"] = ", ".join(
+            f"{item['index']}:{'+'.join(item['issues'])}" for item in dropped
+        )
+
+
+def _local_answer(response: Response, body_fat_request: BodyFatRequest, reason: str) -> BodyFatResponse:
+    """Answer /api/bodyfat from the local estimator instead of the LLM."""
+    FALLBACKS.inc("bodyfat", reason)
+    response.headers["X-Estimate-Source"] = "local-fallback"
+    with span("local.estimate", reason=reason):
+        return estimate_body_fat(body_fat_request)
+
+
+def _photo_quality_error(endpoint: str, e: PhotoQualityError) -> HTTPException:
+    # Пользователь может переснять фото - сообщаем, что с каждым не так
+    ERRORS.inc(endpoint, "photo_quality")
+    return HTTPException(status_code=422, detail=str(e))
+
+
+def _client_id(request: Request) -> str:
+    return client_id(
+        request.headers.get("x-api-key"),
+        request.headers.get("x-forwarded-for"),
+        request.client.host if request.client else None
+    )
+
+
+def _admission_error(e: AdmissionRejectedError) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+
+def _queue_time_header(queue_time: float) -> dict:
+    return {"X-Queue-Time-Ms": f"{queue_time * 1000:.1f}"}
+
+
+async def _release_after(events: AsyncIterator[str], limiter: AdmissionLimiter, client: str) -> AsyncIterator[str]:
+    # Слот занят, пока потоковый ответ не отдан целиком
+    try:
+        async for event in events:
+            yield event
+    finally:
+        limiter.release(client)
+
+
+async def _advice_events(request: AdviceRequest) -> AsyncIterator[str]:
+    try:
+        async for event, data in stream_advice(request):
+            yield _sse(event, data)
+    except Exception as e:
+        ERRORS.inc("advice", "error")
+        logger.exception("Error streaming advice")
+        yield _sse("error", {"detail": f"Error generating advice: {str(e)}"})
+
+
+@app.post("/api/bodyfat", response_model=BodyFatResponse, openapi_extra=BODYFAT_FORM_SCHEMA)
+async def calculate_body_fat_percent(request: Request, response: Response, stream: bool = False):
     """
     Calculate body fat percentage based on user input and optionally images.
     If images are provided, the first image will be analyzed using GPT-4 Vision to improve accuracy.
+    Uploads are streamed to spooled temporary files with per-file and per-request size limits.
+    Send engine=local to get an instant estimate from the local formula engine;
+    it is also used as a fallback when the LLM is unavailable.
+    With ?stream=true the answer is a text/event-stream: a local "estimate"
+    event right away, then the final "result".
+    LLM requests pass admission control (separate vision and text budgets);
+    the time spent waiting for a slot is reported in X-Queue-Time-Ms.
+    Photos dropped by the quality gate (blurry, dark, repeated) are listed
+    in X-Photos-Dropped by upload index.
     """
+    body_fat_request, form = await _parse_bodyfat_form(request)
+    use_llm = form.fields.get("engine") != "local"
+    if use_llm:
+        # Фото и текст ограничиваются раздельно: vision-вызовы намного дороже
+        limiter = get_limiter("vision" if form.get_files("images") else "text")
+        client = _client_id(request)
+        try:
+            with span("admission.wait", limiter=limiter.name):
+                queue_time = await limiter.acquire(client)
+        except AdmissionRejectedError as e:
+            form.close()
+            # Общая перегрузка - как и при переполнении пула изображений, отвечаем локальной оценкой
+            if e.status_code == 503 and settings.local_fallback_enabled:
+                logger.warning("Admission rejected, answering from local estimator: %s", e)
+                return _local_answer(response, body_fat_request, "admission")
+            raise _admission_error(e)
+        response.headers.update(_queue_time_header(queue_time))
+        if stream:
+            # Форму закроет генератор событий после ответа модели, слот освободит обертка
+            events = _release_after(_bodyfat_events(body_fat_request, form), limiter, client)
+            sse_response = _sse_response(events)
+            sse_response.headers.update(_queue_time_header(queue_time))
+            return sse_response
     try:
-        # Получаем файлы из формы
-        form = await request.form()
-        images = form.getlist("images")  # Получаем все файлы с ключом "images"
+        images = form.get_files("images")  # Получаем все файлы с ключом "images"
         
-        # Обрабатываем waist - может быть пустой строкой
-        waist_float = None
-        if waist and waist.strip():
-            try:
-                waist_float = float(waist)
-            except ValueError:
-                waist_float = None
-        
-        # Создаем объект запроса
-        body_fat_request = BodyFatRequest(
-            gender=gender,
-            age=age,
-            height=height,
-            weight=weight,
-            waist=waist_float
-        )
+        # Локальный расчет по формулам по запросу клиента - без вызова LLM
+        if form.fields.get("engine") == "local":
+            response.headers["X-Estimate-Source"] = "local"
+            with span("local.estimate"):
+                return estimate_body_fat(body_fat_request)
         
         # Если есть изображения, используем анализ с фото
-        if images and len(images) > 0:
-            # Собираем все изображения для анализа
+        if images:
+            # Передаем файлы целиком, PIL декодирует их прямо из временных файлов
             image_data_list = []
             content_type_list = []
             for image in images:
-                print(f"Processing image: {image.filename if hasattr(image, 'filename') else 'unknown'}, content_type: {image.content_type if hasattr(image, 'content_type') else 'unknown'}")
-                image_data_list.append(await image.read())
-                content_type_list.append(image.content_type if hasattr(image, 'content_type') else "image/jpeg")
+                image_data_list.append(image.file)
+                content_type_list.append(image.content_type or "image/jpeg")
             
-            print(f"Processing {len(image_data_list)} image(s) for analysis")
-            result = await calculate_body_fat_with_image(body_fat_request, image_data_list, content_type_list)
+            if should_log("bodyfat_images"):
+                logger.info("Processing images", extra={
+                    "images": [{"filename": image.filename, "content_type": image.content_type, "size": image.size}
+                               for image in images],
+                    "sample_every": settings.log_sample_every,
+                })
+            stage_timings = {}
+            result = await calculate_body_fat_with_image(body_fat_request, image_data_list, content_type_list, stage_timings)
+            if stage_timings:
+                response.headers["Server-Timing"] = ", ".join(
+                    f"image-{stage};dur={value}" for stage, value in stage_timings.items()
+                )
         else:
-            print("No images provided, using regular calculation")
             result = await calculate_body_fat(body_fat_request)
         
+        # Ответ мог прийти от хеджа или от локальной оценки по истечении бюджета
+        response.headers["X-Estimate-Source"] = estimate_source()
+        _report_dropped_photos(response)
         return result
+    except PhotoQualityError as e:
+        raise _photo_quality_error("bodyfat", e)
+    except ImageQueueFullError as e:
+        if settings.local_fallback_enabled:
+            logger.warning("Image workers overloaded, answering from local estimator: %s", e)
+            return _local_answer(response, body_fat_request, "image_queue_full")
+        ERRORS.inc("bodyfat", "image_queue_full")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except CircuitOpenError as e:
+        # Апстрим признан нездоровым - отвечаем локально или просим повторить после паузы
+        if settings.local_fallback_enabled:
+            return _local_answer(response, body_fat_request, "circuit_open")
+        ERRORS.inc("bodyfat", "circuit_open")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
     except Exception as e:
-        import traceback
-        error_detail = f"Error calculating body fat: {str(e)}\n{traceback.format_exc()}"
-        raise HTTPException(status_code=500, detail=error_detail)
+        # LLM недоступен или перегружен - отвечаем локальной оценкой вместо ошибки
+        if settings.local_fallback_enabled:
+            logger.warning("LLM unavailable, answering from local estimator: %s", e)
+            return _local_answer(response, body_fat_request, "error")
+        ERRORS.inc("bodyfat", "llm_error")
+        # Traceback только в лог; клиент получает короткое сообщение и ID запроса в X-Request-ID
+        logger.exception("Error calculating body fat")
+        raise HTTPException(status_code=500, detail=f"Error calculating body fat: {str(e)}")
+    finally:
+        form.close()
+        if use_llm:
+            limiter.release(client)
+
+
+@app.post("/api/bodyfat/advice", response_model=BodyFatAdviceResponse, openapi_extra=BODYFAT_FORM_SCHEMA)
+async def calculate_body_fat_and_advice(request: Request, response: Response):
+    """
+    Body fat estimate and advice for it in one request (same form as /api/bodyfat).
+    The LLM estimates and writes the advice in a single call, so the app does
+    not need a second round-trip to /api/advice; time estimates and the
+    Nutrition macros are calculated locally from the estimate.
+    With engine=local the estimate is local and only the advice may use the LLM.
+    X-Estimate-Source tells where the estimate came from, X-Photos-Dropped
+    which photos the quality gate did not send.
+    """
+    body_fat_request, form = await _parse_bodyfat_form(request)
+    images = form.get_files("images")
+    use_vision = bool(images) and form.fields.get("engine") != "local"
+    limiter = get_limiter("vision" if use_vision else "text")
+    client = _client_id(request)
+    try:
+        with span("admission.wait", limiter=limiter.name):
+            queue_time = await limiter.acquire(client)
+    except AdmissionRejectedError as e:
+        form.close()
+        raise _admission_error(e)
+    response.headers.update(_queue_time_header(queue_time))
+    try:
+        if form.fields.get("engine") == "local":
+            response.headers["X-Estimate-Source"] = "local"
+            return await local_body_fat_with_advice(body_fat_request)
+        
+        stage_timings = {}
+        result = await calculate_body_fat_with_advice(
+            body_fat_request,
+            [image.file for image in images],
+            [image.content_type or "image/jpeg" for image in images],
+            stage_timings
+        )
+        if stage_timings:
+            response.headers["Server-Timing"] = ", ".join(
+                f"image-{stage};dur={value}" for stage, value in stage_timings.items()
+            )
+        # Хедж и резерв - локальная оценка
+        response.headers["X-Estimate-Source"] = estimate_source()
+        _report_dropped_photos(response)
+        return result
+    except PhotoQualityError as e:
+        raise _photo_quality_error("bodyfat_advice", e)
+    except (ImageQueueFullError, CircuitOpenError) as e:
+        if settings.local_fallback_enabled:
+            logger.warning("LLM unavailable, answering from local estimator: %s", e)
+            FALLBACKS.inc("bodyfat_advice", "image_queue_full" if isinstance(e, ImageQueueFullError) else "circuit_open")
+            response.headers["X-Estimate-Source"] = "local-fallback"
+            return await local_body_fat_with_advice(body_fat_request)
+        ERRORS.inc("bodyfat_advice", "unavailable")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        ERRORS.inc("bodyfat_advice", "llm_error")
+        logger.exception("Error calculating body fat with advice")
+        raise HTTPException(status_code=500, detail=f"Error calculating body fat with advice: {str(e)}")
+    finally:
+        form.close()
+        limiter.release(client)
+
+
+@app.post("/api/bodyfat/jobs", status_code=202, openapi_extra=BODYFAT_FORM_SCHEMA)
+async def create_body_fat_job(request: Request):
+    """
+    Queue a body fat analysis (same form as /api/bodyfat) and return its job ID at once.
+    Poll GET /api/bodyfat/jobs/{job_id} for the result; the analysis keeps
+    running even if the client disconnects.
+    """
+    body_fat_request, form = await _parse_bodyfat_form(request)
+    job_queue = await jobs.get_job_queue()
+    try:
+        job = job_queue.submit(body_fat_request, form)
+    except JobQueueFullError as e:
+        form.close()
+        ERRORS.inc("job", "queue_full")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return {"job_id": job["id"], "status": job["status"], "poll_url": f"/api/bodyfat/jobs/{job['id']}"}
+
+
+@app.get("/api/bodyfat/jobs/{job_id}")
+async def get_body_fat_job(job_id: str, wait: float = 0.0):
+    """
+    Status and result of a queued analysis.
+    With wait=N the request long-polls up to N seconds (capped by job_max_wait_seconds)
+    until the job is finished.
+    """
+    job_queue = await jobs.get_job_queue()
+    job = await job_queue.wait(job_id, min(max(wait, 0.0), settings.job_max_wait_seconds))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job
+
+
+async def _ndjson_lines(blocks: AsyncIterator[list[dict]]) -> AsyncIterator[str]:
+    # Один блок результатов - одна запись в сокет
+    async for block in blocks:
+        yield "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in block)
+
+
+@app.post("/api/bodyfat/batch")
+async def calculate_body_fat_batch(request: Request, mode: Literal["local", "llm"] = "local"):
+    """
+    Score many BodyFatRequest records in one call.
+    The body is a JSON array or NDJSON (Content-Type: application/x-ndjson).
+    mode=local uses the vectorized local engine; mode=llm fans out to the LLM
+    with limited concurrency. Results are streamed back as NDJSON in input order,
+    one line per record with its "index", or an "error" for invalid records.
+    An llm batch takes one text admission slot for its whole duration.
+    """
+    try:
+        records = await read_records(request)
+    except BatchTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except BatchFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if mode == "local":
+        return StreamingResponse(_ndjson_lines(score_local(records)), media_type="application/x-ndjson")
+    
+    limiter = get_limiter("text")
+    client = _client_id(request)
+    try:
+        queue_time = await limiter.acquire(client)
+    except AdmissionRejectedError as e:
+        raise _admission_error(e)
+    lines = _release_after(_ndjson_lines(score_llm(records)), limiter, client)
+    return StreamingResponse(lines, media_type="application/x-ndjson", headers=_queue_time_header(queue_time))
 
 
 @app.post("/api/advice", response_model=AdviceResponse)
-async def get_advice(request: AdviceRequest):
+async def get_advice(request: AdviceRequest, http_request: Request, response: Response, stream: bool = False):
     """
     Get personalized advice for body fat management based on current body fat percentage.
+    With ?stream=true the answer is a text/event-stream of "time_estimate",
+    "title" and one "section" event per section as soon as each is generated,
+    followed by "done" with the full response.
     """
+    limiter = get_limiter("text")
+    client = _client_id(http_request)
+    try:
+        queue_time = await limiter.acquire(client)
+    except AdmissionRejectedError as e:
+        raise _admission_error(e)
+    if stream:
+        sse_response = _sse_response(_release_after(_advice_events(request), limiter, client))
+        sse_response.headers.update(_queue_time_header(queue_time))
+        return sse_response
+    response.headers.update(_queue_time_header(queue_time))
     try:
         result = await generate_advice(request)
         return result
     except Exception as e:
-        import traceback
-        error_detail = f"Error generating advice: {str(e)}\n{traceback.format_exc()}"
-        raise HTTPException(status_code=500, detail=error_detail)
+        ERRORS.inc("advice", "error")
+        logger.exception("Error generating advice")
+        raise HTTPException(status_code=500, detail=f"Error generating advice: {str(e)}")
+    finally:
+        limiter.release(client)
+
+
+@app.get("/api/stats/llm-pool")
+async def get_llm_pool_stats():
+    """
+    Connection reuse statistics of the shared OpenAI client.
+    """
+    return llm_client.get_pool_stats()
+
+
+@app.get("/api/stats/image-pool")
+async def get_image_pool_stats():
+    """
+    Current load of the image processing worker pool.
+    """
+    return image_workers.get_pool_stats()
+
+
+def _caches() -> dict:
+    return {
+        "bodyfat": get_bodyfat_cache(),
+        "image_payload": image_workers.get_payload_cache(),
+        "image_result": get_image_result_cache(),
+        "advice_library": get_advice_library(),
+    }
+
+
+def _collect_cache_metrics() -> list[MetricFamily]:
+    samples = {}
+    for name, cache in _caches().items():
+        if cache is not None:
+            stats = cache.snapshot()
+            samples[(name, "hit")] = stats["hits"]
+            samples[(name, "miss")] = stats["misses"]
+    return [MetricFamily("bodyfat_cache_requests_total", "counter", "Cache lookups by cache and result.",
+                         ("cache", "result"), samples)]
+
+
+metrics.register_collector(_collect_cache_metrics)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """
+    Prometheus text exposition of request, stage, LLM, fallback, error and cache metrics.
+    """
+    if not settings.metrics_enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/api/stats/cache")
+async def get_cache_stats():
+    """
+    Hit/miss counters of the result caches.
+    """
+    return {name: cache.snapshot() if cache is not None else None for name, cache in _caches().items()}
+
+
+@app.get("/api/stats/latency")
+async def get_latency_percentiles():
+    """
+    Tail latency percentiles and winning attempt counts of hedged LLM calls.
+    """
+    return get_latency_stats()
+
+
+@app.get("/api/stats/admission")
+async def get_admission_control_stats():
+    """
+    Active, queued and rejected requests of the vision and text admission limiters.
+    """
+    return get_admission_stats()
+
+
+@app.get("/api/stats/breakers")
+async def get_circuit_breaker_stats():
+    """
+    State (closed, open, half_open) and recent error/slow-call rates of the per-model circuit breakers.
+    """
+    return get_breaker_stats()
+
+
+@app.get("/api/stats/tokens")
+async def get_token_usage_stats():
+    """
+    Prompt, completion and cached token counts per call, prompt variant and model.
+    """
+    return get_usage_stats()
+
+
+@app.get("/api/stats/jobs")
+async def get_job_stats():
+    """
+    Queue depth, wait time and run time of background analysis jobs.
+    """
+    job_queue = await jobs.get_job_queue()
+    return job_queue.snapshot()
+
+
+@app.get("/api/stats/coalescing")
+async def get_coalescing_stats():
+    """
+    Upstream calls saved by coalescing identical in-flight requests.
+    """
+    return get_single_flight_stats()
 
 
+@app.get("/api/stats/logs")
+async def get_logging_stats():
+    """
+    Log level, queue fill and records dropped because the log queue was full.
+    """
+    return get_log_stats()
+
+
+@app.get("/api/stats/tracing")
+async def get_tracing_state():
+    """
+    Tracing and profiling settings and how many requests were traced or profiled.
+    """
+    return tracing.get_tracing_stats()
+
+
+@app.get("/api/stats/photo-quality")
+async def get_photo_quality_gate_stats():
+    """
+    Local photo quality gate: thresholds, photos checked and dropped,
+    vision calls and estimated vision tokens saved.
+    """
+    return get_photo_quality_stats()
+
+
+@app.get("/api/stats/vision-layout")
+async def get_vision_layout_state():
+    """
+    Detail levels and mosaics of the photos sent to the vision model, with
+    estimated vision tokens before and after the layout.
+    """
+    return get_vision_layout_stats()
+
+
+@app.get("/api/stats/static")
+async def get_static_stats():
+    """
+    Web UI files held in memory and the size of their precompressed variants.
+    """
+    return get_static_assets().snapshot()
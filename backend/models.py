@@ -14,6 +14,8 @@ class BodyFatRequest(BaseModel):
     height: float = Field(..., gt=0, description="Height in centimeters")
     weight: float = Field(..., gt=0, description="Weight in kilograms")
     waist: Optional[float] = Field(None, gt=0, description="Waist circumference in centimeters (optional)")
+    neck: Optional[float] = Field(None, gt=0, description="Neck circumference in centimeters (optional, enables US Navy formula)")
+    hip: Optional[float] = Field(None, gt=0, description="Hip circumference in centimeters (optional, used by US Navy formula for women)")
 
     @field_validator("height", "weight")
     @classmethod
@@ -22,11 +24,11 @@ class BodyFatRequest(BaseModel):
             raise ValueError("Value must be positive")
         return v
 
-    @field_validator("waist")
+    @field_validator("waist", "neck", "hip")
     @classmethod
     def validate_waist(cls, v):
         if v is not None and v <= 0:
-            raise ValueError("Waist circumference must be positive if provided")
+            raise ValueError("Circumference must be positive if provided")
         return v
 
 
@@ -49,3 +51,6 @@ class AdviceResponse(BaseModel):
     time_estimate: Optional[list[dict] | str] = Field(None, description="Time estimate - array of {percent, months} or text string")
 
 
+class BodyFatAdviceResponse(BaseModel):
+    estimate: BodyFatResponse = Field(..., description="Body fat estimate")
+    advice: AdviceResponse = Field(..., description="Advice for the estimate, with time estimates and macros calculated locally")
@@ -0,0 +1,164 @@
+"""
+Offline comparison of prompt variants.
+
+Sends the same sample requests with every prompt variant of each call and
+reports latency, prompt/completion/cached tokens and the estimated cost per
+1000 calls. Run it against the real API to measure a prompt change, or with
+--stub against the local benchmark stub (token counts approximated from the
+prompt length) to compare prompt sizes without paying for calls.
+
+Usage (from the backend directory):
+    python scripts/compare_prompts.py --repeats 5
+    python scripts/compare_prompts.py --stub --calls bodyfat_text,advice
+"""
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from benchmarks.stub_openai_server import start_subprocess  # noqa: E402
+from config import settings  # noqa: E402
+from models import AdviceRequest, BodyFatRequest, Gender  # noqa: E402
+from services.image_processing import preprocess_image  # noqa: E402
+from services.llm_client import create_completion  # noqa: E402
+from services.openai_client import VISION_MODEL, _get_advice_time_estimates  # noqa: E402
+from services.prompts import PROMPTS, advice_values, bodyfat_values, image_values  # noqa: E402
+from services.usage import cached_tokens  # noqa: E402
+
+# USD за 1M токенов: вход, кэшированный вход, выход (обновлять по прайсу OpenAI)
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+
+SAMPLE_BODYFAT = [
+    BodyFatRequest(gender=Gender.MALE, age=30, height=180, weight=85, waist=90, neck=39),
+    BodyFatRequest(gender=Gender.FEMALE, age=42, height=165, weight=68, waist=80, hip=102),
+    BodyFatRequest(gender=Gender.MALE, age=55, height=175, weight=95),
+]
+
+SAMPLE_ADVICE = [
+    AdviceRequest(body_fat_percent=26.5, gender=Gender.MALE, age=30, evaluation="High"),
+    AdviceRequest(body_fat_percent=23.0, gender=Gender.FEMALE, age=42, evaluation="Normal"),
+]
+
+
+def _sample_image_url(path: str | None) -> str:
+    if path:
+        with open(path, "rb") as f:
+            data = f.read()
+    else:
+        buffer = io.BytesIO()
+        Image.new("RGB", (1200, 1600), (150, 120, 100)).save(buffer, "JPEG")
+        data = buffer.getvalue()
+    prepared = preprocess_image(data, "image/jpeg")
+    return f"data:{prepared.mime_type};base64,{prepared.base64_data}"
+
+
+def build_calls(name: str, template, image_url: str) -> list[dict]:
+    """Completion kwargs for every sample request of a call."""
+    if name == "bodyfat_text":
+        return [
+            {"model": settings.openai_model, "messages": template.messages(bodyfat_values(request)),
+             "temperature": 0.0, "seed": 42}
+            for request in SAMPLE_BODYFAT
+        ]
+    if name == "bodyfat_image":
+        return [
+            {"model": VISION_MODEL, "temperature": 0.0, "seed": 42, "messages": [
+                {"role": "system", "content": template.system},
+                {"role": "user", "content": [
+                    {"type": "text", "text": template.user_text(image_values(request, 1))},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ]},
+            ]}
+            for request in SAMPLE_BODYFAT
+        ]
+    return [
+        {"model": settings.openai_model, "temperature": 0.7,
+         "messages": template.messages(advice_values(request, _get_advice_time_estimates(request)))}
+        for request in SAMPLE_ADVICE
+    ]
+
+
+async def measure(name: str, variant: str, repeats: int, image_url: str) -> dict:
+    template = PROMPTS[name][variant]
+    calls = build_calls(name, template, image_url)
+    latencies = []
+    prompt_tokens = []
+    completion_tokens = []
+    cached = []
+    for i in range(repeats * len(calls)):
+        kwargs = calls[i % len(calls)]
+        started = time.perf_counter()
+        response = await create_completion(usage_label=template.label, response_format={"type": "json_object"}, **kwargs)
+        latencies.append(time.perf_counter() - started)
+        prompt_tokens.append(response.usage.prompt_tokens)
+        completion_tokens.append(response.usage.completion_tokens)
+        cached.append(cached_tokens(response.usage))
+
+    model = calls[0]["model"]
+    input_price, cached_price, output_price = PRICES.get(model, (0.0, 0.0, 0.0))
+    avg_prompt = statistics.mean(prompt_tokens)
+    avg_cached = statistics.mean(cached)
+    avg_completion = statistics.mean(completion_tokens)
+    cost = ((avg_prompt - avg_cached) * input_price + avg_cached * cached_price + avg_completion * output_price) / 1e6
+    return {
+        "call": name,
+        "variant": variant,
+        "system_chars": len(template.system),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "prompt": avg_prompt,
+        "cached": avg_cached,
+        "completion": avg_completion,
+        "usd_per_1k": cost * 1000,
+    }
+
+
+async def main(args) -> None:
+    image_url = _sample_image_url(args.image) if "bodyfat_image" in args.calls else ""
+    rows = []
+    for name in args.calls:
+        for variant in args.variants:
+            if variant in PROMPTS[name]:
+                rows.append(await measure(name, variant, args.repeats, image_url))
+
+    print(f"{'call':<14} {'variant':<8} {'sys chars':>9} {'p50 ms':>8} {'max ms':>8} "
+          f"{'prompt':>7} {'cached':>7} {'compl':>6} {'$/1k calls':>10}")
+    for row in rows:
+        print(f"{row['call']:<14} {row['variant']:<8} {row['system_chars']:>9} {row['p50_ms']:>8.0f} {row['max_ms']:>8.0f} "
+              f"{row['prompt']:>7.0f} {row['cached']:>7.0f} {row['completion']:>6.0f} {row['usd_per_1k']:>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", default="bodyfat_text,bodyfat_image,advice",
+                        type=lambda value: value.split(","))
+    parser.add_argument("--variants", default="legacy,compact", type=lambda value: value.split(","))
+    parser.add_argument("--repeats", type=int, default=3, help="Passes over the sample requests")
+    parser.add_argument("--image", help="Photo for bodyfat_image (a synthetic one by default)")
+    parser.add_argument("--stub", action="store_true", help="Use the local benchmark stub instead of the API")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub latency in seconds")
+    args = parser.parse_args()
+
+    stub = None
+    if args.stub:
+        stub = start_subprocess(args.port, args.latency)
+        settings.openai_api_key = "sk-stub"
+        settings.openai_base_url = f"http://127.0.0.1:{args.port}/v1"
+    elif not settings.openai_api_key:
+        sys.exit("OPENAI_API_KEY is not set (or use --stub)")
+    try:
+        asyncio.run(main(args))
+    finally:
+        if stub is not None:
+            stub.terminate()
@@ -0,0 +1,88 @@
+"""
+Offline warm-up of the advice library.
+
+Generates advice variants for every (gender, age band, body fat band,
+evaluation) bucket until each bucket holds advice_library_variants entries,
+and saves them to advice_library_path. Run it before a deploy so most
+/api/advice requests are answered without an LLM call.
+
+Usage (from the backend directory, OPENAI_API_KEY set):
+    python scripts/warm_advice_library.py --concurrency 8
+    python scripts/warm_advice_library.py --dry-run
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import settings  # noqa: E402
+from models import AdviceRequest, Gender  # noqa: E402
+from services.advice_library import get_advice_library  # noqa: E402
+from services.openai_client import _get_evaluation, _llm_advice  # noqa: E402
+
+
+def iter_bucket_requests(min_age: int, max_age: int, min_bodyfat: float, max_bodyfat: float):
+    """Yield one representative request (band midpoint) per bucket."""
+    age_band = settings.advice_age_band
+    bodyfat_band = settings.advice_bodyfat_band
+    for gender in (Gender.MALE, Gender.FEMALE):
+        for age_start in range(min_age // age_band * age_band, max_age + 1, age_band):
+            age = max(min_age, min(120, age_start + age_band // 2))
+            bodyfat = min_bodyfat // bodyfat_band * bodyfat_band
+            while bodyfat <= max_bodyfat:
+                percent = round(bodyfat + bodyfat_band / 2, 1)
+                yield AdviceRequest(
+                    body_fat_percent=percent,
+                    gender=gender,
+                    age=age,
+                    evaluation=_get_evaluation(percent, gender)
+                )
+                bodyfat += bodyfat_band
+
+
+async def main(args) -> None:
+    library = get_advice_library()
+    if library is None:
+        print("Advice library is disabled (ADVICE_LIBRARY_ENABLED=false)")
+        return
+
+    jobs = []
+    for request in iter_bucket_requests(args.min_age, args.max_age, args.min_bodyfat, args.max_bodyfat):
+        missing = library.variants_per_bucket - len(library.buckets.get(library.request_key(request), []))
+        jobs.extend([request] * max(0, missing))
+
+    print(f"{len(jobs)} advice variants to generate into {library.path}")
+    if args.dry_run or not jobs:
+        return
+    if not settings.openai_api_key:
+        print("OPENAI_API_KEY is not set")
+        return
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    done = 0
+
+    async def generate(request: AdviceRequest):
+        nonlocal done
+        async with semaphore:
+            # _llm_advice сам добавляет успешный ответ в библиотеку и сохраняет ее
+            await _llm_advice(request)
+            done += 1
+            if done % 20 == 0:
+                print(f"{done}/{len(jobs)}")
+
+    await asyncio.gather(*(generate(request) for request in jobs))
+    library.save()
+    print(library.snapshot())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--min-age", type=int, default=18)
+    parser.add_argument("--max-age", type=int, default=79)
+    parser.add_argument("--min-bodyfat", type=float, default=6.0)
+    parser.add_argument("--max-bodyfat", type=float, default=45.0)
+    parser.add_argument("--dry-run", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,187 @@
+"""
+Admission control in front of the OpenAI calls.
+
+Each limiter ("vision" for photo analyses, "text" for text-only estimates
+and advice) admits at most max_concurrent requests at a time. Further
+requests wait in a bounded queue for up to queue_timeout seconds; when the
+queue is full or the wait times out they are rejected at once with 503, so
+bursts are shed instead of turning into upstream 429s. A single client (API
+key or IP) may hold at most per_client requests per limiter; more get 429.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from config import settings
+from services.hedging import LatencyTracker
+from services.metrics import MetricFamily, register_collector
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, message: str, status_code: int, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    def __init__(
+        self,
+        name: str,
+        max_concurrent: int,
+        max_queue: int,
+        per_client: int,
+        queue_timeout: float,
+        enabled: bool = True
+    ):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self.queue_timeout = queue_timeout
+        self.enabled = enabled
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_client = 0
+        self.timeouts = 0
+        self.queue_times = LatencyTracker()
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._clients: dict[str, int] = {}
+
+    def _retry_after(self) -> float:
+        return settings.admission_retry_after_seconds
+
+    def _release_client(self, client: str) -> None:
+        count = self._clients.get(client, 0) - 1
+        if count > 0:
+            self._clients[client] = count
+        else:
+            self._clients.pop(client, None)
+
+    async def acquire(self, client: str) -> float:
+        """Wait for a slot; returns the time spent in the queue (seconds)."""
+        if not self.enabled:
+            return 0.0
+        if self._clients.get(client, 0) >= self.per_client:
+            self.rejected_client += 1
+            raise AdmissionRejectedError(
+                f"Too many concurrent {self.name} requests from this client", 429, self._retry_after()
+            )
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise AdmissionRejectedError(f"Server is busy ({self.name} queue is full)", 503, self._retry_after())
+
+        self._clients[client] = self._clients.get(client, 0) + 1
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._release_client(client)
+            self.timeouts += 1
+            raise AdmissionRejectedError(f"Server is busy ({self.name} queue timeout)", 503, self._retry_after())
+        except BaseException:
+            self._release_client(client)
+            raise
+        finally:
+            self.waiting -= 1
+
+        queue_time = time.perf_counter() - started
+        self.queue_times.record(queue_time, "admitted")
+        self.active += 1
+        self.admitted += 1
+        return queue_time
+
+    def release(self, client: str) -> None:
+        if not self.enabled:
+            return
+        self.active -= 1
+        self._release_client(client)
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def admit(self, client: str) -> AsyncIterator[float]:
+        queue_time = await self.acquire(client)
+        try:
+            yield queue_time
+        finally:
+            self.release(client)
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "per_client": self.per_client,
+            "clients": len(self._clients),
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_client": self.rejected_client,
+            "timeouts": self.timeouts,
+            "queue_time": self.queue_times.snapshot(),
+        }
+
+
+_limiters: dict[str, AdmissionLimiter] = {}
+
+
+def get_limiter(kind: str) -> AdmissionLimiter:
+    """Shared limiter for "vision" or "text" requests."""
+    if kind not in _limiters:
+        if kind == "vision":
+            max_concurrent, max_queue = settings.admission_vision_concurrency, settings.admission_vision_queue
+        else:
+            max_concurrent, max_queue = settings.admission_text_concurrency, settings.admission_text_queue
+        _limiters[kind] = AdmissionLimiter(
+            kind,
+            max_concurrent=max_concurrent,
+            max_queue=max_queue,
+            per_client=settings.admission_per_client,
+            queue_timeout=settings.admission_queue_timeout_seconds,
+            enabled=settings.admission_enabled
+        )
+    return _limiters[kind]
+
+
+def get_admission_stats() -> dict:
+    return {kind: get_limiter(kind).snapshot() for kind in ("vision", "text")}
+
+
+def _collect_metrics() -> list[MetricFamily]:
+    limiters = {(kind,): get_limiter(kind) for kind in ("vision", "text")}
+    return [
+        MetricFamily("bodyfat_admission_active", "gauge", "Requests holding an admission slot.",
+                     ("limiter",), {key: limiter.active for key, limiter in limiters.items()}),
+        MetricFamily("bodyfat_admission_waiting", "gauge", "Requests waiting for an admission slot.",
+                     ("limiter",), {key: limiter.waiting for key, limiter in limiters.items()}),
+        MetricFamily("bodyfat_admission_rejected_total", "counter", "Requests rejected by admission control.",
+                     ("limiter", "reason"), {
+                         key + (reason,): value
+                         for key, limiter in limiters.items()
+                         for reason, value in (("queue_full", limiter.rejected_queue_full),
+                                               ("client_limit", limiter.rejected_client),
+                                               ("timeout", limiter.timeouts))
+                     }),
+    ]
+
+
+register_collector(_collect_metrics)
+
+
+def _known_api_keys() -> set[str]:
+    return {key.strip() for key in settings.admission_api_keys.split(",") if key.strip()}
+
+
+def client_id(api_key: Optional[str], forwarded_for: Optional[str], host: Optional[str]) -> str:
+    """Identify the client by a configured API key, else by (optionally forwarded) IP."""
+    # Непроверенный ключ клиент может менять в каждом запросе и обходить лимит - такие ключи не учитываем
+    if api_key and api_key in _known_api_keys():
+        return f"key:{api_key}"
+    if forwarded_for and settings.admission_trust_forwarded_for:
+        return f"ip:{forwarded_for.split(',')[0].strip()}"
+    return f"ip:{host or 'unknown'}"
@@ -0,0 +1,131 @@
+"""
+Pre-generated advice library.
+
+Advice inputs are coarse, so LLM answers are stored per bucket
+(gender, age band, body fat band, evaluation). Each bucket keeps several
+variants to preserve variety; once a bucket is full, requests are answered
+from it without an LLM call. Buckets are filled lazily from live traffic or
+offline by scripts/warm_advice_library.py, and persisted to a JSON file.
+Variants written by the combined estimate + advice call have no macros and
+live in their own namespace (COMBINED), apart from the /api/advice ones.
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+from typing import Optional
+
+from config import settings
+from models import AdviceRequest
+from services.log import get_logger
+
+logger = get_logger("advice_library")
+
+# Пространство вариантов объединенного вызова: в них нет macros, /api/advice их не отдает
+COMBINED = "bodyfat_advice"
+
+
+class AdviceLibrary:
+    def __init__(self, path: str, variants_per_bucket: int, age_band: int, bodyfat_band: float):
+        self.path = path
+        self.variants_per_bucket = variants_per_bucket
+        self.age_band = age_band
+        self.bodyfat_band = bodyfat_band
+        self.buckets: dict[str, list[dict]] = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def bucket_key(self, gender: str, age: int, body_fat_percent: float, evaluation: str) -> str:
+        age_start = (age // self.age_band) * self.age_band
+        bodyfat_start = int(body_fat_percent // self.bodyfat_band * self.bodyfat_band)
+        return f"{gender}|{age_start}|{bodyfat_start}|{evaluation}"
+
+    def request_key(self, request: AdviceRequest, namespace: str = "") -> str:
+        key = self.bucket_key(request.gender.value, request.age, request.body_fat_percent, request.evaluation)
+        return f"{namespace}|{key}" if namespace else key
+
+    def lookup(self, request: AdviceRequest, namespace: str = "") -> Optional[dict]:
+        """Return a random variant ({"title", "sections"}) if the bucket is full."""
+        variants = self.buckets.get(self.request_key(request, namespace))
+        if variants and len(variants) >= self.variants_per_bucket:
+            self.hits += 1
+            return random.choice(variants)
+        self.misses += 1
+        return None
+
+    def add(self, key: str, title: str, sections: list[dict]) -> bool:
+        """Store a new variant; returns False if the bucket is full or already has it."""
+        variants = self.buckets.setdefault(key, [])
+        variant = {"title": title, "sections": sections}
+        if len(variants) >= self.variants_per_bucket or variant in variants:
+            return False
+        variants.append(variant)
+        return True
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            stored = json.load(f)
+        for key, variants in stored.items():
+            for variant in variants:
+                self.add(key, variant["title"], variant["sections"])
+
+    def save(self, buckets: Optional[dict[str, list[dict]]] = None) -> None:
+        """
+        Merge with the file on disk (other workers may have added variants) and write atomically.
+        buckets is a copy to write instead of self.buckets, which add() may change meanwhile.
+        """
+        with self._lock:
+            merged = AdviceLibrary(self.path, self.variants_per_bucket, self.age_band, self.bodyfat_band)
+            merged.load()
+            for key, variants in (self.buckets if buckets is None else buckets).items():
+                for variant in variants:
+                    merged.add(key, variant["title"], variant["sections"])
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(merged.buckets, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    async def persist(self) -> None:
+        """Save from the event loop: buckets are copied on the loop, the file is written in a thread."""
+        # add() меняет buckets на event loop без блокировки - поток получает только копию
+        buckets = {key: list(variants) for key, variants in self.buckets.items()}
+        try:
+            await asyncio.to_thread(self.save, buckets)
+        except OSError as e:
+            # Вариант уже в памяти, а ответ клиенту готов - ошибка записи его не отменяет
+            logger.warning("Could not save the advice library: %s", e)
+
+    def snapshot(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "buckets": len(self.buckets),
+            "full_buckets": sum(1 for v in self.buckets.values() if len(v) >= self.variants_per_bucket),
+            "variants_per_bucket": self.variants_per_bucket,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+_library: Optional[AdviceLibrary] = None
+
+
+def get_advice_library() -> Optional[AdviceLibrary]:
+    """Shared advice library, loaded from disk on first use (None if disabled)."""
+    global _library
+    if _library is None and settings.advice_library_enabled:
+        _library = AdviceLibrary(
+            settings.advice_library_path,
+            variants_per_bucket=settings.advice_library_variants,
+            age_band=settings.advice_age_band,
+            bodyfat_band=settings.advice_bodyfat_band
+        )
+        try:
+            _library.load()
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load advice library: %s", e)
+    return _library
@@ -0,0 +1,193 @@
+"""
+Bulk scoring for /api/bodyfat/batch.
+
+Records arrive as a JSON array or as NDJSON (one object per line, decoded
+as the request body streams in). In local mode they are validated
+and scored chunk by chunk through the vectorized estimator; in llm mode they
+fan out to calculate_body_fat with bounded concurrency. Results come back in
+input order, in blocks of dicts, with an "error" entry for invalid records.
+"""
+import asyncio
+import json
+from collections import deque
+from typing import Any, AsyncIterator, Optional
+
+from fastapi import Request
+from pydantic import ValidationError
+
+from config import settings
+from models import BodyFatRequest
+from services.estimator import estimate_body_fat, estimate_many
+from services.hedging import estimate_source, winner_var
+from services.metrics import ERRORS, FALLBACKS
+from services.openai_client import calculate_body_fat
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines")
+
+
+class BatchFormatError(Exception):
+    pass
+
+
+class BatchTooLargeError(Exception):
+    pass
+
+
+class _InvalidLine:
+    """Placeholder for an NDJSON line that is not valid JSON."""
+
+    def __init__(self, error: str):
+        self.error = error
+
+
+def _decode_line(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return _InvalidLine(f"Invalid JSON: {str(e)}")
+
+
+async def _read_ndjson(request: Request, max_records: int, max_bytes: int) -> list:
+    # Тело нельзя дочитывать во время потокового ответа, поэтому разбираем
+    # строки по мере поступления, не накапливая сырой текст целиком
+    records = []
+    buffer = b""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise BatchTooLargeError(f"Batch body exceeds {max_bytes} bytes")
+        buffer += chunk
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                records.append(_decode_line(line))
+        if len(records) > max_records:
+            raise BatchTooLargeError(f"Batch exceeds {max_records} records")
+    if buffer.strip():
+        records.append(_decode_line(buffer))
+    if len(records) > max_records:
+        raise BatchTooLargeError(f"Batch exceeds {max_records} records")
+    return records
+
+
+async def read_records(request: Request, max_records: Optional[int] = None, max_bytes: Optional[int] = None) -> list:
+    """
+    Read the raw records of a JSON array or NDJSON body.
+    Raises BatchFormatError for a malformed body and BatchTooLargeError over the
+    record or byte limit; malformed NDJSON lines become per-record errors instead.
+    """
+    max_records = max_records or settings.batch_max_records
+    max_bytes = max_bytes or settings.batch_max_bytes
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise BatchTooLargeError(f"Batch body exceeds {max_bytes} bytes")
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in NDJSON_CONTENT_TYPES:
+        return await _read_ndjson(request, max_records, max_bytes)
+
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            raise BatchTooLargeError(f"Batch body exceeds {max_bytes} bytes")
+    try:
+        records = json.loads(body)
+    except ValueError as e:
+        raise BatchFormatError(f"Invalid JSON: {str(e)}")
+    if not isinstance(records, list):
+        raise BatchFormatError("Expected a JSON array of records or an NDJSON body")
+    if len(records) > max_records:
+        raise BatchTooLargeError(f"Batch exceeds {max_records} records")
+    return records
+
+
+def _validate(record: Any) -> tuple[Optional[BodyFatRequest], Optional[str]]:
+    if isinstance(record, _InvalidLine):
+        return None, record.error
+    if not isinstance(record, dict):
+        return None, "Record must be a JSON object"
+    try:
+        return BodyFatRequest(**record), None
+    except ValidationError as e:
+        return None, "; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors())
+
+
+def _score_chunk(start: int, records: list) -> list[dict]:
+    results: list[Optional[dict]] = [None] * len(records)
+    valid_requests = []
+    valid_positions = []
+    for position, record in enumerate(records):
+        request, error = _validate(record)
+        if error is not None:
+            results[position] = {"index": start + position, "error": error}
+        else:
+            valid_requests.append(request)
+            valid_positions.append(position)
+    for position, response in zip(valid_positions, estimate_many(valid_requests)):
+        results[position] = {"index": start + position, "source": "local", **response.model_dump()}
+    return results
+
+
+async def score_local(records: list, chunk_size: Optional[int] = None) -> AsyncIterator[list[dict]]:
+    """Score records with the local engine, one vectorized pass per chunk."""
+    chunk_size = chunk_size or settings.batch_chunk_size
+    for start in range(0, len(records), chunk_size):
+        yield _score_chunk(start, records[start:start + chunk_size])
+        # Отдаем управление event loop между чанками большого пакета
+        await asyncio.sleep(0)
+
+
+async def _score_one_llm(index: int, record: Any, semaphore: asyncio.Semaphore) -> dict:
+    request, error = _validate(record)
+    if error is not None:
+        return {"index": index, "error": error}
+    async with semaphore:
+        try:
+            # Ответ из кэша не выставляет победителя - не наследуем значение из контекста пакета
+            winner_var.set(None)
+            result = await calculate_body_fat(request)
+            source = estimate_source()
+        except Exception as e:
+            if not settings.local_fallback_enabled:
+                ERRORS.inc("batch", "llm_error")
+                return {"index": index, "error": f"Error calculating body fat: {str(e)}"}
+            FALLBACKS.inc("batch", "error")
+            result = estimate_body_fat(request)
+            source = "local-fallback"
+    return {"index": index, "source": source, **result.model_dump()}
+
+
+async def score_llm(records: list, concurrency: Optional[int] = None) -> AsyncIterator[list[dict]]:
+    """
+    Score records through calculate_body_fat (cache, coalescing, hedging and
+    local fallback included) with at most `concurrency` calls in flight.
+    Finished results are yielded in input order as soon as their predecessors are done.
+    """
+    concurrency = concurrency or settings.batch_llm_concurrency
+    semaphore = asyncio.Semaphore(concurrency)
+    pending: deque[asyncio.Task] = deque()
+    # Создаем задачи не дальше, чем на несколько окон вперед
+    max_pending = concurrency * 4
+
+    def ready() -> list[dict]:
+        block = []
+        while pending and pending[0].done():
+            block.append(pending.popleft().result())
+        return block
+
+    try:
+        for index, record in enumerate(records):
+            pending.append(asyncio.ensure_future(_score_one_llm(index, record, semaphore)))
+            if len(pending) >= max_pending:
+                await asyncio.wait([pending[0]])
+            block = ready()
+            if block:
+                yield block
+        while pending:
+            await asyncio.wait([pending[0]])
+            yield ready()
+    finally:
+        for task in pending:
+            task.cancel()
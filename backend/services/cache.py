@@ -0,0 +1,195 @@
+"""
+Result caches with LRU/TTL eviction.
+
+MemoryCache lives in the process; SQLiteCache stores entries in a local SQLite
+file (WAL mode) so that several uvicorn workers share one cache. Both expose
+the same get/set/stats interface and keep hit/miss/eviction counters.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def snapshot(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class MemoryCache:
+    """
+    In-process LRU cache with per-entry TTL.
+    Optionally bounded by total size: weigher(value) returns an entry's size
+    and least recently used entries are evicted while the sum exceeds max_bytes.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        weigher: Optional[Callable[[Any], int]] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.weigher = weigher
+        self.stats = CacheStats()
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._bytes = 0
+
+    def _weight(self, value: Any) -> int:
+        return self.weigher(value) if self.weigher else 0
+
+    def _remove(self, key: str) -> None:
+        _, value = self._entries.pop(key)
+        self._bytes -= self._weight(value)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at and expires_at < time.time():
+            self._remove(key)
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        expires_at = time.time() + self.ttl if self.ttl else 0.0
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, value)
+        self._bytes += self._weight(value)
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes and self._bytes > self.max_bytes and len(self._entries) > 1
+        ):
+            self._remove(next(iter(self._entries)))
+            self.stats.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def snapshot(self) -> dict:
+        stats = self.stats.snapshot()
+        stats.update({"backend": "memory", "entries": len(self._entries), "max_entries": self.max_entries})
+        if self.max_bytes:
+            stats.update({"bytes": self._bytes, "max_bytes": self.max_bytes})
+        return stats
+
+
+class SQLiteCache:
+    """
+    On-disk LRU cache shared across worker processes.
+    Values must be JSON-serializable. Lookups are sub-millisecond local
+    SQLite queries, so they run directly on the event loop.
+    """
+
+    def __init__(self, path: str, namespace: str, max_entries: int = 10000, ttl: Optional[float] = None):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed_at)")
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            value, expires_at = row
+            if expires_at and expires_at < now:
+                self._conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, self.namespace, key)
+            )
+        self.stats.hits += 1
+        return json.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else 0.0
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value, ensure_ascii=False), expires_at, now)
+            )
+            count = self._conn.execute(
+                "SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key IN ("
+                    "SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at LIMIT ?)",
+                    (self.namespace, self.namespace, overflow)
+                )
+                self.stats.evictions += overflow
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+
+    def snapshot(self) -> dict:
+        stats = self.stats.snapshot()
+        stats.update({"backend": "sqlite", "entries": len(self), "max_entries": self.max_entries})
+        return stats
+
+
+def create_cache(backend: str, namespace: str, max_entries: int, ttl: Optional[float], path: str = ""):
+    """Build a cache for the configured backend, or None if caching is disabled."""
+    if backend == "memory":
+        return MemoryCache(max_entries=max_entries, ttl=ttl)
+    if backend == "sqlite":
+        return SQLiteCache(path, namespace, max_entries=max_entries, ttl=ttl)
+    return None
@@ -0,0 +1,272 @@
+"""
+Circuit breakers and deadline-aware retries for LLM calls.
+
+Each model gets a breaker that watches the outcome and latency of its last
+calls. When too many fail (connection errors, timeouts, 429, 5xx) or are
+too slow, the circuit opens and calls are refused at once with
+CircuitOpenError, so callers answer from the local estimator or the mock
+advice instead of waiting on a failing upstream. After breaker_open_seconds
+a few trial calls are let through (half-open) to decide whether to close it.
+
+call_with_retries retries transient failures with full-jitter exponential
+backoff, but only while the remaining request deadline leaves room for it.
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import openai
+
+from config import settings
+from services.hedging import deadline_var
+from services.log import get_logger
+from services.metrics import MetricFamily, register_collector
+
+T = TypeVar("T")
+logger = get_logger("circuit_breaker")
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit for {name} is open, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window: int,
+        min_calls: int,
+        failure_rate: float,
+        slow_call_seconds: float,
+        slow_call_rate: float,
+        open_seconds: float,
+        half_open_calls: int,
+        enabled: bool = True
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.enabled = enabled
+        self.state = "closed"
+        self.times_opened = 0
+        self.short_circuited = 0
+        self.successes = 0
+        self.failures = 0
+        # (неудача, медленный вызов) для последних window вызовов
+        self._outcomes: deque[tuple[bool, bool]] = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._trial_in_flight = 0
+        self._trial_successes = 0
+        # Номер текущего полуоткрытого периода: пробный слот возвращается только в свой период
+        self._trial_period = 0
+
+    def _refresh(self) -> None:
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.open_seconds:
+            self.state = "half_open"
+            self._trial_in_flight = 0
+            self._trial_successes = 0
+            self._trial_period += 1
+
+    def _open(self) -> None:
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self.times_opened += 1
+        self._outcomes.clear()
+        logger.error("Circuit for %s opened", self.name)
+
+    def is_open(self) -> bool:
+        """True while calls are refused (does not consume a half-open trial)."""
+        if not self.enabled:
+            return False
+        self._refresh()
+        return self.state == "open"
+
+    def retry_after(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now."""
+        if not self.enabled:
+            return True
+        self._refresh()
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and self._trial_in_flight < self.half_open_calls:
+            self._trial_in_flight += 1
+            return True
+        self.short_circuited += 1
+        return False
+
+    def trial_period(self) -> Optional[int]:
+        """Half-open period of a call just let through by allow(), or None if it is not a trial call."""
+        return self._trial_period if self.enabled and self.state == "half_open" else None
+
+    def release_trial(self, period: int) -> None:
+        """Give back a trial slot whose call ended without an outcome (cancelled, or a non-transient error)."""
+        if self.state == "half_open" and period == self._trial_period:
+            self._trial_in_flight = max(0, self._trial_in_flight - 1)
+
+    def record(self, duration: float, failed: bool, trial: Optional[int] = None) -> None:
+        """Outcome of a call; trial is its trial_period() if it was let through as a half-open trial."""
+        slow = duration >= self.slow_call_seconds
+        if failed:
+            self.failures += 1
+        else:
+            self.successes += 1
+        if not self.enabled or self.state == "open":
+            return
+        if self.state == "half_open":
+            if trial != self._trial_period:
+                # Вызов начат до полуоткрытого периода - о пробных вызовах он ничего не говорит
+                return
+            self._trial_in_flight = max(0, self._trial_in_flight - 1)
+            if failed or slow:
+                self._open()
+                return
+            self._trial_successes += 1
+            if self._trial_successes >= self.half_open_calls:
+                self.state = "closed"
+                self._outcomes.clear()
+                logger.warning("Circuit for %s closed", self.name)
+            return
+
+        self._outcomes.append((failed, slow))
+        if len(self._outcomes) < self.min_calls:
+            return
+        total = len(self._outcomes)
+        failure_rate = sum(1 for failed_call, _ in self._outcomes if failed_call) / total
+        slow_rate = sum(1 for _, slow_call in self._outcomes if slow_call) / total
+        if failure_rate >= self.failure_rate or slow_rate >= self.slow_call_rate:
+            self._open()
+
+    def snapshot(self) -> dict:
+        self._refresh()
+        total = len(self._outcomes)
+        return {
+            "state": self.state,
+            "enabled": self.enabled,
+            "window_calls": total,
+            "window_failure_rate": round(sum(1 for f, _ in self._outcomes if f) / total, 4) if total else 0.0,
+            "window_slow_rate": round(sum(1 for _, s in self._outcomes if s) / total, 4) if total else 0.0,
+            "retry_after_seconds": round(self.retry_after(), 1),
+            "times_opened": self.times_opened,
+            "short_circuited": self.short_circuited,
+            "successes": self.successes,
+            "failures": self.failures,
+        }
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Shared breaker for an upstream model."""
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(
+            name,
+            window=settings.breaker_window,
+            min_calls=settings.breaker_min_calls,
+            failure_rate=settings.breaker_failure_rate,
+            slow_call_seconds=settings.breaker_slow_call_seconds,
+            slow_call_rate=settings.breaker_slow_call_rate,
+            open_seconds=settings.breaker_open_seconds,
+            half_open_calls=settings.breaker_half_open_calls,
+            enabled=settings.breaker_enabled
+        )
+    return _breakers[name]
+
+
+def get_breaker_stats() -> dict:
+    return {name: breaker.snapshot() for name, breaker in _breakers.items()}
+
+
+_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def _collect_metrics() -> list[MetricFamily]:
+    stats = get_breaker_stats()
+    return [
+        MetricFamily("bodyfat_breaker_state", "gauge", "Circuit state per model: 0 closed, 1 half-open, 2 open.",
+                     ("model",), {(name,): _STATE_VALUES[s["state"]] for name, s in stats.items()}),
+        MetricFamily("bodyfat_breaker_opened_total", "counter", "Times the circuit opened.",
+                     ("model",), {(name,): s["times_opened"] for name, s in stats.items()}),
+        MetricFamily("bodyfat_breaker_short_circuited_total", "counter", "Calls refused while the circuit was open.",
+                     ("model",), {(name,): s["short_circuited"] for name, s in stats.items()}),
+    ]
+
+
+register_collector(_collect_metrics)
+
+
+def _is_transient(error: Exception) -> bool:
+    # Ошибки самого запроса (400, 401, ...) не говорят о здоровье апстрима и не повторяются
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _server_retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+async def call_with_retries(name: str, factory: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run factory() through the breaker for `name`, retrying transient errors
+    with jittered backoff while the deadline (from hedged_call, or
+    llm_deadline_seconds from now) allows. Raises CircuitOpenError when refused.
+    """
+    breaker = get_breaker(name)
+    loop = asyncio.get_running_loop()
+    deadline = deadline_var.get() or loop.time() + settings.llm_deadline_seconds
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(name, breaker.retry_after())
+        trial = breaker.trial_period()
+        recorded = False
+        started = time.perf_counter()
+        try:
+            try:
+                result = await factory()
+            except Exception as e:
+                transient = _is_transient(e)
+                if transient:
+                    breaker.record(time.perf_counter() - started, failed=True, trial=trial)
+                    recorded = True
+                if not transient or attempt >= settings.llm_max_retries:
+                    raise
+                # Full jitter: случайная пауза от 0 до экспоненциального потолка
+                delay = random.uniform(0, min(settings.llm_retry_max_backoff_seconds,
+                                              settings.llm_retry_base_seconds * 2 ** attempt))
+                delay = max(delay, _server_retry_after(e) or 0.0)
+                if loop.time() + delay + settings.llm_retry_min_remaining_seconds > deadline:
+                    raise
+                attempt += 1
+                logger.warning("%s: transient error, retry %d in %.2fs: %s", name, attempt, delay, e)
+                await asyncio.sleep(delay)
+                continue
+            breaker.record(time.perf_counter() - started, failed=False, trial=trial)
+            recorded = True
+            return result
+        finally:
+            # Отмена (проигравший хедж, отключение клиента, срок) и ошибки запроса (400) не дают исхода -
+            # пробный слот возвращаем, иначе полуоткрытая цепь перестанет пропускать вызовы навсегда
+            if not recorded and trial is not None:
+                breaker.release_trial(trial)
@@ -0,0 +1,133 @@
+"""
+Hedged LLM calls with a per-request latency budget.
+
+hedged_call starts the primary attempt, issues a hedge attempt if no answer
+arrived after hedge_delay (or right away if the primary failed), and returns
+the first successful result. When the deadline expires, or every attempt has
+failed, the local fallback answers instead. Latency and winner statistics
+are kept per call name.
+"""
+import asyncio
+import contextvars
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from services.log import get_logger
+from services.metrics import FALLBACKS
+
+T = TypeVar("T")
+logger = get_logger("hedging")
+
+# Какая попытка дала ответ в текущем запросе: primary, hedge или fallback
+winner_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("hedge_winner", default=None)
+# Абсолютный срок (loop.time()) текущего хеджированного вызова - по нему ограничиваются повторы
+deadline_var: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("llm_deadline", default=None)
+
+
+def estimate_source() -> str:
+    """
+    Source of the estimate just produced in this context (X-Estimate-Source):
+    "local-fallback" if the local estimator answered, otherwise "llm"
+    (an LLM call, its hedge, or a cached LLM answer).
+    """
+    return "local-fallback" if winner_var.get() == "fallback" else "llm"
+
+
+class LatencyTracker:
+    """Sliding window of recent latencies with percentile reporting."""
+
+    def __init__(self, window: int = 2048):
+        self.samples: deque[float] = deque(maxlen=window)
+        self.winners: dict[str, int] = {}
+
+    def record(self, seconds: float, winner: str) -> None:
+        self.samples.append(seconds)
+        self.winners[winner] = self.winners.get(winner, 0) + 1
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def snapshot(self) -> dict:
+        return {
+            "count": len(self.samples),
+            "p50_ms": round(self.percentile(50) * 1000, 1),
+            "p95_ms": round(self.percentile(95) * 1000, 1),
+            "p99_ms": round(self.percentile(99) * 1000, 1),
+            "max_ms": round(max(self.samples) * 1000, 1) if self.samples else 0.0,
+            "winners": dict(self.winners),
+        }
+
+
+_trackers: dict[str, LatencyTracker] = {}
+
+
+def get_tracker(name: str) -> LatencyTracker:
+    if name not in _trackers:
+        _trackers[name] = LatencyTracker()
+    return _trackers[name]
+
+
+def get_latency_stats() -> dict:
+    return {name: tracker.snapshot() for name, tracker in _trackers.items()}
+
+
+async def hedged_call(
+    name: str,
+    primary: Callable[[], Awaitable[T]],
+    hedge: Optional[Callable[[], Awaitable[T]]] = None,
+    fallback: Optional[Callable[[], T]] = None,
+    hedge_delay: float = 8.0,
+    deadline: float = 20.0
+) -> T:
+    """
+    Race primary and (delayed) hedge attempts within the deadline.
+    Raises the last attempt error (or TimeoutError) only if there is no fallback.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    # Попытки наследуют контекст и видят общий срок
+    deadline_token = deadline_var.set(started + deadline)
+    tasks: dict[asyncio.Task, str] = {asyncio.ensure_future(primary()): "primary"}
+    hedge_started = hedge is None
+    last_error: Optional[BaseException] = None
+
+    try:
+        while True:
+            elapsed = loop.time() - started
+            remaining = deadline - elapsed
+            if remaining <= 0:
+                break
+
+            # Основная попытка уже упала - запускаем хедж сразу, не дожидаясь задержки
+            if not hedge_started and (not tasks or elapsed >= hedge_delay):
+                tasks[asyncio.ensure_future(hedge())] = "hedge"
+                hedge_started = True
+            if not tasks:
+                break
+
+            timeout = remaining if hedge_started else min(remaining, hedge_delay - elapsed)
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                label = tasks.pop(task)
+                if task.exception() is None:
+                    get_tracker(name).record(loop.time() - started, label)
+                    winner_var.set(label)
+                    return task.result()
+                last_error = task.exception()
+                logger.warning("%s: %s attempt failed: %s", name, label, last_error)
+    finally:
+        for task in tasks:
+            task.cancel()
+        deadline_var.reset(deadline_token)
+
+    if fallback is not None:
+        get_tracker(name).record(loop.time() - started, "fallback")
+        # Незавершенные попытки остаются только при истечении срока
+        FALLBACKS.inc(name, "deadline" if tasks else "error")
+        winner_var.set("fallback")
+        return fallback()
+    raise last_error or asyncio.TimeoutError(f"{name}: no answer within {deadline}s")
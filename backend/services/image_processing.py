@@ -0,0 +1,316 @@
+"""
+Image preprocessing for the vision model.
+
+Phone photos are decoded at reduced scale (JPEG draft mode), rotated according
+to EXIF orientation, downsampled to a bounded edge and re-encoded with an
+adaptively chosen format and quality before base64 encoding. The decoded
+image also gets the local quality checks of services.photo_quality.
+Prepared photos of one request can be composed into a single labelled
+mosaic (see services.vision_layout for the layout).
+"""
+import base64
+import hashlib
+import math
+import time
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import BinaryIO, Optional
+
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+from config import settings
+from services.photo_quality import ANALYSIS_EDGE, PhotoQuality, assess
+
+
+# Фон и промежуток между ячейками мозаики, px
+MOSAIC_BACKGROUND = (128, 128, 128)
+MOSAIC_GUTTER = 8
+
+
+@dataclass
+class PreparedImage:
+    base64_data: str
+    mime_type: str
+    width: int
+    height: int
+    original_bytes: int
+    encoded_bytes: int
+    original_tokens: int
+    estimated_tokens: int
+    # Время этапов обработки в миллисекундах (decode, resize, encode, base64)
+    timings: dict = field(default_factory=dict)
+    # Хэш итогового (предобработанного) изображения
+    content_hash: str = ""
+    # Результат локальной проверки качества (None, если проверка выключена или фото не декодировалось)
+    quality: Optional[PhotoQuality] = None
+
+    @property
+    def bytes_saved(self) -> int:
+        return max(0, self.original_bytes - self.encoded_bytes)
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.original_tokens - self.estimated_tokens)
+
+
+# Тайлы vision модели: 512px, 170 токенов за тайл плюс 85 базовых (low detail - только базовые)
+TILE_SIZE = 512
+TILE_TOKENS = 170
+BASE_TOKENS = 85
+
+
+def estimate_vision_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Estimate gpt-4o input tokens for an image. High detail (and auto, which
+    picks high for photos): fit into 2048x2048, scale the shortest side down
+    to 768, then 170 tokens per 512px tile plus 85 base tokens. Low detail: 85.
+    """
+    if width <= 0 or height <= 0:
+        return 0
+    if detail == "low":
+        return BASE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+    return BASE_TOKENS + TILE_TOKENS * tiles
+
+
+def _target_size(width: int, height: int, max_edge: int) -> tuple[int, int]:
+    if max(width, height) <= max_edge:
+        return width, height
+    ratio = max_edge / max(width, height)
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+def _flatten_alpha(img: Image.Image) -> Image.Image:
+    """Composite transparent images onto a white background."""
+    if img.mode == 'P':
+        img = img.convert('RGBA')
+    if img.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    if img.mode not in ('RGB', 'L'):
+        return img.convert('RGB')
+    return img
+
+
+# Сегменты JPEG с метаданными: APP1 (EXIF, XMP), APP13 (IPTC), комментарии
+_METADATA_SEGMENTS = ("APP1", "APP13", "COM")
+
+
+def _has_metadata(img: Image.Image) -> bool:
+    return any(marker in _METADATA_SEGMENTS for marker, _ in getattr(img, "applist", []))
+
+
+def _choose_quality(width: int, height: int) -> int:
+    # Крупные изображения сжимаем сильнее - визуальная разница для модели незаметна
+    if width * height > 1_000_000:
+        return max(50, settings.image_jpeg_quality - 5)
+    return settings.image_jpeg_quality
+
+
+def content_hash(data: bytes | BinaryIO, chunk_size: int = 1024 * 1024) -> str:
+    """Content hash of raw bytes or a seekable file (read in chunks)."""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(data, (bytes, bytearray)):
+        digest.update(data)
+    else:
+        data.seek(0)
+        while chunk := data.read(chunk_size):
+            digest.update(chunk)
+        data.seek(0)
+    return digest.hexdigest()
+
+
+def _read_all(stream: BinaryIO) -> bytes:
+    stream.seek(0)
+    return stream.read()
+
+
+def preprocess_image(image_data: bytes | BinaryIO, content_type: str, max_edge: int | None = None) -> PreparedImage:
+    """
+    Prepare an uploaded image for the vision API.
+    Accepts raw bytes or a seekable file (e.g. a spooled upload), which PIL
+    decodes incrementally without loading the whole upload into memory.
+    Falls back to the raw bytes if the image cannot be decoded.
+    """
+    max_edge = max_edge or settings.image_max_edge
+    mime_type = content_type if content_type and content_type.startswith('image/') else "image/jpeg"
+    timings = {}
+
+    if isinstance(image_data, (bytes, bytearray)):
+        stream = BytesIO(image_data)
+        original_bytes = len(image_data)
+    else:
+        stream = image_data
+        stream.seek(0, 2)
+        original_bytes = stream.tell()
+        stream.seek(0)
+
+    try:
+        started = time.perf_counter()
+        img = Image.open(stream)
+        original_width, original_height = img.size
+        original_format = img.format
+        target = _target_size(original_width, original_height, max_edge)
+
+        # Для JPEG декодируем сразу в уменьшенном масштабе (1/2, 1/4, 1/8)
+        if original_format == 'JPEG' and target != img.size:
+            img.draft('RGB', target)
+
+        orientation = img.getexif().get(0x0112, 1)
+        needs_resize = target != (original_width, original_height)
+
+        # Исходный JPEG подходящего размера без поворота отправляем как есть, если в нем нет
+        # метаданных (EXIF с GPS и моделью устройства, XMP, IPTC, комментарии) и он не пережат слабо
+        if (original_format == 'JPEG' and not needs_resize and orientation == 1
+                and not _has_metadata(img)
+                and original_bytes <= settings.image_passthrough_max_bytes_per_pixel * original_width * original_height):
+            timings["decode"] = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            raw = _read_all(stream)
+            quality = None
+            if settings.photo_quality_gate != "off":
+                # Пиксели здесь не декодировались - для проверки хватает уменьшенного декодирования
+                with Image.open(BytesIO(raw)) as check:
+                    check.draft('L', (ANALYSIS_EDGE, ANALYSIS_EDGE))
+                    quality = assess(check, (original_width, original_height))
+                timings["quality"] = (time.perf_counter() - started) * 1000
+                started = time.perf_counter()
+            base64_data = base64.b64encode(raw).decode('utf-8')
+            timings["base64"] = (time.perf_counter() - started) * 1000
+            return PreparedImage(
+                base64_data=base64_data,
+                mime_type="image/jpeg",
+                width=original_width,
+                height=original_height,
+                original_bytes=original_bytes,
+                encoded_bytes=original_bytes,
+                original_tokens=estimate_vision_tokens(original_width, original_height),
+                estimated_tokens=estimate_vision_tokens(original_width, original_height),
+                timings=timings,
+                content_hash=content_hash(raw),
+                quality=quality
+            )
+
+        img.load()
+        timings["decode"] = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        img = ImageOps.exif_transpose(img)
+        # reducing_gap включает быстрое целочисленное уменьшение (Image.reduce) перед ресемплингом
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        timings["resize"] = (time.perf_counter() - started) * 1000
+
+        quality = None
+        if settings.photo_quality_gate != "off":
+            started = time.perf_counter()
+            quality = assess(img, (original_width, original_height))
+            timings["quality"] = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        buffer = BytesIO()
+        # Графика с малым числом цветов (скриншоты) лучше сжимается в PNG
+        if img.mode in ('P', 'RGB', 'RGBA') and img.getcolors(256) is not None:
+            img.save(buffer, format='PNG')
+            mime_type = "image/png"
+        else:
+            img = _flatten_alpha(img)
+            img.save(buffer, format='JPEG', quality=_choose_quality(*img.size))
+            mime_type = "image/jpeg"
+        # Декодированное изображение больше не нужно - освобождаем память до base64
+        img_width, img_height = img.size
+        img.close()
+        del img
+        encoded = buffer.getvalue()
+        buffer.close()
+        timings["encode"] = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        base64_data = base64.b64encode(encoded).decode('utf-8')
+        timings["base64"] = (time.perf_counter() - started) * 1000
+
+        return PreparedImage(
+            base64_data=base64_data,
+            mime_type=mime_type,
+            width=img_width,
+            height=img_height,
+            original_bytes=original_bytes,
+            encoded_bytes=len(encoded),
+            original_tokens=estimate_vision_tokens(original_width, original_height),
+            estimated_tokens=estimate_vision_tokens(img_width, img_height),
+            timings=timings,
+            content_hash=content_hash(encoded),
+            quality=quality
+        )
+    except Exception:
+        # Если не удалось обработать, просто кодируем как есть
+        raw = _read_all(stream)
+        return PreparedImage(
+            base64_data=base64.b64encode(raw).decode('utf-8'),
+            mime_type=mime_type,
+            width=0,
+            height=0,
+            original_bytes=original_bytes,
+            encoded_bytes=original_bytes,
+            original_tokens=0,
+            estimated_tokens=0,
+            timings=timings,
+            content_hash=content_hash(raw)
+        )
+
+
+def compose_mosaic(prepared_images: list[PreparedImage], cols: int, rows: int, width: int, height: int) -> PreparedImage:
+    """
+    Compose prepared images into one width x height JPEG: a cols x rows grid,
+    each image fitted into its cell in upload order and labelled with its
+    number (1, 2, ...) in the top-left corner.
+    """
+    timings = {}
+    started = time.perf_counter()
+    canvas = Image.new('RGB', (width, height), MOSAIC_BACKGROUND)
+    draw = ImageDraw.Draw(canvas)
+    cell_width, cell_height = width // cols, height // rows
+    box = (max(1, cell_width - MOSAIC_GUTTER), max(1, cell_height - MOSAIC_GUTTER))
+    # Без FreeType load_default возвращает растровый шрифт и размер игнорирует
+    font = ImageFont.load_default(size=max(14, min(cell_width, cell_height) // 12))
+    for index, image in enumerate(prepared_images):
+        left, top = (index % cols) * cell_width, (index // cols) * cell_height
+        with Image.open(BytesIO(base64.b64decode(image.base64_data))) as photo:
+            photo.draft('RGB', box)
+            photo = _flatten_alpha(photo)
+            # Ячейка лишь в 1-2 раза меньше подготовленного фото: билинейный фильтр вдвое быстрее LANCZOS без видимой разницы
+            photo = ImageOps.contain(photo, box, Image.Resampling.BILINEAR)
+        x, y = left + (cell_width - photo.width) // 2, top + (cell_height - photo.height) // 2
+        canvas.paste(photo.convert('RGB'), (x, y))
+        label = str(index + 1)
+        text_box = draw.textbbox((x + 6, y + 4), label, font=font)
+        draw.rectangle((text_box[0] - 5, text_box[1] - 4, text_box[2] + 5, text_box[3] + 4), fill=(0, 0, 0))
+        draw.text((x + 6, y + 4), label, fill=(255, 255, 255), font=font)
+    timings["mosaic"] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    buffer = BytesIO()
+    canvas.save(buffer, format='JPEG', quality=_choose_quality(width, height))
+    canvas.close()
+    encoded = buffer.getvalue()
+    timings["encode"] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    base64_data = base64.b64encode(encoded).decode('utf-8')
+    timings["base64"] = (time.perf_counter() - started) * 1000
+    return PreparedImage(
+        base64_data=base64_data,
+        mime_type="image/jpeg",
+        width=width,
+        height=height,
+        original_bytes=sum(image.encoded_bytes for image in prepared_images),
+        encoded_bytes=len(encoded),
+        original_tokens=sum(image.estimated_tokens for image in prepared_images),
+        estimated_tokens=estimate_vision_tokens(width, height),
+        timings=timings,
+        content_hash=content_hash(encoded)
+    )
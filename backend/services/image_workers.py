@@ -0,0 +1,182 @@
+"""
+Executor-backed image worker pool.
+
+PIL decoding, compositing and re-encoding run in a thread or process pool so
+the event loop keeps serving other requests. All images of one request are
+processed in parallel; a queue-depth limit rejects work when the pool is
+saturated instead of letting latency grow without bound.
+"""
+import asyncio
+import dataclasses
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Optional
+
+from config import settings
+from services.cache import MemoryCache
+from services.image_processing import PreparedImage, compose_mosaic, content_hash, preprocess_image
+from services.metrics import IMAGE_BASE64_BYTES, IMAGE_STAGE, MetricFamily, register_collector
+from services.tracing import record_stages, span
+
+
+class ImageQueueFullError(Exception):
+    """Raised when the image pool already has image_queue_limit images in flight."""
+
+
+_executor: Optional[Executor] = None
+_in_flight = 0
+_payload_cache: Optional[MemoryCache] = None
+
+
+def get_payload_cache() -> Optional[MemoryCache]:
+    """
+    Cache of preprocessed images keyed by the hash of the original upload,
+    bounded by the total size of the cached base64 payloads.
+    """
+    global _payload_cache
+    if _payload_cache is None and settings.image_cache_enabled:
+        _payload_cache = MemoryCache(
+            max_entries=settings.image_payload_cache_max_entries,
+            max_bytes=settings.image_payload_cache_max_bytes,
+            weigher=lambda image: len(image.base64_data)
+        )
+    return _payload_cache
+
+
+def _run_preprocess(image_data: bytes | BinaryIO, content_type: str, submitted_at: float) -> PreparedImage:
+    # Выполняется в воркере; time.time() сравним между процессами, в отличие от perf_counter
+    queue_wait = (time.time() - submitted_at) * 1000
+    prepared = preprocess_image(image_data, content_type)
+    prepared.timings["queue_wait"] = queue_wait
+    return prepared
+
+
+def _build_executor() -> Executor:
+    if settings.image_worker_mode == "process":
+        return ProcessPoolExecutor(max_workers=settings.image_workers)
+    # PIL отпускает GIL при декодировании, ресайзе и кодировании, поэтому потоков достаточно
+    return ThreadPoolExecutor(max_workers=settings.image_workers, thread_name_prefix="image-worker")
+
+
+def startup() -> None:
+    """Create the worker pool. Called from the FastAPI lifespan hook."""
+    global _executor
+    if _executor is None:
+        _executor = _build_executor()
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def get_executor() -> Executor:
+    if _executor is None:
+        startup()
+    return _executor
+
+
+def get_pool_stats() -> dict:
+    return {
+        "mode": settings.image_worker_mode,
+        "workers": settings.image_workers,
+        "in_flight": _in_flight,
+        "queue_limit": settings.image_queue_limit,
+    }
+
+
+def _collect_metrics() -> list[MetricFamily]:
+    return [
+        MetricFamily("bodyfat_image_in_flight", "gauge", "Images queued or being processed by the worker pool.",
+                     samples={(): _in_flight}),
+    ]
+
+
+register_collector(_collect_metrics)
+
+
+async def prepare_images(image_data_list: list[bytes | BinaryIO], content_type_list: list[str]) -> list[PreparedImage]:
+    """
+    Preprocess all images of a request in parallel on the worker pool.
+    Raises ImageQueueFullError if accepting them would exceed the queue limit.
+    """
+    global _in_flight
+    count = len(image_data_list)
+    if _in_flight + count > settings.image_queue_limit:
+        raise ImageQueueFullError(
+            f"Image processing queue is full ({_in_flight} in flight, limit {settings.image_queue_limit})"
+        )
+
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    cache = get_payload_cache()
+    settings_key = "|".join(str(value) for value in (
+        settings.image_max_edge,
+        settings.image_jpeg_quality,
+        settings.image_passthrough_max_bytes_per_pixel,
+        settings.photo_quality_gate != "off",
+    ))
+    _in_flight += count
+    try:
+        async def prepare_one(index: int, image_data: bytes | BinaryIO, content_type: str) -> PreparedImage:
+            with span("image.prepare", index=index):
+                return await _prepare(index, image_data, content_type)
+
+        async def _prepare(index: int, image_data: bytes | BinaryIO, content_type: str) -> PreparedImage:
+            cache_key = None
+            if cache is not None:
+                # Повторно присланное фото не обрабатываем заново
+                raw_hash = await asyncio.to_thread(content_hash, image_data)
+                cache_key = f"{raw_hash}|{settings_key}"
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    IMAGE_BASE64_BYTES.observe(len(cached.base64_data))
+                    return dataclasses.replace(cached, timings={})
+            # Файловые объекты нельзя передать в другой процесс - читаем их в байты
+            if settings.image_worker_mode == "process" and not isinstance(image_data, (bytes, bytearray)):
+                image_data.seek(0)
+                image_data = image_data.read()
+            submitted_ns = time.time_ns()
+            prepared = await loop.run_in_executor(executor, _run_preprocess, image_data, content_type, submitted_ns / 1e9)
+            # Этапы внутри воркера восстанавливаем по их длительностям: ожидание очереди, затем обработка
+            stages = {"queue_wait": prepared.timings.get("queue_wait", 0.0)}
+            stages.update((stage, value) for stage, value in prepared.timings.items() if stage != "queue_wait")
+            record_stages("image.worker", submitted_ns, stages, lane_key=f"image-{index}")
+            # Этапы замерены в воркере, в метрики пишем уже из event loop
+            for stage, value in prepared.timings.items():
+                IMAGE_STAGE.observe(value / 1000, stage)
+            IMAGE_BASE64_BYTES.observe(len(prepared.base64_data))
+            if cache_key is not None:
+                cache.set(cache_key, prepared)
+            return prepared
+
+        calls = []
+        for i, image_data in enumerate(image_data_list):
+            content_type = content_type_list[i] if i < len(content_type_list) else "image/jpeg"
+            calls.append(prepare_one(i, image_data, content_type))
+        return list(await asyncio.gather(*calls))
+    finally:
+        _in_flight -= count
+
+
+async def build_mosaic(prepared_images: list[PreparedImage], cols: int, rows: int, width: int, height: int) -> PreparedImage:
+    """Compose the prepared images of a request into one mosaic on the worker pool."""
+    with span("image.mosaic", images=len(prepared_images)):
+        mosaic = await asyncio.get_running_loop().run_in_executor(
+            get_executor(), compose_mosaic, prepared_images, cols, rows, width, height
+        )
+    for stage, value in mosaic.timings.items():
+        IMAGE_STAGE.observe(value / 1000, stage)
+    IMAGE_BASE64_BYTES.observe(len(mosaic.base64_data))
+    return mosaic
+
+
+def summarize_timings(prepared_images: list[PreparedImage]) -> dict:
+    """Sum per-stage timings (ms) over the images of one request."""
+    totals = {}
+    for image in prepared_images:
+        for stage, value in image.timings.items():
+            totals[stage] = round(totals.get(stage, 0.0) + value, 2)
+    return totals
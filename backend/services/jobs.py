@@ -0,0 +1,288 @@
+"""
+Background jobs for photo analyses.
+
+POST /api/bodyfat/jobs stores a job and returns its ID at once; a bounded
+pool of worker tasks runs the analyses from an in-process queue, and clients
+poll or long-poll GET /api/bodyfat/jobs/{id} for the result, so a dropped
+connection no longer loses a paid analysis. Jobs are stored in memory or in
+SQLite; with SQLite any uvicorn worker can answer a poll, although each job
+runs in the process that accepted it. Finished jobs expire after job_ttl_seconds.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+from config import settings
+from models import BodyFatRequest
+from services.estimator import estimate_body_fat
+from services.hedging import LatencyTracker, estimate_source, winner_var
+from services.log import get_logger, request_id_var
+from services.metrics import ERRORS, FALLBACKS, MetricFamily, register_collector
+from services.openai_client import calculate_body_fat, calculate_body_fat_with_image
+from services.photo_quality import PhotoQualityError, dropped_photos_var
+from services.uploads import ParsedForm
+
+FINISHED_STATUSES = ("done", "failed")
+
+logger = get_logger("jobs")
+
+
+class JobQueueFullError(Exception):
+    """Raised when job_queue_limit jobs are already waiting."""
+
+
+class MemoryJobStore:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._jobs: dict[str, dict] = {}
+
+    def save(self, job: dict) -> None:
+        self._jobs[job["id"]] = dict(job)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def prune(self) -> None:
+        expired_before = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job["finished_at"] and job["finished_at"] < expired_before]:
+            del self._jobs[job_id]
+
+
+class SQLiteJobStore:
+    """Job records in a local SQLite file (WAL mode), readable by every worker process."""
+
+    def __init__(self, path: str, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL, finished_at REAL)"
+        )
+
+    def save(self, job: dict) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, data, finished_at) VALUES (?, ?, ?)",
+                (job["id"], json.dumps(job, ensure_ascii=False), job["finished_at"])
+            )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def prune(self) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                (time.time() - self.ttl,)
+            )
+
+
+def create_job_store(backend: str, path: str, ttl: float):
+    if backend == "sqlite":
+        return SQLiteJobStore(path, ttl)
+    return MemoryJobStore(ttl)
+
+
+class JobQueue:
+    def __init__(self, store, workers: int, queue_limit: int, deadline: float):
+        self.store = store
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.deadline = deadline
+        self.wait_times = LatencyTracker()
+        self.run_times = LatencyTracker()
+        self.submitted = 0
+        self.rejected = 0
+        self.running = 0
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_limit)
+        self._events: dict[str, asyncio.Event] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Освобождаем загрузки задач, которые так и не начались
+        while not self._queue.empty():
+            _, _, form = self._queue.get_nowait()
+            form.close()
+
+    def submit(self, request: BodyFatRequest, form: ParsedForm) -> dict:
+        """
+        Queue an analysis; the job takes ownership of the form and closes it when done.
+        Raises JobQueueFullError if the queue is full.
+        """
+        if self._queue.full():
+            self.rejected += 1
+            raise JobQueueFullError(f"Job queue is full ({self.queue_limit} jobs waiting)")
+        self.store.prune()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "source": None,
+            "dropped_photos": [],
+            "result": None,
+            "error": None,
+        }
+        self.store.save(job)
+        self._events[job["id"]] = asyncio.Event()
+        self._queue.put_nowait((job, request, form))
+        self.submitted += 1
+        return job
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        """Return the job, waiting up to timeout seconds for it to finish."""
+        job = self.store.get(job_id)
+        if job is None or job["status"] in FINISHED_STATUSES or timeout <= 0:
+            return job
+        event = self._events.get(job_id)
+        if event is not None:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return self.store.get(job_id)
+        # Задача выполняется в другом процессе - опрашиваем общее хранилище
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(settings.job_poll_interval_seconds, deadline - time.monotonic()))
+            job = self.store.get(job_id)
+            if job is None or job["status"] in FINISHED_STATUSES:
+                break
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            job, request, form = await self._queue.get()
+            try:
+                await self._run(job, request, form)
+            finally:
+                form.close()
+                self._queue.task_done()
+
+    async def _run(self, job: dict, request: BodyFatRequest, form: ParsedForm) -> None:
+        job["status"] = "running"
+        job["started_at"] = time.time()
+        self.wait_times.record(job["started_at"] - job["created_at"], "queued")
+        self.store.save(job)
+        self.running += 1
+        # Воркер обрабатывает задачи подряд в одном контексте - сбрасываем результат прошлой
+        winner_var.set(None)
+        dropped_photos_var.set(None)
+        # Записи лога задачи помечаются ее ID вместо ID запроса, который ее создал
+        request_id_var.set(f"job:{job['id']}")
+        try:
+            images = form.get_files("images")
+            if images:
+                result = await calculate_body_fat_with_image(
+                    request,
+                    [image.file for image in images],
+                    [image.content_type or "image/jpeg" for image in images],
+                    deadline=self.deadline
+                )
+            else:
+                result = await calculate_body_fat(request)
+            job["status"] = "done"
+            job["source"] = estimate_source()
+            job["dropped_photos"] = dropped_photos_var.get() or []
+            job["result"] = result.model_dump()
+        except PhotoQualityError as e:
+            # Фото нужно переснять - локальная оценка здесь не замена
+            ERRORS.inc("job", "photo_quality")
+            job["status"] = "failed"
+            job["error"] = str(e)
+        except Exception as e:
+            if settings.local_fallback_enabled:
+                logger.warning("Job %s: LLM unavailable, answering from local estimator: %s", job["id"], e)
+                job["status"] = "done"
+                job["source"] = "local-fallback"
+                job["result"] = estimate_body_fat(request).model_dump()
+                FALLBACKS.inc("job", "error")
+            else:
+                logger.exception("Job %s failed", job["id"])
+                ERRORS.inc("job", "llm_error")
+                job["status"] = "failed"
+                job["error"] = f"Error calculating body fat: {str(e)}"
+        finally:
+            self.running -= 1
+            job["finished_at"] = time.time()
+            self.run_times.record(job["finished_at"] - job["started_at"], job["status"])
+            self.store.save(job)
+            event = self._events.pop(job["id"], None)
+            if event is not None:
+                event.set()
+
+    def snapshot(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_limit": self.queue_limit,
+            "running": self.running,
+            "workers": self.workers,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "wait": self.wait_times.snapshot(),
+            "run": self.run_times.snapshot(),
+        }
+
+
+_job_queue: Optional[JobQueue] = None
+
+
+async def startup() -> None:
+    """Create the store and start the worker tasks. Called from the FastAPI lifespan hook."""
+    global _job_queue
+    if _job_queue is None:
+        store = create_job_store(settings.job_store_backend, settings.job_store_path, settings.job_ttl_seconds)
+        _job_queue = JobQueue(
+            store,
+            workers=settings.job_workers,
+            queue_limit=settings.job_queue_limit,
+            deadline=settings.job_deadline_seconds
+        )
+        _job_queue.start()
+
+
+async def shutdown() -> None:
+    global _job_queue
+    if _job_queue is not None:
+        await _job_queue.stop()
+        _job_queue = None
+
+
+async def get_job_queue() -> JobQueue:
+    if _job_queue is None:
+        await startup()
+    return _job_queue
+
+
+def _collect_metrics() -> list[MetricFamily]:
+    if _job_queue is None:
+        return []
+    return [
+        MetricFamily("bodyfat_jobs_queue_depth", "gauge", "Background jobs waiting for a worker.",
+                     samples={(): _job_queue._queue.qsize()}),
+        MetricFamily("bodyfat_jobs_running", "gauge", "Background jobs being processed.",
+                     samples={(): _job_queue.running}),
+        MetricFamily("bodyfat_jobs_rejected_total", "counter", "Jobs rejected because the queue was full.",
+                     samples={(): _job_queue.rejected}),
+    ]
+
+
+register_collector(_collect_metrics)
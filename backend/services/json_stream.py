@@ -0,0 +1,123 @@
+"""
+Incremental parser for a streamed JSON object.
+
+The model streams its JSON answer token by token. IncrementalJSONParser
+is fed those text chunks and reports every top-level field as soon as its
+value is complete; for the keys listed in stream_arrays (e.g. "sections")
+each array element is reported on its own, without waiting for the array
+to close. Only the raw text is buffered; each finished value is decoded once
+with json.loads.
+"""
+import json
+from typing import Any, Iterable
+
+# Виды событий: готовое поле верхнего уровня или элемент потокового массива
+FIELD = "field"
+ITEM = "item"
+
+
+class IncrementalJSONParser:
+    def __init__(self, stream_arrays: Iterable[str] = ()):
+        self.stream_arrays = set(stream_arrays)
+        self.done = False
+        self._text = ""
+        self._pos = 0
+        self._stack: list[str] = []
+        self._in_string = False
+        self._escape = False
+        # Состояние на верхнем уровне: key -> in_key -> colon -> value -> in_value -> after
+        self._phase = "start"
+        self._key = None
+        self._key_start = 0
+        self._value_start = 0
+        self._streaming = False
+        self._item_start = None
+
+    def feed(self, chunk: str) -> list[tuple[str, str, Any]]:
+        """Consume a chunk and return the (kind, key, value) events it completed."""
+        events: list[tuple[str, str, Any]] = []
+        self._text += chunk
+        text = self._text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._string_closed(i, events)
+                continue
+            if ch.isspace():
+                continue
+            depth = len(self._stack)
+            if ch in ",}]":
+                self._scalar_closed(i, depth, events)
+                if ch == ",":
+                    if depth == 1:
+                        self._phase = "key"
+                    continue
+                self._stack.pop()
+                self._container_closed(i, events)
+                continue
+            if ch == ":":
+                if depth == 1:
+                    self._phase = "value"
+                continue
+            self._value_started(i, depth, ch)
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._stack.append(ch)
+        self._pos = len(text)
+        return events
+
+    def _value_started(self, i: int, depth: int, ch: str) -> None:
+        if depth == 0 and ch == "{":
+            self._phase = "key"
+        elif depth == 1 and self._phase == "key" and ch == '"':
+            self._key_start = i
+            self._phase = "in_key"
+        elif depth == 1 and self._phase == "value":
+            self._value_start = i
+            self._phase = "in_value"
+            self._streaming = ch == "[" and self._key in self.stream_arrays
+        elif depth == 2 and self._streaming and self._item_start is None:
+            self._item_start = i
+
+    def _string_closed(self, i: int, events: list) -> None:
+        depth = len(self._stack)
+        if depth == 1 and self._phase == "in_key":
+            self._key = json.loads(self._text[self._key_start:i + 1])
+            self._phase = "colon"
+        elif depth == 1 and self._phase == "in_value":
+            events.append((FIELD, self._key, json.loads(self._text[self._value_start:i + 1])))
+            self._phase = "after"
+        elif depth == 2 and self._streaming and self._item_start is not None:
+            events.append((ITEM, self._key, json.loads(self._text[self._item_start:i + 1])))
+            self._item_start = None
+
+    def _scalar_closed(self, i: int, depth: int, events: list) -> None:
+        # Числа, true/false/null заканчиваются только на разделителе
+        if depth == 1 and self._phase == "in_value":
+            events.append((FIELD, self._key, json.loads(self._text[self._value_start:i])))
+            self._phase = "after"
+        elif depth == 2 and self._streaming and self._item_start is not None:
+            events.append((ITEM, self._key, json.loads(self._text[self._item_start:i])))
+            self._item_start = None
+
+    def _container_closed(self, i: int, events: list) -> None:
+        depth = len(self._stack)
+        if depth == 0:
+            self.done = True
+        elif depth == 1 and self._phase == "in_value":
+            if self._streaming:
+                # Элементы уже отданы по одному
+                self._streaming = False
+            else:
+                events.append((FIELD, self._key, json.loads(self._text[self._value_start:i + 1])))
+            self._phase = "after"
+        elif depth == 2 and self._streaming and self._item_start is not None:
+            events.append((ITEM, self._key, json.loads(self._text[self._item_start:i + 1])))
+            self._item_start = None
@@ -0,0 +1,150 @@
+"""
+Process-wide pooled OpenAI client.
+
+One AsyncOpenAI instance (backed by a keep-alive httpx.AsyncClient) is created
+in the FastAPI lifespan hook and shared by all requests, so TLS handshakes and
+connection pools are reused instead of being rebuilt on every call.
+"""
+import time
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI
+
+from config import settings
+from services.circuit_breaker import CircuitOpenError, call_with_retries
+from services.metrics import LLM_DURATION, LLM_ERRORS
+from services.tracing import span
+from services.usage import record_usage
+
+
+class PoolStats:
+    """Connection reuse counters collected through httpx trace events."""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.handshake_seconds = 0.0
+
+    def snapshot(self) -> dict:
+        reused = max(0, self.requests - self.new_connections)
+        avg_handshake = self.handshake_seconds / self.new_connections if self.new_connections else 0.0
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused_connections": reused,
+            "reuse_rate": round(reused / self.requests, 4) if self.requests else 0.0,
+            "avg_handshake_ms": round(avg_handshake * 1000, 2),
+            "handshake_time_saved_ms": round(reused * avg_handshake * 1000, 2),
+        }
+
+
+_client: Optional[AsyncOpenAI] = None
+_stats = PoolStats()
+
+
+def _make_trace():
+    """Build a per-request httpx trace callback measuring TCP connect + TLS time."""
+    started = {}
+
+    async def trace(event_name: str, info: dict):
+        if event_name in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            started[event_name.rsplit(".", 1)[0]] = time.perf_counter()
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            stage = event_name.rsplit(".", 1)[0]
+            if stage in started:
+                _stats.handshake_seconds += time.perf_counter() - started.pop(stage)
+            if stage == "connection.connect_tcp":
+                _stats.new_connections += 1
+
+    return trace
+
+
+async def _on_request(request: httpx.Request):
+    _stats.requests += 1
+    request.extensions["trace"] = _make_trace()
+
+
+def _build_client() -> AsyncOpenAI:
+    http_client = httpx.AsyncClient(
+        http2=settings.openai_http2,
+        # Прокси задается явно в настройках, переменные окружения не читаем
+        proxy=settings.openai_proxy,
+        trust_env=False,
+        limits=httpx.Limits(
+            max_connections=settings.openai_max_connections,
+            max_keepalive_connections=settings.openai_max_keepalive_connections,
+            keepalive_expiry=settings.openai_keepalive_expiry
+        ),
+        timeout=httpx.Timeout(settings.openai_timeout, connect=10.0),
+        event_hooks={"request": [_on_request]}
+    )
+    return AsyncOpenAI(
+        api_key=settings.openai_api_key,
+        base_url=settings.openai_base_url,
+        timeout=settings.openai_timeout,
+        # Повторы делает call_with_retries с учетом срока запроса
+        max_retries=0,
+        http_client=http_client
+    )
+
+
+async def startup() -> None:
+    """Create the shared client. Called from the FastAPI lifespan hook."""
+    global _client
+    if _client is None and settings.openai_api_key:
+        _client = _build_client()
+
+
+async def shutdown() -> None:
+    """Close the shared client and its connection pool."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def get_client() -> AsyncOpenAI:
+    """
+    Return the shared client.
+    Created lazily when used outside the app lifespan (scripts, benchmarks).
+    """
+    global _client
+    if _client is None:
+        _client = _build_client()
+    return _client
+
+
+def get_pool_stats() -> dict:
+    stats = _stats.snapshot()
+    stats["http2"] = settings.openai_http2
+    stats["max_connections"] = settings.openai_max_connections
+    stats["max_keepalive_connections"] = settings.openai_max_keepalive_connections
+    return stats
+
+
+async def create_completion(usage_label: str = "other", **kwargs):
+    """
+    chat.completions.create on the shared client, guarded by the model's
+    circuit breaker and retried on transient errors within the request deadline.
+    Token usage is recorded under usage_label (streams record it from their last chunk);
+    latency and errors go to the bodyfat_llm_* metrics.
+    """
+    client = get_client()
+    model = kwargs["model"]
+    started = time.perf_counter()
+    try:
+        with span("llm.call", model=model, call=usage_label, stream=bool(kwargs.get("stream"))):
+            response = await call_with_retries(model, lambda: client.chat.completions.create(**kwargs))
+    except CircuitOpenError:
+        LLM_DURATION.observe(time.perf_counter() - started, model, usage_label, "circuit_open")
+        raise
+    except Exception as e:
+        LLM_DURATION.observe(time.perf_counter() - started, model, usage_label, "error")
+        LLM_ERRORS.inc(model, type(e).__name__)
+        raise
+    # Для потока это время до заголовков ответа, а не до последнего чанка
+    LLM_DURATION.observe(time.perf_counter() - started, model, usage_label, "stream" if kwargs.get("stream") else "ok")
+    if not kwargs.get("stream"):
+        record_usage(usage_label, model, response.usage)
+    return response
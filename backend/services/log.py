@@ -0,0 +1,161 @@
+"""
+Structured, non-blocking logging.
+
+Records are written as JSON lines (ts, level, logger, msg, request_id and any
+extra fields). Request handlers only put records on a bounded in-memory
+queue; a QueueListener thread formats and writes them to stdout, so a slow
+terminal or log collector never blocks the event loop. When the queue is
+full, records are dropped and counted instead of waiting.
+
+Every HTTP request gets an ID (taken from X-Request-ID or generated) that is
+attached to all its log records and echoed in the response headers.
+High-volume events (one per uploaded image) are sampled with should_log().
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import uuid
+from typing import Optional
+
+from config import settings
+
+# ID текущего HTTP запроса - попадает во все его записи лога
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# Стандартные атрибуты LogRecord - все остальные пришли через extra и выводятся как поля
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _RequestIDFilter(logging.Filter):
+    # Выполняется в потоке, который пишет в лог, - там виден контекст запроса
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking or raising."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Подставляем аргументы сразу, а traceback и JSON форматирует поток записи, не event loop
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler: Optional[_DroppingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_sample_counters: dict[str, int] = {}
+
+
+def setup_logging() -> None:
+    """Route the "bodyfat" loggers through the queue handler. Safe to call more than once."""
+    global _handler, _listener
+    if _handler is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter())
+    _handler = _DroppingQueueHandler(queue.Queue(maxsize=settings.log_queue_size))
+    _handler.addFilter(_RequestIDFilter())
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger("bodyfat")
+    root.setLevel(settings.log_level.upper())
+    root.addHandler(_handler)
+    root.propagate = False
+
+
+def shutdown_logging() -> None:
+    """Flush the queue and stop the writer thread. Called from the FastAPI lifespan hook."""
+    global _handler, _listener
+    if _listener is not None:
+        _listener.stop()
+        logging.getLogger("bodyfat").removeHandler(_handler)
+        _listener = None
+        _handler = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"bodyfat.{name}")
+
+
+def should_log(event: str) -> bool:
+    """Sampling for high-volume events: True for 1 of every log_sample_every calls per event."""
+    count = _sample_counters.get(event, 0)
+    _sample_counters[event] = count + 1
+    return count % max(1, settings.log_sample_every) == 0
+
+
+def get_log_stats() -> dict:
+    return {
+        "level": settings.log_level.upper(),
+        "queued": _handler.queue.qsize() if _handler is not None else 0,
+        "queue_size": settings.log_queue_size,
+        "dropped": _handler.dropped if _handler is not None else 0,
+        "sample_every": settings.log_sample_every,
+    }
+
+
+class RequestIDMiddleware:
+    """
+    ASGI middleware that assigns each request an ID (X-Request-ID from the
+    client if present, else a new one) and returns it in the response.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                # Чужой ID ограничиваем по длине, чтобы не раздувать логи
+                request_id = value.decode("latin-1")[:64]
+                break
+        if not request_id:
+            request_id = uuid.uuid4().hex[:16]
+        token = request_id_var.set(request_id)
+        header = (b"x-request-id", request_id.encode("latin-1"))
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [header]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
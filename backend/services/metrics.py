@@ -0,0 +1,243 @@
+"""
+Prometheus-style metrics.
+
+Counters and histograms are plain in-process objects: recording a value is a
+dict lookup and a few additions, so instrumenting hot paths costs well under
+a microsecond. Record from the event loop only (worker threads report their
+timings back through PreparedImage.timings). Statistics already kept by
+other services (caches, breakers, admission, tokens, jobs) are read at
+scrape time through registered collectors instead of being counted twice.
+render() returns everything in the Prometheus text exposition format.
+"""
+import bisect
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator
+
+from services.log import get_logger
+
+logger = get_logger("metrics")
+
+# Границы корзин гистограмм, секунды / байты
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+SIZE_BUCKETS = (16_384, 65_536, 262_144, 1_048_576, 4_194_304, 16_777_216)
+
+
+@dataclass
+class MetricFamily:
+    """One metric with all its label combinations, as produced by a collector."""
+    name: str
+    kind: str
+    help: str
+    labelnames: tuple = ()
+    samples: dict = field(default_factory=dict)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        """Increment the series for the given label values (positional, in labelnames order)."""
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> list[str]:
+        return _render_family(MetricFamily(self.name, "counter", self.help, self.labelnames, self._values))
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # Для каждой комбинации меток: [счетчики корзин (+Inf последней), сумма]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observe the duration of the with-block in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bounds = [_format_value(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le=bound)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, le: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _render_family(family: MetricFamily) -> list[str]:
+    lines = [f"# HELP {family.name} {family.help}", f"# TYPE {family.name} {family.kind}"]
+    for labels, value in family.samples.items():
+        lines.append(f"{family.name}{_format_labels(family.labelnames, labels)} {_format_value(value)}")
+    return lines
+
+
+_metrics: list = []
+_collectors: list[Callable[[], Iterable[MetricFamily]]] = []
+
+
+def counter(name: str, help: str, labelnames: tuple = ()) -> Counter:
+    metric = Counter(name, help, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    metric = Histogram(name, help, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(collector: Callable[[], Iterable[MetricFamily]]) -> None:
+    """Add a function called at scrape time that reports stats kept elsewhere."""
+    _collectors.append(collector)
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            for family in collector():
+                lines.extend(_render_family(family))
+        except Exception as e:
+            # Сбой одного источника не должен ломать всю выдачу /metrics
+            logger.warning("Metrics collector %s failed: %s", getattr(collector, "__name__", collector), e)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests and timing them up to the response start
+    (time to first byte for streamed responses). Routes are labelled by their
+    template (/api/bodyfat/jobs/{job_id}), never by the raw path.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                HTTP_DURATION.observe(time.perf_counter() - started, _route_label(scope), scope["method"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUESTS.inc(_route_label(scope), scope["method"], str(status[0]))
+
+
+def _route_label(scope) -> str:
+    # Роутер FastAPI кладет найденный маршрут в scope
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    return "unmatched"
+
+
+# Метрики горячего пути (имена в стиле Prometheus, единицы - секунды и байты)
+HTTP_REQUESTS = counter(
+    "bodyfat_http_requests_total", "HTTP requests by route template, method and status.",
+    ("route", "method", "status")
+)
+HTTP_DURATION = histogram(
+    "bodyfat_http_request_duration_seconds", "Time to the response start by route template.",
+    ("route", "method")
+)
+FORM_PARSE = histogram(
+    "bodyfat_form_parse_seconds", "Parsing and validating the /api/bodyfat form, uploads included.",
+    ("kind",), FAST_BUCKETS
+)
+IMAGE_STAGE = histogram(
+    "bodyfat_image_stage_seconds", "Image preprocessing stages per image or mosaic (queue_wait, decode, resize, quality, mosaic, encode, base64).",
+    ("stage",), FAST_BUCKETS
+)
+IMAGE_BASE64_BYTES = histogram(
+    "bodyfat_image_base64_bytes", "Size of the base64 image payload sent to the vision model.",
+    (), SIZE_BUCKETS
+)
+LLM_DURATION = histogram(
+    "bodyfat_llm_request_seconds", "Chat completion calls including retries, by model, call and outcome.",
+    ("model", "call", "outcome")
+)
+LLM_ERRORS = counter(
+    "bodyfat_llm_errors_total", "Failed chat completion calls by model and exception type.",
+    ("model", "error")
+)
+JSON_PARSE = histogram(
+    "bodyfat_llm_json_parse_seconds", "Parsing the JSON answer of the model.",
+    ("call",), FAST_BUCKETS
+)
+JSON_PARSE_ERRORS = counter(
+    "bodyfat_llm_json_parse_errors_total", "Model answers that were not valid JSON.",
+    ("call",)
+)
+FALLBACKS = counter(
+    "bodyfat_fallbacks_total", "Answers served by the local estimator or mock advice instead of the LLM.",
+    ("endpoint", "reason")
+)
+ERRORS = counter(
+    "bodyfat_errors_total", "Requests that ended with an error response, by endpoint and reason.",
+    ("endpoint", "reason")
+)
+PHOTOS_DROPPED = counter(
+    "bodyfat_photos_dropped_total", "Uploaded photos dropped by the quality gate before the vision call, by reason.",
+    ("reason",)
+)
@@ -1,78 +1,242 @@
-from models import BodyFatRequest, BodyFatResponse, AdviceRequest, AdviceResponse
+from models import BodyFatRequest, BodyFatResponse, AdviceRequest, AdviceResponse, BodyFatAdviceResponse
 from config import settings
-from openai import OpenAI
+from services.llm_client import create_completion
+from services.image_workers import prepare_images, summarize_timings
+from services.image_processing import PreparedImage
+from services.photo_quality import apply_gate
+from services.cache import create_cache
+from services.estimator import estimate_body_fat
+from services.hedging import get_tracker, hedged_call, winner_var
+from services.circuit_breaker import CircuitOpenError, get_breaker
+from services.advice_library import COMBINED, get_advice_library
+from services.json_stream import FIELD, ITEM, IncrementalJSONParser
+from services.log import get_logger, should_log
+from services.metrics import FALLBACKS, JSON_PARSE, JSON_PARSE_ERRORS
+from services.tracing import span
+from services.prompts import MOSAIC_NOTE, advice_values, bodyfat_values, get_prompt, image_values
+from services.usage import record_usage
+from services.vision_layout import arrange
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Optional
+import asyncio
 import json
 import re
-import base64
-from io import BytesIO
-from PIL import Image
-import httpx
+import time
+
+
+VISION_MODEL = "gpt-4o"
+
+logger = get_logger("openai")
+
+
+class _Flight:
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.waiters = 0
+
+
+class _SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one upstream call.
+    Waiters await a shielded shared future, so one cancelled waiter
+    (client disconnect, lost hedge race) does not cancel it for the others;
+    once every waiter has left, the upstream call itself is cancelled.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, _Flight] = {}
+        self.upstream_calls = 0
+        self.coalesced_calls = 0
+        self.abandoned_calls = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(factory()))
+            self._calls[key] = flight
+            self.upstream_calls += 1
+            flight.future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.coalesced_calls += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.future)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.future.done():
+                # Ответ больше никому не нужен - не держим платный запрос к LLM до конца
+                self.abandoned_calls += 1
+                if self._calls.get(key) is flight:
+                    del self._calls[key]
+                flight.future.cancel()
+
+    def _forget(self, key: str, future: asyncio.Future) -> None:
+        flight = self._calls.get(key)
+        if flight is not None and flight.future is future:
+            del self._calls[key]
+        # Помечаем исключение как полученное, даже если все ожидающие отменились
+        if not future.cancelled():
+            future.exception()
+
+    def snapshot(self) -> dict:
+        total = self.upstream_calls + self.coalesced_calls
+        return {
+            "upstream_calls": self.upstream_calls,
+            "coalesced_calls": self.coalesced_calls,
+            "saved_ratio": round(self.coalesced_calls / total, 4) if total else 0.0,
+            "abandoned_calls": self.abandoned_calls,
+            "in_flight": len(self._calls),
+        }
+
+
+_bodyfat_flight = _SingleFlight()
+_advice_flight = _SingleFlight()
+
+
+def get_single_flight_stats() -> dict:
+    return {"bodyfat": _bodyfat_flight.snapshot(), "advice": _advice_flight.snapshot()}
+
+
+_bodyfat_cache = None
+_image_result_cache = None
+
+
+def get_bodyfat_cache():
+    """Shared cache of text-only body fat estimates (None if disabled)."""
+    global _bodyfat_cache
+    if _bodyfat_cache is None and settings.bodyfat_cache_backend != "none":
+        _bodyfat_cache = create_cache(
+            settings.bodyfat_cache_backend,
+            namespace="bodyfat",
+            max_entries=settings.bodyfat_cache_max_entries,
+            ttl=settings.bodyfat_cache_ttl,
+            path=settings.bodyfat_cache_path
+        )
+    return _bodyfat_cache
+
+
+def get_image_result_cache():
+    """Cache of photo-based analyses keyed by preprocessed image hashes (None if disabled)."""
+    global _image_result_cache
+    if _image_result_cache is None and settings.image_cache_enabled:
+        _image_result_cache = create_cache(
+            settings.image_result_cache_backend,
+            namespace="bodyfat_image",
+            max_entries=settings.image_result_cache_max_entries,
+            ttl=settings.image_result_cache_ttl,
+            path=settings.bodyfat_cache_path
+        )
+    return _image_result_cache
+
+
+def _bucket(value: Optional[float], bucket: float) -> Optional[float]:
+    if value is None:
+        return None
+    if bucket > 0:
+        return round(round(value / bucket) * bucket, 2)
+    return round(value, 1)
+
+
+def _bodyfat_cache_key(request: BodyFatRequest) -> str:
+    """
+    Normalized key of a text-only estimate. The model runs with temperature=0
+    and a fixed seed, so equal inputs give equal answers (for the same prompt variant).
+    """
+    return "|".join(str(part) for part in (
+        settings.openai_model,
+        settings.prompt_variant,
+        request.gender.value,
+        request.age,
+        _bucket(request.height, settings.bodyfat_cache_height_bucket),
+        _bucket(request.weight, settings.bodyfat_cache_weight_bucket),
+        _bucket(request.waist, settings.bodyfat_cache_height_bucket),
+        _bucket(request.neck, settings.bodyfat_cache_height_bucket),
+        _bucket(request.hip, settings.bodyfat_cache_height_bucket)
+    ))
+
+
+def _get_cached_estimate(request: BodyFatRequest) -> Optional[BodyFatResponse]:
+    cache = get_bodyfat_cache()
+    if cache is None:
+        return None
+    cached = cache.get(_bodyfat_cache_key(request))
+    return BodyFatResponse(**cached) if cached is not None else None
+
+
+def _parse_json(content: str, call: str) -> dict:
+    """json.loads of a model answer, with parse time and failures recorded in the metrics."""
+    started = time.perf_counter()
+    try:
+        with span("llm.parse", call=call):
+            return json.loads(content)
+    except json.JSONDecodeError:
+        JSON_PARSE_ERRORS.inc(call)
+        raise
+    finally:
+        JSON_PARSE.observe(time.perf_counter() - started, call)
+
+
+def _local_fallback(request: BodyFatRequest):
+    """Local estimator used when the latency budget runs out (None if disabled)."""
+    if not settings.local_fallback_enabled:
+        return None
+    return lambda: estimate_body_fat(request)
 
 
 async def calculate_body_fat(request: BodyFatRequest) -> BodyFatResponse:
     """
     Calculate body fat percentage using OpenAI API.
     Returns structured response with body fat percentage and comment.
+    A slow call is hedged with a second request after llm_hedge_delay_seconds;
+    if nothing answers within llm_deadline_seconds the local estimator is used.
     """
     
     # Если API ключ не установлен, возвращаем заглушку для тестирования
     if not settings.openai_api_key:
+        FALLBACKS.inc("bodyfat_text", "no_api_key")
+        winner_var.set("fallback")
         return _get_mock_response(request)
     
-    # Инициализируем клиент OpenAI
-    # Удаляем переменные окружения прокси, чтобы избежать конфликта с httpx
-    import os
+    # Одинаковые параметры дают одинаковый ответ - сначала проверяем кэш
+    cached = _get_cached_estimate(request)
+    if cached is not None:
+        return cached
     
-    # Сохраняем и удаляем прокси переменные
-    proxy_vars = ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 'ALL_PROXY', 'all_proxy']
-    saved_proxies = {}
-    for var in proxy_vars:
-        if var in os.environ:
-            saved_proxies[var] = os.environ[var]
-            del os.environ[var]
+    # Цепь разомкнута - сразу отвечаем локальной оценкой вместо заведомо неудачного вызова
+    if settings.local_fallback_enabled and get_breaker(settings.openai_model).is_open():
+        winner_var.set("fallback")
+        FALLBACKS.inc("bodyfat_text", "circuit_open")
+        return estimate_body_fat(request)
     
-    try:
-        # Создаем клиент без передачи http_client - пусть OpenAI создаст свой
-        # Это должно избежать проблемы с proxies параметром
-        client = OpenAI(api_key=settings.openai_api_key)
-    finally:
-        # Восстанавливаем прокси переменные
-        for var, value in saved_proxies.items():
-            os.environ[var] = value
-    
-    # Формируем промпт
-    system_prompt = """You are an expert in body composition analysis. 
-Your task is to estimate body fat percentage based on provided anthropometric data.
-
-You must respond ONLY with a valid JSON object in this exact format:
-{
-    "body_fat_percent": <number between 0 and 100>,
-    "comment": "<brief comment in 1-3 sentences, in English>"
-}
-
-Rules:
-- body_fat_percent: a single number (float), no additional text
-- comment: brief, informative, in English, no medical diagnoses
-- Consider gender, age, height, weight, and waist circumference (if provided)
-- Use standard body fat estimation formulas (e.g., Deurenberg, Jackson-Pollock) as reference
-- Do not provide any text outside the JSON object"""
-
-    user_prompt = f"""Calculate body fat percentage for:
-- Gender: {request.gender}
-- Age: {request.age} years
-- Height: {request.height} cm
-- Weight: {request.weight} kg
-{f"- Waist circumference: {request.waist} cm" if request.waist else ""}
-
-Respond with JSON only."""
+    # Одинаковые запросы в полете объединяются: основной и хеджирующий вызовы - по одному на ключ
+    key = _bodyfat_cache_key(request)
+    return await hedged_call(
+        "bodyfat_text",
+        primary=lambda: _bodyfat_flight.do(key, lambda: _llm_body_fat(request)),
+        hedge=(lambda: _bodyfat_flight.do(f"hedge|{key}", lambda: _llm_body_fat(request)))
+        if settings.llm_hedge_enabled else None,
+        fallback=_local_fallback(request),
+        hedge_delay=settings.llm_hedge_delay_seconds,
+        deadline=settings.llm_deadline_seconds
+    )
+
+
+async def _text_estimate(request: BodyFatRequest) -> BodyFatResponse:
+    """Single text-only LLM estimate (served from cache when possible)."""
+    cached = _get_cached_estimate(request)
+    if cached is not None:
+        return cached
+    return await _llm_body_fat(request)
+
+
+async def _llm_body_fat(request: BodyFatRequest) -> BodyFatResponse:
+    """One text-only LLM attempt. Raises on upstream errors."""
+    prompt = get_prompt("bodyfat_text")
 
     try:
-        response = client.chat.completions.create(
+        response = await create_completion(
+            usage_label=prompt.label,
             model=settings.openai_model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
+            messages=prompt.messages(bodyfat_values(request)),
             temperature=0.0,  # Минимальная температура для максимальной стабильности
             response_format={"type": "json_object"},  # Принудительный JSON формат
             seed=42  # Фиксированный seed для детерминированных результатов
@@ -82,7 +246,7 @@ Respond with JSON only."""
         if not content:
             raise Exception("Empty response from OpenAI API")
         
-        result = json.loads(content)
+        result = _parse_json(content, "bodyfat_text")
         
         # Валидация и извлечение данных
         body_fat_percent = float(result.get("body_fat_percent", 0))
@@ -94,16 +258,22 @@ Respond with JSON only."""
         # Ограничиваем процент жира разумными значениями
         body_fat_percent = max(0, min(100, body_fat_percent))
         
-        return BodyFatResponse(
+        result = BodyFatResponse(
             body_fat_percent=round(body_fat_percent, 1),
             comment=comment,
             evaluation=evaluation
         )
+        cache = get_bodyfat_cache()
+        if cache is not None:
+            cache.set(_bodyfat_cache_key(request), result.model_dump())
+        return result
         
     except json.JSONDecodeError as e:
         # Если не удалось распарсить JSON, пытаемся извлечь число из текста
         content = response.choices[0].message.content if response and response.choices else ""
         return _parse_fallback_response(content, request)
+    except CircuitOpenError:
+        raise
     except Exception as e:
         raise Exception(f"OpenAI API error: {str(e)}")
 
@@ -137,42 +307,9 @@ def _get_evaluation(percent: float, gender: str) -> str:
 def _get_mock_response(request: BodyFatRequest) -> BodyFatResponse:
     """
     Mock response for testing without OpenAI API key.
-    Uses simple estimation formula as fallback.
+    Uses the local anthropometric estimator as fallback.
     """
-    # Простая формула для демонстрации (формула Деуренберга)
-    bmi = request.weight / ((request.height / 100) ** 2)
-    
-    if request.gender == "male":
-        body_fat = (1.20 * bmi) + (0.23 * request.age) - 16.2
-    else:
-        body_fat = (1.20 * bmi) + (0.23 * request.age) - 5.4
-    
-    # Корректировка с учетом обхвата талии, если предоставлен
-    if request.waist:
-        if request.gender == "male":
-            body_fat += (request.waist / request.height) * 10
-        else:
-            body_fat += (request.waist / request.height) * 8
-    
-    body_fat = max(5, min(50, body_fat))  # Ограничиваем разумными значениями
-    
-    evaluation = _get_evaluation(body_fat, request.gender)
-    
-    comment = f"Estimated body fat percentage calculated based on your parameters. "
-    if body_fat < 10:
-        comment += "Very low body fat percentage, typical for athletes."
-    elif body_fat < 20:
-        comment += "Low body fat percentage, good physical condition."
-    elif body_fat < 25:
-        comment += "Normal body fat percentage for a healthy person."
-    else:
-        comment += "Elevated body fat percentage, consultation with a specialist is recommended."
-    
-    return BodyFatResponse(
-        body_fat_percent=round(body_fat, 1),
-        comment=comment,
-        evaluation=evaluation
-    )
+    return estimate_body_fat(request)
 
 
 def _parse_fallback_response(content: str, request: BodyFatRequest) -> BodyFatResponse:
@@ -190,168 +327,129 @@ def _parse_fallback_response(content: str, request: BodyFatRequest) -> BodyFatRe
     )
 
 
-def _encode_image_to_base64(image_data: bytes, content_type: str) -> str:
+def _close_uploads(image_data_list: list[bytes | BinaryIO]) -> None:
+    for image_data in image_data_list:
+        if hasattr(image_data, "close"):
+            image_data.close()
+
+
+async def _prepare_uploads(
+    image_data_list: list[bytes | BinaryIO],
+    content_type_list: list[str],
+    stage_timings: Optional[dict] = None
+) -> list[PreparedImage]:
     """
-    Encode image to base64 string for GPT-4 Vision API.
+    Downscale and base64-encode the uploads in the worker pool, then release them.
+    Photos failing the quality gate are left out (PhotoQualityError in reject mode).
     """
-    # Если изображение уже в правильном формате, просто кодируем
-    # Иначе конвертируем через PIL
-    try:
-        if content_type and content_type.startswith('image/'):
-            # Пытаемся открыть и оптимизировать изображение
-            img = Image.open(BytesIO(image_data))
-            
-            # Конвертируем в RGB если нужно (для JPEG)
-            if img.mode in ('RGBA', 'LA', 'P'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                img = background
-            
-            # Сохраняем в буфер
-            buffer = BytesIO()
-            img.save(buffer, format='JPEG', quality=85, optimize=True)
-            image_data = buffer.getvalue()
-        
-        return base64.b64encode(image_data).decode('utf-8')
-    except Exception as e:
-        # Если не удалось обработать, просто кодируем как есть
-        return base64.b64encode(image_data).decode('utf-8')
+    # Уменьшаем и кодируем все изображения в base64 параллельно в пуле воркеров
+    prepared_images = await prepare_images(image_data_list, content_type_list)
+    # Исходные загрузки больше не нужны - освобождаем буферы до вызова LLM
+    _close_uploads(image_data_list)
+    timings = summarize_timings(prepared_images)
+    if stage_timings is not None:
+        stage_timings.update(timings)
+    
+    # Частое событие - пишем выборочно, время этапов есть в метриках
+    if should_log("image_preprocessing"):
+        logger.info("Image preprocessing", extra={
+            "images": len(prepared_images),
+            "original_bytes": sum(image.original_bytes for image in prepared_images),
+            "encoded_bytes": sum(image.encoded_bytes for image in prepared_images),
+            "vision_tokens_saved": sum(image.tokens_saved for image in prepared_images),
+            "timings_ms": timings,
+            "sample_every": settings.log_sample_every,
+        })
+    # Размытые, темные, мелкие фото и дубликаты не отправляем в vision модель
+    prepared_images, _ = apply_gate(prepared_images)
+    return prepared_images
+
+
+def _image_parts(prepared_images: list[PreparedImage], details: list[Optional[str]]) -> list[dict]:
+    """image_url message parts; the prepared base64 is released once copied into the data URLs."""
+    parts = []
+    for image, detail in zip(prepared_images, details):
+        image_url = {"url": f"data:{image.mime_type};base64,{image.base64_data}"}
+        if detail is not None:
+            image_url["detail"] = detail
+        parts.append({"type": "image_url", "image_url": image_url})
+    # base64 уже скопирован в data URL - не держим вторую копию
+    prepared_images.clear()
+    return parts
+
+
+async def _vision_content(user_text: str, prepared_images: list[PreparedImage]) -> list[dict]:
+    """User message content: the request text, then the photos laid out by services.vision_layout."""
+    images, details, mosaic = await arrange(prepared_images)
+    if mosaic:
+        user_text = f"{user_text}\n{MOSAIC_NOTE}"
+    parts = [{"type": "text", "text": user_text}, *_image_parts(images, details)]
+    # Отдельные фото, собранные в мозаику, тоже больше не нужны
+    prepared_images.clear()
+    return parts
 
 
 async def calculate_body_fat_with_image(
     request: BodyFatRequest, 
-    image_data_list: list[bytes], 
-    content_type_list: list[str]
+    image_data_list: list[bytes | BinaryIO], 
+    content_type_list: list[str],
+    stage_timings: Optional[dict] = None,
+    deadline: Optional[float] = None
 ) -> BodyFatResponse:
     """
     Calculate body fat percentage using OpenAI GPT-4 Vision API with image analysis.
     Combines user input parameters with visual analysis from multiple photos.
+    The vision call is raced against a hedge (image_hedge_strategy) within
+    deadline (image_deadline_seconds by default), after which the local estimator answers.
+    If stage_timings is given, it is filled with per-stage image processing timings (ms).
     """
     
     # Если API ключ не установлен, используем обычный расчет
     if not settings.openai_api_key:
-        print("WARNING: OpenAI API key not set, using fallback calculation")
+        logger.warning("OpenAI API key not set, using fallback calculation")
+        FALLBACKS.inc("bodyfat_image", "no_api_key")
+        winner_var.set("fallback")
         return _get_mock_response(request)
     
-    print(f"Using OpenAI API key: {settings.openai_api_key[:20]}...")
-    print(f"Processing {len(image_data_list)} image(s)")
+    # Vision-модель недоступна - не тратим время на обработку фото, оцениваем по параметрам
+    if get_breaker(VISION_MODEL).is_open():
+        logger.warning("Vision circuit is open, estimating without photos")
+        FALLBACKS.inc("bodyfat_image", "circuit_open")
+        _close_uploads(image_data_list)
+        return await calculate_body_fat(request)
     
-    # Инициализируем клиент OpenAI
-    # Удаляем переменные окружения прокси, чтобы избежать конфликта с httpx
-    import os
+    prepared_images = await _prepare_uploads(image_data_list, content_type_list, stage_timings)
+    if not prepared_images:
+        # Ни одно фото не прошло проверку качества - оцениваем по параметрам без vision вызова
+        return await calculate_body_fat(request)
     
-    # Сохраняем и удаляем прокси переменные
-    proxy_vars = ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 'ALL_PROXY', 'all_proxy']
-    saved_proxies = {}
-    for var in proxy_vars:
-        if var in os.environ:
-            saved_proxies[var] = os.environ[var]
-            del os.environ[var]
+    # Те же фото с теми же параметрами и той же раскладкой - отдаем сохраненный результат без вызова LLM
+    result_cache = get_image_result_cache()
+    result_cache_key = "|".join([
+        _bodyfat_cache_key(request),
+        settings.image_detail,
+        str(settings.image_high_detail_max),
+        f"mosaic{settings.image_mosaic_min_cell}" if settings.image_mosaic_enabled else "separate",
+        *sorted(image.content_hash for image in prepared_images)
+    ])
+    if result_cache is not None:
+        cached = result_cache.get(result_cache_key)
+        if cached is not None:
+            return BodyFatResponse(**cached)
     
-    try:
-        # Создаем клиент без передачи http_client - пусть OpenAI создаст свой
-        # Это должно избежать проблемы с proxies параметром
-        client = OpenAI(api_key=settings.openai_api_key)
-    finally:
-        # Восстанавливаем прокси переменные
-        for var, value in saved_proxies.items():
-            os.environ[var] = value
-    
-    # Кодируем все изображения в base64
-    base64_images = []
-    mime_types = []
-    for i, image_data in enumerate(image_data_list):
-        content_type = content_type_list[i] if i < len(content_type_list) else "image/jpeg"
-        base64_images.append(_encode_image_to_base64(image_data, content_type))
-        mime_types.append(content_type if content_type else "image/jpeg")
-    
-    # Формируем промпт для анализа изображения
-    system_prompt = """You are an expert in body composition analysis and visual assessment of body fat percentage.
-Your task is to estimate body fat percentage by analyzing a photo of a person combined with their anthropometric data.
-
-You must respond ONLY with a valid JSON object in this exact format:
-{
-    "body_fat_percent": <number between 0 and 100>,
-    "comment": "<brief comment in 1-3 sentences, in English, explaining the analysis>",
-    "evaluation": "<one of: Very Low, Low (Athletic), Normal, Above Average, High>"
-}
-
-CRITICAL RULES FOR ACCURACY:
-1. Be CONSERVATIVE and REALISTIC - most people underestimate body fat. Average body fat for men is 18-24%, for women 25-31%
-2. Visual assessment is often MORE accurate than formulas - trust what you see in the photo
-3. Look for these indicators:
-   - Visible fat deposits (especially abdomen, love handles, chest, thighs)
-   - Muscle definition (visible abs = lower body fat, no definition = higher body fat)
-   - Body shape and proportions
-   - Skin appearance and texture
-4. If you see visible fat deposits, the body fat is likely 20% or higher
-5. If abs are not visible at all, body fat is typically 18%+ for men, 25%+ for women
-6. Combine visual assessment with anthropometric data, but prioritize visual cues
-7. Be honest and accurate - do not underestimate
-
-- body_fat_percent: a single number (float), be realistic and accurate
-- comment: brief, informative, in English, mention specific visual indicators you observed
-- evaluation: one of "Very Low", "Low (Athletic)", "Normal", "Above Average", "High" based on:
-  * For men: <10% = Very Low, 10-15% = Low, 15-20% = Normal, 20-25% = Above Average, >25% = High
-  * For women: <16% = Very Low, 16-20% = Low, 20-25% = Normal, 25-32% = Above Average, >32% = High
-- Do not provide any text outside the JSON object"""
-
-    bmi = request.weight / ((request.height/100)**2)
-    
-    user_prompt = f"""Analyze {"these photos" if len(image_data_list) > 1 else "this photo"} and calculate body fat percentage for:
-- Gender: {request.gender}
-- Age: {request.age} years
-- Height: {request.height} cm
-- Weight: {request.weight} kg
-- BMI: {bmi:.1f}
-{f"- Waist circumference: {request.waist} cm" if request.waist else ""}
-
-SYSTEMATIC ANALYSIS APPROACH:
-
-STEP 1: Calculate baseline using Deurenberg formula:
-- BMI = {bmi:.1f}
-- Baseline body fat ≈ {1.20 * bmi + 0.23 * request.age - (16.2 if request.gender == 'male' else 5.4):.1f}%
-
-STEP 2: Visual assessment from {"photos" if len(image_data_list) > 1 else "photo"} (THIS IS CRITICAL):
-Carefully examine {"all photos" if len(image_data_list) > 1 else "the photo"} and assess:
-- Visible fat deposits: abdomen, love handles, chest, arms, thighs
-- Muscle definition: are abs visible? Are muscles defined?
-- Body shape: overall proportions and fat distribution
-- Skin appearance: smoothness, texture, visible fat under skin
-
-STEP 3: Combine both approaches:
-- If visual assessment shows MORE fat than baseline suggests → use higher value
-- If visual assessment shows LESS fat than baseline suggests → use lower value
-- PRIORITIZE visual assessment over formulas - photos don't lie
-
-STEP 4: Realistic ranges:
-- For men: 15-20% = athletic, 20-25% = average, 25%+ = above average
-- For women: 20-25% = athletic, 25-30% = average, 30%+ = above average
-- If you see visible fat deposits, body fat is likely 20%+ for men, 25%+ for women
-
-IMPORTANT: Be HONEST and REALISTIC. Most people underestimate body fat. If you see fat in the photo, reflect that in your estimate.
-
-Provide a CONSISTENT, ACCURATE, and REALISTIC estimate.
-
-Respond with JSON only."""
+    # Статичные инструкции - в system, в user - только данные запроса
+    prompt = get_prompt("bodyfat_image")
+    user_prompt = prompt.user_text(image_values(request, len(prepared_images)))
 
-    try:
-        # Формируем контент с текстом и всеми изображениями
-        user_content = [{"type": "text", "text": user_prompt}]
-        for i, base64_image in enumerate(base64_images):
-            user_content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{mime_types[i]};base64,{base64_image}"
-                }
-            })
-        
-        response = client.chat.completions.create(
-            model="gpt-4o",  # Используем GPT-4o для vision capabilities
+    # Формируем контент с текстом и всеми изображениями (по отдельности или мозаикой)
+    user_content = await _vision_content(user_prompt, prepared_images)
+    
+    async def vision_attempt() -> BodyFatResponse:
+        response = await create_completion(
+            usage_label=prompt.label,
+            model=VISION_MODEL,  # Используем GPT-4o для vision capabilities
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": prompt.system},
                 {
                     "role": "user",
                     "content": user_content
@@ -366,7 +464,8 @@ Respond with JSON only."""
         if not content:
             raise Exception("Empty response from OpenAI API")
         
-        result = json.loads(content)
+        # Ошибка разбора JSON считается неудачной попыткой - ответ даст хедж
+        result = _parse_json(content, "bodyfat_image")
         
         # Валидация и извлечение данных
         body_fat_percent = float(result.get("body_fat_percent", 0))
@@ -376,22 +475,31 @@ Respond with JSON only."""
         # Ограничиваем процент жира разумными значениями
         body_fat_percent = max(0, min(100, body_fat_percent))
         
-        return BodyFatResponse(
+        result = BodyFatResponse(
             body_fat_percent=round(body_fat_percent, 1),
             comment=comment,
             evaluation=evaluation
         )
-        
-    except json.JSONDecodeError as e:
-        # Если не удалось распарсить JSON, используем обычный расчет
-        print(f"JSON decode error in image analysis: {e}")
-        return await calculate_body_fat(request)
-    except Exception as e:
-        # В случае ошибки с фото, используем обычный расчет без фото
-        print(f"Error in image analysis, falling back to regular calculation: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
-        return await calculate_body_fat(request)
+        if result_cache is not None:
+            result_cache.set(result_cache_key, result.model_dump())
+        return result
+    
+    # Хедж: повтор vision запроса или текстовая оценка без фото (она же резерв при ошибке фото)
+    if settings.image_hedge_strategy == "duplicate":
+        hedge = vision_attempt
+    elif settings.image_hedge_strategy == "text":
+        hedge = lambda: _text_estimate(request)
+    else:
+        hedge = None
+    
+    return await hedged_call(
+        "bodyfat_image",
+        primary=vision_attempt,
+        hedge=hedge,
+        fallback=_local_fallback(request),
+        hedge_delay=settings.image_hedge_delay_seconds,
+        deadline=deadline or settings.image_deadline_seconds
+    )
 
 
 def _calculate_time_estimates(current_percent: float, target_percent: float, gender: str) -> list[dict]:
@@ -448,142 +556,80 @@ def _calculate_time_estimates(current_percent: float, target_percent: float, gen
     return estimates if estimates else [{"percent": round(current_percent, 1), "months": 0}]
 
 
-async def generate_advice(request: AdviceRequest) -> AdviceResponse:
-    """
-    Generate personalized advice for body fat management based on current body fat percentage.
-    """
-    
-    # Если API ключ не установлен, возвращаем заглушку
-    if not settings.openai_api_key:
-        return _get_mock_advice(request)
-    
-    # Инициализируем клиент OpenAI
-    import os
-    
-    # Сохраняем и удаляем прокси переменные
-    proxy_vars = ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 'ALL_PROXY', 'all_proxy']
-    saved_proxies = {}
-    for var in proxy_vars:
-        if var in os.environ:
-            saved_proxies[var] = os.environ[var]
-            del os.environ[var]
-    
-    try:
-        client = OpenAI(api_key=settings.openai_api_key)
-    finally:
-        # Восстанавливаем прокси переменные
-        for var, value in saved_proxies.items():
-            os.environ[var] = value
-    
-    system_prompt = """You are an expert fitness and nutrition coach specializing in body composition management.
-Your task is to provide personalized, practical, and actionable advice for managing body fat percentage.
-
-You must respond ONLY with a valid JSON object in this exact format:
-{
-    "title": "<title in English, e.g., 'Tips for Reducing Body Fat' or 'Recommendations for Maintaining Fitness'>",
-    "sections": [
-        {
-            "title": "<section title in English>",
-            "content": "<detailed content in English, can be multiple paragraphs separated by \\n>",
-            "macros": {
-                "calories": {"min": <number>, "max": <number>, "goal": "<Gain/Lose/Maintain>"},
-                "protein": {"percent": <number 0-100>, "grams": <number>},
-                "carbs": {"percent": <number 0-100>, "grams": <number>},
-                "fats": {"percent": <number 0-100>, "grams": <number>}
-            }
-        }
-    ],
-    
-IMPORTANT for Nutrition section:
-- If the section title is "Nutrition" or contains "Nutrition", you MUST include a "macros" field with:
-  - calories: min and max daily calories, and goal (Gain/Lose/Maintain)
-  - protein, carbs, fats: percentage (0-100) and grams per day
-- Calculate based on the person's weight, age, gender, and body fat goal
-- For other sections, "macros" field is optional and can be omitted
-    "time_estimate": [
-        {"percent": <target body fat %>, "months": <number of months>},
-        {"percent": <next target %>, "months": <number of months>}
-    ]
-}
-
-IMPORTANT for time_estimate:
-- Provide an array of objects with "percent" (target body fat percentage) and "months" (time needed)
-- Example: [{"percent": 20, "months": 2}, {"percent": 18, "months": 4}, {"percent": 15, "months": 6}]
-- Show realistic progression from current to optimal body fat
-- Each step should be achievable and realistic
-
-Rules:
-- title: appropriate title based on whether person needs to reduce, maintain, or increase body fat
-- sections: 3-5 sections covering: nutrition, exercise, lifestyle, specific recommendations
-- content: concise, practical advice in English (approximately 20% shorter than typical, but keep the most essential information), use \\n for line breaks
-- Keep content focused on key actionable points - prioritize the most important recommendations
-- time_estimate: realistic timeframe based on current body fat and target
-- Be encouraging, realistic, and professional
-- Provide specific, actionable recommendations but be concise
-- Do not provide any text outside the JSON object"""
-
-    gender_text = "male" if request.gender == "male" else "female"
-    optimal_range = "15-20%" if request.gender == "male" else "20-25%"
-    target_percent = 18 if request.gender == "male" else 22
-    
-    # Рассчитываем временные рамки по формуле
+def _get_advice_time_estimates(request: AdviceRequest) -> list[dict]:
+    """Time estimates for the advice, always computed locally by formula."""
     # Всегда показываем путь до 10% (атлетический уровень)
     final_target = 10.0  # Целевой процент для всех
-    time_estimates = []
     
     if request.evaluation in ["Above Average", "High"]:
         # Для высокого процента - путь до 10%
-        time_estimates = _calculate_time_estimates(request.body_fat_percent, final_target, request.gender)
+        return _calculate_time_estimates(request.body_fat_percent, final_target, request.gender)
     elif request.evaluation == "Normal":
         # Для нормального - тоже показываем путь до 10%
-        time_estimates = _calculate_time_estimates(request.body_fat_percent, final_target, request.gender)
+        return _calculate_time_estimates(request.body_fat_percent, final_target, request.gender)
     else:
         # Для низкого - показываем путь до 10% (если еще не достигнут)
         if request.body_fat_percent > final_target:
-            time_estimates = _calculate_time_estimates(request.body_fat_percent, final_target, request.gender)
-        else:
-            time_estimates = [{"percent": round(request.body_fat_percent, 1), "months": 0}]
-    
-    user_prompt = f"""Create personalized advice for a {gender_text}, {request.age} years old.
-
-Current situation:
-- Body fat percentage: {request.body_fat_percent}%
-- Evaluation: {request.evaluation}
-- Optimal range for {gender_text}: {optimal_range}
+            return _calculate_time_estimates(request.body_fat_percent, final_target, request.gender)
+        return [{"percent": round(request.body_fat_percent, 1), "months": 0}]
 
-Create concise but comprehensive recommendations (approximately 20% shorter than typical, focusing on the most essential points) that will help:
-1. {"Reduce" if request.body_fat_percent > 10 else "Maintain"} body fat to athletic level (10%)
-2. Improve overall health
-3. Achieve long-term results
 
-Include specific, focused recommendations for:
-- Nutrition (key calories, macronutrients, essential foods - be concise). For Nutrition section, you MUST include "macros" field with:
-  * calories: min/max daily calories and goal (Gain/Lose/Maintain)
-  * protein, carbs, fats: percentage (0-100) and grams per day
-  * Calculate based on person's weight, age, gender, and body fat goal
-- Exercise (type, frequency, intensity - focus on most important)
-- Lifestyle (sleep, stress, hydration - essential points only)
+def _advice_key(request: AdviceRequest) -> str:
+    return "|".join(str(part) for part in (
+        settings.openai_model,
+        request.gender.value,
+        request.age,
+        round(request.body_fat_percent, 1),
+        request.evaluation
+    ))
 
-IMPORTANT: 
-- Keep each section's content approximately 20% shorter than typical advice, but ensure all critical information is included
-- For Nutrition section, always include the "macros" field with calculated values
-- Prioritize the most actionable and important recommendations
 
-IMPORTANT for time_estimate:
-Use EXACTLY this array (calculated using scientific formula):
-{json.dumps(time_estimates, ensure_ascii=False, indent=2)}
+async def generate_advice(request: AdviceRequest) -> AdviceResponse:
+    """
+    Generate personalized advice for body fat management based on current body fat percentage.
+    Concurrent identical requests share one upstream call.
+    """
+    
+    # Если API ключ не установлен, возвращаем заглушку
+    if not settings.openai_api_key:
+        FALLBACKS.inc("advice", "no_api_key")
+        return _get_mock_advice(request)
+    
+    # Большинство запросов обслуживается из библиотеки готовых советов по корзинам
+    started = time.perf_counter()
+    library = get_advice_library()
+    if library is not None:
+        variant = library.lookup(request)
+        if variant is not None:
+            get_tracker("advice").record(time.perf_counter() - started, "library")
+            return AdviceResponse(
+                title=variant["title"],
+                sections=variant["sections"],
+                time_estimate=_get_advice_time_estimates(request)
+            )
+    
+    # Цепь разомкнута - отвечаем заготовкой, не дожидаясь ошибки
+    if get_breaker(settings.openai_model).is_open():
+        get_tracker("advice").record(time.perf_counter() - started, "circuit-open")
+        FALLBACKS.inc("advice", "circuit_open")
+        return _get_mock_advice(request)
+    
+    result = await _advice_flight.do(_advice_key(request), lambda: _llm_advice(request))
+    get_tracker("advice").record(time.perf_counter() - started, "llm")
+    return result
 
-DO NOT modify these values! Copy them exactly as they are into the time_estimate field.
 
-Respond with JSON only."""
+async def _llm_advice(request: AdviceRequest) -> AdviceResponse:
+    """Generate advice with one LLM call, falling back to the mock advice on errors."""
+    # Рассчитываем временные рамки по формуле
+    time_estimates = _get_advice_time_estimates(request)
+    prompt = get_prompt("advice")
 
     try:
-        response = client.chat.completions.create(
+        response = await create_completion(
+            usage_label=prompt.label,
             model=settings.openai_model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
+            messages=prompt.messages(advice_values(request, time_estimates)),
             temperature=0.7,  # Немного выше для более разнообразных советов
             response_format={"type": "json_object"}
         )
@@ -592,22 +638,291 @@ Respond with JSON only."""
         if not content:
             raise Exception("Empty response from OpenAI API")
         
-        result = json.loads(content)
+        result = _parse_json(content, "advice")
         
         # ВСЕГДА используем рассчитанные временные рамки (не доверяем GPT)
         time_estimate = time_estimates if time_estimates else None
         
-        return AdviceResponse(
+        advice = AdviceResponse(
             title=result.get("title", "Personalized Recommendations"),
             sections=result.get("sections", []),
             time_estimate=time_estimate
         )
         
+        # Пополняем библиотеку новым вариантом для этой корзины
+        library = get_advice_library()
+        if library is not None and library.add(library.request_key(request), advice.title, advice.sections):
+            await library.persist()
+        
+        return advice
+        
     except Exception as e:
-        print(f"Error generating advice: {str(e)}")
+        logger.warning("Error generating advice: %s", e)
+        FALLBACKS.inc("advice", "error")
         return _get_mock_advice(request)
 
 
+async def stream_advice(request: AdviceRequest) -> AsyncIterator[tuple[str, Any]]:
+    """
+    Generate advice as a stream of (event, data) pairs.
+    time_estimate is computed locally and comes first; title and every section
+    follow as soon as the model has finished writing them; "done" carries the
+    full AdviceResponse. Library hits and the mock advice are emitted at once.
+    """
+    started = time.perf_counter()
+    time_estimates = _get_advice_time_estimates(request)
+    yield "time_estimate", time_estimates
+    
+    # Готовый вариант (библиотека или заглушка) отдаем сразу целиком
+    variant = None
+    if settings.openai_api_key:
+        library = get_advice_library()
+        if library is not None:
+            variant = library.lookup(request)
+    if variant is None and (not settings.openai_api_key or get_breaker(settings.openai_model).is_open()):
+        FALLBACKS.inc("advice", "no_api_key" if not settings.openai_api_key else "circuit_open")
+        mock = _get_mock_advice(request)
+        variant = {"title": mock.title, "sections": mock.sections}
+    if variant is not None:
+        yield "title", variant["title"]
+        for section in variant["sections"]:
+            yield "section", section
+        get_tracker("advice").record(time.perf_counter() - started, "library")
+        yield "done", AdviceResponse(title=variant["title"], sections=variant["sections"], time_estimate=time_estimates)
+        return
+    
+    prompt = get_prompt("advice")
+    parser = IncrementalJSONParser(stream_arrays=["sections"])
+    title = None
+    sections = []
+    completed = False
+    try:
+        stream = await create_completion(
+            usage_label=prompt.label,
+            model=settings.openai_model,
+            messages=prompt.messages(advice_values(request, time_estimates)),
+            temperature=0.7,
+            response_format={"type": "json_object"},
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            # Последний чанк несет только usage
+            if chunk.usage is not None:
+                record_usage(prompt.label, settings.openai_model, chunk.usage)
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            for kind, key, value in parser.feed(chunk.choices[0].delta.content):
+                if kind == ITEM and key == "sections":
+                    sections.append(value)
+                    yield "section", value
+                elif kind == FIELD and key == "title":
+                    title = value
+                    yield "title", value
+        if not parser.done:
+            raise Exception("Streamed advice JSON is incomplete")
+        completed = True
+    except Exception as e:
+        logger.warning("Error streaming advice: %s", e)
+    
+    # Если модель не успела отдать заголовок или разделы - досылаем их из заглушки
+    if title is None or not sections:
+        FALLBACKS.inc("advice", "error")
+        mock = _get_mock_advice(request)
+        if title is None:
+            title = mock.title
+            yield "title", title
+        if not sections:
+            sections = mock.sections
+            for section in sections:
+                yield "section", section
+    
+    advice = AdviceResponse(title=title, sections=sections, time_estimate=time_estimates)
+    get_tracker("advice").record(time.perf_counter() - started, "llm-stream" if completed else "fallback")
+    yield "done", advice
+    
+    if completed:
+        library = get_advice_library()
+        if library is not None and library.add(library.request_key(request), advice.title, advice.sections):
+            await library.persist()
+
+
+def _calculate_macros(request: BodyFatRequest, body_fat_percent: float, evaluation: str) -> dict:
+    """
+    Daily calories and macros from lean body mass (Katch-McArdle BMR, light activity).
+    Same shape as the "macros" the advice prompt asks the model for.
+    """
+    lean_mass = request.weight * (1 - body_fat_percent / 100)
+    maintenance = (370 + 21.6 * lean_mass) * 1.4
+    # Цель как в советах: снижение до 10%, набор только при очень низком проценте
+    if evaluation == "Very Low":
+        goal, calories = "Gain", maintenance + 250
+    elif body_fat_percent <= 10:
+        goal, calories = "Maintain", maintenance
+    elif evaluation in ("Above Average", "High"):
+        goal, calories = "Lose", maintenance - 400
+    else:
+        goal, calories = "Lose", maintenance - 250
+    calories = max(1500 if request.gender == "male" else 1200, calories)
+    
+    protein_grams = round(2.2 * lean_mass)
+    fats_grams = round(calories * 0.25 / 9)
+    carbs_grams = max(0, round((calories - protein_grams * 4 - fats_grams * 9) / 4))
+    return {
+        "calories": {"min": int(calories - 100), "max": int(calories + 100), "goal": goal},
+        "protein": {"percent": round(protein_grams * 4 * 100 / calories), "grams": protein_grams},
+        "carbs": {"percent": round(carbs_grams * 4 * 100 / calories), "grams": carbs_grams},
+        "fats": {"percent": round(fats_grams * 9 * 100 / calories), "grams": fats_grams}
+    }
+
+
+def _advice_request(request: BodyFatRequest, estimate: BodyFatResponse) -> AdviceRequest:
+    return AdviceRequest(
+        body_fat_percent=estimate.body_fat_percent,
+        gender=request.gender,
+        age=request.age,
+        evaluation=estimate.evaluation or _get_evaluation(estimate.body_fat_percent, request.gender)
+    )
+
+
+def _with_local_figures(request: BodyFatRequest, estimate: BodyFatResponse, title: str, sections: list[dict]) -> BodyFatAdviceResponse:
+    """Estimate + advice, with time estimates and Nutrition macros calculated locally."""
+    advice_request = _advice_request(request, estimate)
+    macros = _calculate_macros(request, estimate.body_fat_percent, advice_request.evaluation)
+    sections = [dict(section) for section in sections]
+    nutrition = next((section for section in sections if "nutrition" in str(section.get("title", "")).lower()), None)
+    if nutrition is not None:
+        nutrition["macros"] = macros
+    return BodyFatAdviceResponse(
+        estimate=estimate,
+        advice=AdviceResponse(title=title, sections=sections, time_estimate=_get_advice_time_estimates(advice_request))
+    )
+
+
+async def local_body_fat_with_advice(request: BodyFatRequest) -> BodyFatAdviceResponse:
+    """
+    Local estimate plus advice for it. The estimate is instant, so the advice
+    (library variant or one advice call) starts right away.
+    """
+    with span("local.estimate"):
+        estimate = estimate_body_fat(request)
+    advice_request = _advice_request(request, estimate)
+    # Варианты объединенного вызова написаны под локальные macros - подходят без изменений
+    library = get_advice_library() if settings.openai_api_key else None
+    variant = library.lookup(advice_request, COMBINED) if library is not None else None
+    if variant is not None:
+        return _with_local_figures(request, estimate, variant["title"], variant["sections"])
+    advice = await generate_advice(advice_request)
+    return _with_local_figures(request, estimate, advice.title, advice.sections)
+
+
+def _local_with_mock_advice(request: BodyFatRequest) -> BodyFatAdviceResponse:
+    estimate = estimate_body_fat(request)
+    advice = _get_mock_advice(_advice_request(request, estimate))
+    return _with_local_figures(request, estimate, advice.title, advice.sections)
+
+
+async def calculate_body_fat_with_advice(
+    request: BodyFatRequest,
+    image_data_list: Optional[list[bytes | BinaryIO]] = None,
+    content_type_list: Optional[list[str]] = None,
+    stage_timings: Optional[dict] = None
+) -> BodyFatAdviceResponse:
+    """
+    Estimate body fat (from the data, or the data and photos) and write the
+    advice for that estimate in one structured LLM call, instead of an
+    estimate call followed by an advice call. Time estimates and macros are
+    calculated locally. A slow call is hedged with the local estimate plus
+    its advice, running in parallel; past the deadline the local estimate
+    with the template advice answers.
+    """
+    image_data_list = image_data_list or []
+    
+    if not settings.openai_api_key:
+        _close_uploads(image_data_list)
+        FALLBACKS.inc("bodyfat_advice", "no_api_key")
+        winner_var.set("fallback")
+        return _local_with_mock_advice(request)
+    
+    # Vision-модель недоступна - оцениваем без фото тем же объединенным вызовом
+    if image_data_list and get_breaker(VISION_MODEL).is_open():
+        logger.warning("Vision circuit is open, estimating without photos")
+        FALLBACKS.inc("bodyfat_advice", "vision_circuit_open")
+        _close_uploads(image_data_list)
+        image_data_list = []
+    
+    # Фото, не прошедшие проверку качества, отброшены; если не осталось ни одного - оценка по параметрам
+    prepared_images = await _prepare_uploads(image_data_list, content_type_list, stage_timings) if image_data_list else []
+    model = VISION_MODEL if prepared_images else settings.openai_model
+    if not prepared_images and get_breaker(model).is_open():
+        winner_var.set("fallback")
+        FALLBACKS.inc("bodyfat_advice", "circuit_open")
+        return await local_body_fat_with_advice(request)
+    
+    if prepared_images:
+        prompt = get_prompt("bodyfat_image_advice")
+        user_text = prompt.user_text(image_values(request, len(prepared_images)))
+        messages = [
+            {"role": "system", "content": prompt.system},
+            {"role": "user", "content": await _vision_content(user_text, prepared_images)}
+        ]
+    else:
+        prompt = get_prompt("bodyfat_advice")
+        messages = prompt.messages(bodyfat_values(request))
+    
+    async def combined_attempt() -> BodyFatAdviceResponse:
+        response = await create_completion(
+            usage_label=prompt.label,
+            model=model,
+            messages=messages,
+            temperature=0.0,  # Стабильность оценки важнее разнообразия советов
+            response_format={"type": "json_object"},
+            seed=42
+        )
+        
+        content = response.choices[0].message.content
+        if not content:
+            raise Exception("Empty response from OpenAI API")
+        
+        result = _parse_json(content, "bodyfat_advice")
+        body_fat_percent = round(max(0, min(100, float(result.get("body_fat_percent", 0)))), 1)
+        sections = [section for section in result.get("sections") or [] if isinstance(section, dict)]
+        if not sections:
+            # Без советов ответ неполный - пусть ответит хедж
+            raise Exception("No advice sections in the response")
+        
+        estimate = BodyFatResponse(
+            body_fat_percent=body_fat_percent,
+            comment=result.get("comment", "Calculation completed."),
+            evaluation=_get_evaluation(body_fat_percent, request.gender)
+        )
+        title = result.get("title", "Personalized Recommendations")
+        combined = _with_local_figures(request, estimate, title, sections)
+        
+        # Пополняем библиотеку ответом модели до подстановки macros этого человека и отдельно от /api/advice,
+        # где Nutrition обязан содержать macros
+        library = get_advice_library()
+        if library is not None:
+            shared = [{key: value for key, value in section.items() if key != "macros"} for section in sections]
+            if library.add(library.request_key(_advice_request(request, estimate), COMBINED), title, shared):
+                await library.persist()
+        return combined
+    
+    images = model == VISION_MODEL
+    result = await hedged_call(
+        "bodyfat_advice",
+        primary=combined_attempt,
+        hedge=(lambda: local_body_fat_with_advice(request)) if settings.llm_hedge_enabled else None,
+        fallback=(lambda: _local_with_mock_advice(request)) if settings.local_fallback_enabled else None,
+        hedge_delay=settings.image_hedge_delay_seconds if images else settings.llm_hedge_delay_seconds,
+        deadline=settings.image_deadline_seconds if images else settings.llm_deadline_seconds
+    )
+    if winner_var.get() == "hedge":
+        # Хедж здесь - локальная оценка (с советами LLM), а не повтор вызова
+        winner_var.set("fallback")
+    return result
+
+
 def _get_mock_advice(request: AdviceRequest) -> AdviceResponse:
     """Mock advice for testing without OpenAI API key"""
     # Всегда рассчитываем до 10% (атлетический уровень)
@@ -0,0 +1,212 @@
+"""
+Local photo quality gate in front of the vision model.
+
+Every uploaded photo gets a few cheap NumPy checks on a small grayscale copy
+(made in the image worker, right after decoding): sharpness as the variance
+of the Laplacian, exposure as mean brightness and the share of clipped
+pixels, the original resolution, and a 256-bit difference hash with the
+16x16 thumbnail it was computed from. Photos that fail a check, and
+repeats of an earlier photo of the same request (hashes within a few bits
+and thumbnails nearly equal, so only the same shot re-uploaded or
+re-encoded matches), are dropped before the gpt-4o call; the dropped
+photos of the current request are in dropped_photos_var for the response.
+If no usable photo remains, the estimate is made without photos, or, with
+photo_quality_gate=reject, the request is rejected so the user can retake
+them. The calls and vision tokens saved are counted.
+"""
+import contextvars
+import math
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from config import settings
+from services.log import get_logger
+from services.metrics import PHOTOS_DROPPED, MetricFamily, register_collector
+
+logger = get_logger("photo_quality")
+
+# Сторона уменьшенной копии для проверок: Laplacian и яркость на ней считаются за ~1 мс
+ANALYSIS_EDGE = 512
+HASH_SIZE = 16
+
+# Фото, отброшенные проверкой в текущем запросе ({"index", "issues"}), - для ответа клиенту
+dropped_photos_var: contextvars.ContextVar[Optional[list[dict]]] = contextvars.ContextVar("dropped_photos", default=None)
+
+
+class PhotoQualityError(Exception):
+    """Raised (photo_quality_gate=reject) when none of the uploaded photos is usable."""
+
+    def __init__(self, issues: list[dict]):
+        self.issues = issues
+        super().__init__("No usable photo: " + "; ".join(
+            f"photo {issue['index'] + 1}: {', '.join(issue['issues'])}" for issue in issues
+        ))
+
+
+@dataclass
+class PhotoQuality:
+    width: int  # Исходное разрешение загрузки
+    height: int
+    sharpness: float  # Дисперсия Laplacian на копии со стороной ANALYSIS_EDGE
+    brightness: float  # Средняя яркость 0-255
+    clipped: float  # Доля пикселей в тенях (<16) или пересветах (>239)
+    dhash: int
+    thumbnail: bytes  # Уменьшенная копия (HASH_SIZE+1)xHASH_SIZE, по которой считался dhash
+    issues: list[str] = field(default_factory=list)
+
+
+def _difference_hash(gray: np.ndarray) -> tuple[int, bytes]:
+    # dHash: 17x16 уменьшение, бит - ярче ли пиксель соседа справа. Уменьшаем в float: после округления
+    # до uint8 соседние пиксели малоконтрастных фото равны, и биты у разных фото совпадают
+    small = np.asarray(Image.fromarray(gray).convert("F").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR))
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big"), np.round(small).astype(np.uint8).tobytes()
+
+
+def assess(img: Image.Image, original_size: tuple[int, int]) -> PhotoQuality:
+    """Quality checks of a decoded image. Runs in the image worker; does not modify img."""
+    gray_img = img.convert("L")
+    factor = math.ceil(max(gray_img.size) / ANALYSIS_EDGE)
+    if factor > 1:
+        # Целочисленное уменьшение (усреднение блоков) в разы быстрее ресемплинга
+        gray_img = gray_img.reduce(factor)
+    gray = np.asarray(gray_img, dtype=np.uint8)
+    g = gray.astype(np.float32)
+
+    # Laplacian 4-соседей без свертки: сумма сдвигов минус 4x центр
+    if g.shape[0] >= 3 and g.shape[1] >= 3:
+        laplacian = g[:-2, 1:-1] + g[2:, 1:-1] + g[1:-1, :-2] + g[1:-1, 2:] - 4 * g[1:-1, 1:-1]
+        sharpness = float(laplacian.var())
+    else:
+        sharpness = 0.0
+    brightness = float(g.mean())
+    clipped = float(np.count_nonzero((gray < 16) | (gray > 239)) / gray.size)
+
+    width, height = original_size
+    dhash, thumbnail = _difference_hash(gray)
+    quality = PhotoQuality(
+        width=width,
+        height=height,
+        sharpness=round(sharpness, 1),
+        brightness=round(brightness, 1),
+        clipped=round(clipped, 3),
+        dhash=dhash,
+        thumbnail=thumbnail
+    )
+    if min(width, height) < settings.photo_quality_min_side:
+        quality.issues.append("low_resolution")
+    if brightness < settings.photo_quality_min_brightness:
+        quality.issues.append("too_dark")
+    elif brightness > settings.photo_quality_max_brightness:
+        quality.issues.append("overexposed")
+    elif clipped > settings.photo_quality_max_clipped:
+        quality.issues.append("poor_exposure")
+    # У плохо экспонированного фото мал контраст и дисперсия Laplacian - резкость оцениваем только при нормальной экспозиции
+    elif sharpness < settings.photo_quality_min_sharpness:
+        quality.issues.append("blurry")
+    return quality
+
+
+def _hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def is_duplicate(a: PhotoQuality, b: PhotoQuality) -> bool:
+    """
+    Same shot: the hashes differ in at most photo_quality_duplicate_distance
+    bits and the thumbnails in photo_quality_duplicate_max_diff on average.
+    Gradient bits of flat or low-contrast photos are close for any content,
+    so the thumbnail check keeps different views from matching.
+    """
+    if _hamming(a.dhash, b.dhash) > settings.photo_quality_duplicate_distance:
+        return False
+    diff = np.abs(np.frombuffer(a.thumbnail, np.uint8).astype(np.int16) - np.frombuffer(b.thumbnail, np.uint8))
+    return float(diff.mean()) <= settings.photo_quality_duplicate_max_diff
+
+
+_stats = {
+    "photos_checked": 0,
+    "photos_dropped": 0,
+    "vision_calls_saved": 0,
+    "vision_tokens_saved": 0,
+    "requests_rejected": 0,
+}
+
+
+def apply_gate(prepared_images: list) -> tuple[list, list[dict]]:
+    """
+    Split the prepared images of a request into usable ones and dropped ones
+    ({"index", "issues"}), also stored in dropped_photos_var.
+    Raises PhotoQualityError in reject mode if none is usable.
+    """
+    dropped_photos_var.set([])
+    if settings.photo_quality_gate == "off":
+        return prepared_images, []
+    kept = []
+    dropped = []
+    for index, image in enumerate(prepared_images):
+        quality = image.quality
+        _stats["photos_checked"] += 1
+        if quality is None:
+            # Не удалось декодировать - решать будет модель
+            kept.append(image)
+            continue
+        issues = list(quality.issues)
+        if not issues and any(is_duplicate(quality, other.quality) for other in kept if other.quality is not None):
+            issues.append("duplicate")
+        if issues:
+            dropped.append({"index": index, "issues": issues, "tokens": image.estimated_tokens})
+        else:
+            kept.append(image)
+
+    if not dropped:
+        return kept, []
+    dropped_photos_var.set([{"index": item["index"], "issues": item["issues"]} for item in dropped])
+    for item in dropped:
+        _stats["photos_dropped"] += 1
+        _stats["vision_tokens_saved"] += item["tokens"]
+        for issue in item["issues"]:
+            PHOTOS_DROPPED.inc(issue)
+    if not kept:
+        if settings.photo_quality_gate == "reject":
+            _stats["requests_rejected"] += 1
+            raise PhotoQualityError(dropped)
+        # Фото не осталось - оценка без vision вызова
+        _stats["vision_calls_saved"] += 1
+    logger.info("Photos dropped by the quality gate", extra={
+        "dropped": dropped, "kept": len(kept), "gate": settings.photo_quality_gate,
+    })
+    return kept, dropped
+
+
+def get_photo_quality_stats() -> dict:
+    return {
+        "gate": settings.photo_quality_gate,
+        "thresholds": {
+            "min_side": settings.photo_quality_min_side,
+            "min_sharpness": settings.photo_quality_min_sharpness,
+            "min_brightness": settings.photo_quality_min_brightness,
+            "max_brightness": settings.photo_quality_max_brightness,
+            "max_clipped": settings.photo_quality_max_clipped,
+            "duplicate_distance": settings.photo_quality_duplicate_distance,
+            "duplicate_max_diff": settings.photo_quality_duplicate_max_diff,
+        },
+        **_stats,
+    }
+
+
+def _collect_metrics() -> list[MetricFamily]:
+    return [
+        MetricFamily("bodyfat_vision_calls_saved_total", "counter",
+                     "Vision calls skipped because no uploaded photo passed the quality gate.",
+                     samples={(): _stats["vision_calls_saved"]}),
+        MetricFamily("bodyfat_vision_tokens_saved_total", "counter",
+                     "Estimated vision input tokens of photos dropped by the quality gate.",
+                     samples={(): _stats["vision_tokens_saved"]}),
+    ]
+
+
+register_collector(_collect_metrics)
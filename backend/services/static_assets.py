@@ -0,0 +1,234 @@
+"""
+In-memory serving of the web UI.
+
+All files under web/ are read once at startup, precompressed with gzip (and
+brotli, if the brotli package is installed) and served from memory with a
+strong ETag per representation, Cache-Control and Vary: Accept-Encoding.
+Conditional requests with a matching If-None-Match get an empty 304.
+With static_watch enabled (development), a background task polls the files
+and reloads the ones that changed.
+"""
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from typing import Optional
+
+from fastapi import Request, Response
+
+from config import settings
+from services.log import get_logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = get_logger("static")
+
+# Сжимаем только текстовые форматы: картинки и шрифты уже сжаты
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/xml")
+MIN_COMPRESS_BYTES = 256
+# Суффикс ETag сжатого представления: у разных кодировок разные сильные ETag
+ETAG_SUFFIXES = {"gzip": "-gz", "br": "-br"}
+
+
+@dataclass
+class StaticAsset:
+    content_type: str
+    body: bytes
+    etag: str  # Без кавычек; у сжатых вариантов добавляется суффикс -gz / -br
+    last_modified: str
+    mtime: float
+    encoded: dict[str, bytes] = field(default_factory=dict)  # gzip / br -> тело
+
+
+def _compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def load_asset(path: str) -> StaticAsset:
+    """Read a file and precompress it."""
+    with open(path, "rb") as f:
+        body = f.read()
+    mtime = os.path.getmtime(path)
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+        content_type += "; charset=utf-8"
+    asset = StaticAsset(
+        content_type=content_type,
+        body=body,
+        etag=hashlib.sha256(body).hexdigest()[:32],
+        last_modified=formatdate(mtime, usegmt=True),
+        mtime=mtime
+    )
+    if _compressible(content_type) and len(body) >= MIN_COMPRESS_BYTES:
+        # mtime=0 - одинаковый вывод при одинаковом содержимом
+        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(compressed) < len(body):
+            asset.encoded["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                asset.encoded["br"] = compressed
+    return asset
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        # q=0 означает явный отказ от кодировки
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        # Любое представление того же содержимого (обычное или сжатое) считается совпадением
+        if candidate.strip('"').split("-", 1)[0] == etag:
+            return True
+    return False
+
+
+class StaticAssets:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.assets: dict[str, StaticAsset] = {}
+        self.reloads = 0
+
+    def load(self) -> None:
+        assets = {}
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    relative = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                    assets[relative] = load_asset(path)
+        self.assets = assets
+        logger.info("Static assets loaded", extra={
+            "directory": self.directory,
+            "files": len(assets),
+            "bytes": sum(len(asset.body) for asset in assets.values()),
+            "gzip_bytes": sum(len(asset.encoded.get("gzip", asset.body)) for asset in assets.values()),
+            "brotli": brotli is not None,
+        })
+
+    def reload_changed(self) -> int:
+        """Reload files whose mtime changed, pick up new and drop deleted ones. Returns the number of changes."""
+        current = {}
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    current[os.path.relpath(path, self.directory).replace(os.sep, "/")] = path
+        changed = 0
+        for relative, path in current.items():
+            asset = self.assets.get(relative)
+            if asset is None or os.path.getmtime(path) != asset.mtime:
+                self.assets[relative] = load_asset(path)
+                changed += 1
+        for relative in set(self.assets) - set(current):
+            del self.assets[relative]
+            changed += 1
+        if changed:
+            self.reloads += changed
+            logger.info("Static assets reloaded", extra={"changed": changed})
+        return changed
+
+    def get(self, relative: str) -> Optional[StaticAsset]:
+        return self.assets.get(relative)
+
+    def response(self, request: Request, asset: StaticAsset, cache_control: str) -> Response:
+        """200 with the best accepted encoding, or 304 if the client already has this content."""
+        encoding = None
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        for candidate in ("br", "gzip"):
+            if candidate in asset.encoded and candidate in accepted:
+                encoding = candidate
+                break
+        etag = f'"{asset.etag}{ETAG_SUFFIXES.get(encoding, "")}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": cache_control,
+            "Last-Modified": asset.last_modified,
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, asset.etag):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(asset.encoded[encoding] if encoding else asset.body, headers=headers, media_type=asset.content_type)
+
+    def snapshot(self) -> dict:
+        return {
+            "directory": self.directory,
+            "files": len(self.assets),
+            "bytes": sum(len(asset.body) for asset in self.assets.values()),
+            "encoded_bytes": {
+                encoding: sum(len(asset.encoded[encoding]) for asset in self.assets.values() if encoding in asset.encoded)
+                for encoding in ("gzip", "br")
+            },
+            "brotli_available": brotli is not None,
+            "watch": settings.static_watch,
+            "reloads": self.reloads,
+        }
+
+
+_assets: Optional[StaticAssets] = None
+_watch_task: Optional[asyncio.Task] = None
+
+
+async def _watch(assets: StaticAssets) -> None:
+    while True:
+        await asyncio.sleep(settings.static_watch_interval_seconds)
+        try:
+            await asyncio.to_thread(assets.reload_changed)
+        except OSError as e:
+            logger.warning("Static asset reload failed: %s", e)
+
+
+def default_directory() -> str:
+    # Папка web в корне проекта, рядом с backend
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(os.path.dirname(backend_dir), "web")
+
+
+def get_static_assets() -> StaticAssets:
+    global _assets
+    if _assets is None:
+        _assets = StaticAssets(settings.static_dir or default_directory())
+        _assets.load()
+    return _assets
+
+
+async def startup() -> None:
+    """Load and precompress the assets. Called from the FastAPI lifespan hook."""
+    global _watch_task
+    assets = await asyncio.to_thread(get_static_assets)
+    if settings.static_watch and _watch_task is None:
+        _watch_task = asyncio.create_task(_watch(assets))
+
+
+async def shutdown() -> None:
+    global _watch_task
+    if _watch_task is not None:
+        _watch_task.cancel()
+        _watch_task = None
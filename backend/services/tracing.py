@@ -0,0 +1,330 @@
+"""
+Opt-in per-request tracing and profiling.
+
+TracingMiddleware attaches a Trace to a sampled fraction of requests
+(tracing_sample_rate, or any request sent with "X-Trace: 1" while tracing is
+enabled). Code on the request path opens spans with `with span("llm.call"):`;
+without an active trace span() is a no-op costing one ContextVar lookup.
+Finished traces are appended to tracing_path as Chrome trace events (open in
+chrome://tracing or Perfetto) or as OTLP JSON lines, from a background
+writer thread.
+
+With profile_sample_rate > 0 the middleware also runs cProfile on that
+fraction of requests and saves one .prof file per request into profile_dir
+(view with snakeviz or pstats). cProfile sees the whole event loop thread,
+so other requests running concurrently show up in the profile too; only
+one request is profiled at a time.
+"""
+import asyncio
+import contextvars
+import cProfile
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from config import settings
+from services.log import get_logger, request_id_var
+
+logger = get_logger("tracing")
+
+_UNSAFE_FILENAME = re.compile(r"[^A-Za-z0-9_-]")
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start_ns", "end_ns", "attrs", "lane")
+
+    def __init__(self, span_id: int, parent_id: Optional[int], name: str, start_ns: int, lane: int, attrs: dict):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = start_ns
+        self.end_ns = start_ns
+        self.attrs = attrs
+        self.lane = lane
+
+
+class Trace:
+    """Spans of one request. Times are wall-clock nanoseconds (time.time_ns)."""
+
+    def __init__(self, trace_id: str, name: str):
+        self.trace_id = trace_id
+        self.spans: list[Span] = []
+        self._ids = itertools.count(1)
+        # Дорожки (tid в Chrome trace): отдельная для каждой asyncio задачи и каждого фото в воркере
+        self._lanes: dict = {}
+        self.root = self.start(name, None, lane_key="request")
+
+    def lane(self, key) -> int:
+        if key not in self._lanes:
+            self._lanes[key] = len(self._lanes) + 1
+        return self._lanes[key]
+
+    def start(self, name: str, parent: Optional[Span], lane_key=None, start_ns: Optional[int] = None, **attrs) -> Span:
+        span = Span(
+            next(self._ids),
+            parent.span_id if parent is not None else None,
+            name,
+            start_ns if start_ns is not None else time.time_ns(),
+            self.lane(lane_key),
+            attrs
+        )
+        self.spans.append(span)
+        return span
+
+
+# Активная трассировка и текущий родительский спан запроса
+trace_var: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+_span_var: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("trace_span", default=None)
+
+
+def _task_key():
+    # Параллельные попытки (хедж) и фото идут в разных задачах - у каждой своя дорожка
+    try:
+        return id(asyncio.current_task())
+    except RuntimeError:
+        return threading.get_ident()
+
+
+class span:
+    """Context manager timing a stage of the current request (no-op when not traced)."""
+    __slots__ = ("name", "attrs", "_span", "_token")
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self._span = None
+
+    def __enter__(self) -> Optional[Span]:
+        trace = trace_var.get()
+        if trace is None:
+            return None
+        self._span = trace.start(self.name, _span_var.get() or trace.root, lane_key=_task_key(), **self.attrs)
+        self._token = _span_var.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self._span is None:
+            return
+        self._span.end_ns = time.time_ns()
+        if exc_type is not None:
+            self._span.attrs["error"] = exc_type.__name__
+        _span_var.reset(self._token)
+
+
+def record_stages(name: str, start_ns: int, timings_ms: dict, lane_key, **attrs) -> None:
+    """
+    Add spans for stages measured elsewhere (e.g. in an image worker) from
+    their durations: a parent span `name` and one child per stage, laid out
+    back to back from start_ns.
+    """
+    trace = trace_var.get()
+    if trace is None:
+        return
+    parent = trace.start(name, _span_var.get() or trace.root, lane_key=lane_key, start_ns=start_ns, **attrs)
+    cursor = start_ns
+    for stage, duration_ms in timings_ms.items():
+        child = trace.start(f"{name}.{stage}", parent, lane_key=lane_key, start_ns=cursor)
+        cursor += int(duration_ms * 1_000_000)
+        child.end_ns = cursor
+    parent.end_ns = max(cursor, time.time_ns())
+
+
+def _chrome_events(trace: Trace) -> list[dict]:
+    pid = os.getpid()
+    return [
+        {
+            "name": s.name,
+            "cat": "bodyfat",
+            "ph": "X",
+            "ts": s.start_ns / 1000,
+            "dur": max(0, s.end_ns - s.start_ns) / 1000,
+            "pid": pid,
+            "tid": s.lane,
+            "args": {"trace_id": trace.trace_id, **s.attrs},
+        }
+        for s in trace.spans
+    ]
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_request(trace: Trace) -> dict:
+    # OTLP требует 16-байтовый trace id и 8-байтовые span id в hex
+    trace_id = uuid.uuid5(uuid.NAMESPACE_OID, trace.trace_id).hex
+    spans = []
+    for s in trace.spans:
+        item = {
+            "traceId": trace_id,
+            "spanId": f"{s.span_id:016x}",
+            "name": s.name,
+            "kind": 2 if s.parent_id is None else 1,  # SERVER для корня, INTERNAL для этапов
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in s.attrs.items()],
+        }
+        if s.parent_id is not None:
+            item["parentSpanId"] = f"{s.parent_id:016x}"
+        spans.append(item)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "bodyfatai-backend"}}]},
+            "scopeSpans": [{"scope": {"name": "bodyfat.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+# Файлы пишет один фоновый поток - запросы не ждут диска
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-writer")
+_stats = {"traced": 0, "profiled": 0, "profile_skipped_busy": 0, "export_errors": 0}
+
+
+def _ensure_parent_dir(path: str) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def _write_trace(trace: Trace, fmt: str, path: str) -> None:
+    try:
+        _ensure_parent_dir(path)
+        if fmt == "otlp":
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(_otlp_request(trace)) + "\n")
+            return
+        # Chrome trace: JSON массив без закрывающей скобки - формат это допускает, файл можно дописывать
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a", encoding="utf-8") as f:
+            if new_file:
+                f.write("[\n")
+            for event in _chrome_events(trace):
+                f.write(json.dumps(event) + ",\n")
+    except OSError:
+        _stats["export_errors"] += 1
+        logger.exception("Could not write trace to %s", path)
+
+
+def export(trace: Trace) -> None:
+    _stats["traced"] += 1
+    _writer.submit(_write_trace, trace, settings.tracing_format, settings.tracing_path)
+
+
+def _write_profile(profiler: cProfile.Profile, path: str) -> None:
+    try:
+        _ensure_parent_dir(path)
+        profiler.dump_stats(path)
+    except OSError:
+        _stats["export_errors"] += 1
+        logger.exception("Could not write profile to %s", path)
+
+
+_profiling = False
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that traces and/or profiles a sampled fraction of requests.
+    Must run inside RequestIDMiddleware so traces carry the request ID.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def _traced(self, scope) -> bool:
+        if not settings.tracing_enabled:
+            return False
+        for name, value in scope["headers"]:
+            if name == b"x-trace" and value == b"1":
+                return True
+        return random.random() < settings.tracing_sample_rate
+
+    async def __call__(self, scope, receive, send):
+        global _profiling
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        traced = self._traced(scope)
+        profiled = settings.profile_sample_rate > 0 and random.random() < settings.profile_sample_rate
+        if profiled and _profiling:
+            # cProfile не может профилировать два запроса одновременно в одном потоке
+            _stats["profile_skipped_busy"] += 1
+            profiled = False
+        if not traced and not profiled:
+            await self.app(scope, receive, send)
+            return
+
+        request_id = request_id_var.get() or uuid.uuid4().hex[:16]
+        trace = Trace(request_id, f"{scope['method']} {scope['path']}") if traced else None
+        trace_token = trace_var.set(trace)
+        state = {"response_start": None, "send": None}
+
+        async def send_wrapper(message):
+            if trace is not None and message["type"] == "http.response.start":
+                state["response_start"] = time.time_ns()
+                trace.root.attrs["http.status_code"] = message["status"]
+                # Время после последнего отмеченного этапа - валидация модели ответа и сериализация
+                last_end = max((s.end_ns for s in trace.spans if s is not trace.root), default=trace.root.start_ns)
+                build = trace.start("response.build", trace.root, lane_key="request", start_ns=min(last_end, state["response_start"]))
+                build.end_ns = state["response_start"]
+                state["send"] = trace.start("response.send", trace.root, lane_key="request")
+            await send(message)
+            if state["send"] is not None and message["type"] == "http.response.body" and not message.get("more_body"):
+                state["send"].end_ns = time.time_ns()
+
+        profiler = None
+        if profiled:
+            profiler = cProfile.Profile()
+            _profiling = True
+            profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                _profiling = False
+                _stats["profiled"] += 1
+                # X-Request-ID приходит от клиента - в имени файла только безопасные символы
+                name = _UNSAFE_FILENAME.sub("", request_id)[:64] or uuid.uuid4().hex[:16]
+                path = os.path.join(settings.profile_dir, f"{int(time.time())}-{name}.prof")
+                _writer.submit(_write_profile, profiler, path)
+            trace_var.reset(trace_token)
+            if trace is not None:
+                trace.root.end_ns = time.time_ns()
+                trace.root.attrs.update({"http.method": scope["method"], "http.route": _route(scope)})
+                export(trace)
+
+
+def _route(scope) -> str:
+    route = scope.get("route")
+    return route.path if route is not None else scope["path"]
+
+
+def get_tracing_stats() -> dict:
+    return {
+        "tracing_enabled": settings.tracing_enabled,
+        "tracing_sample_rate": settings.tracing_sample_rate,
+        "tracing_format": settings.tracing_format,
+        "tracing_path": settings.tracing_path,
+        "profile_sample_rate": settings.profile_sample_rate,
+        "profile_dir": settings.profile_dir,
+        **_stats,
+    }
+
+
+def flush() -> None:
+    """Wait for pending trace and profile writes. Called from the FastAPI lifespan hook."""
+    _writer.submit(lambda: None).result()
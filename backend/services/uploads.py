@@ -0,0 +1,211 @@
+"""
+Streaming multipart ingestion for /api/bodyfat.
+
+The request body is fed chunk by chunk into python-multipart. File parts are
+written straight into spooled temporary files (small ones stay in memory,
+large ones roll over to disk), and per-file / per-request byte limits are
+enforced while streaming, so oversized uploads are rejected before they are
+fully received. Urlencoded forms are read under the same per-request limit.
+"""
+from dataclasses import dataclass, field
+from tempfile import SpooledTemporaryFile
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from fastapi import Request
+
+from config import settings
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+
+class UploadTooLargeError(Exception):
+    """Raised when a file or the whole request exceeds the configured byte limits."""
+
+
+class UploadFormatError(Exception):
+    """Raised for malformed multipart bodies."""
+
+
+@dataclass
+class UploadedFile:
+    field_name: str
+    filename: str
+    content_type: str
+    file: SpooledTemporaryFile
+    size: int = 0
+
+    def close(self) -> None:
+        self.file.close()
+
+
+@dataclass
+class ParsedForm:
+    fields: dict[str, str] = field(default_factory=dict)
+    files: list[UploadedFile] = field(default_factory=list)
+
+    def get_files(self, field_name: str) -> list[UploadedFile]:
+        return [f for f in self.files if f.field_name == field_name]
+
+    def close(self) -> None:
+        """Release spooled buffers and temporary files."""
+        for uploaded in self.files:
+            uploaded.close()
+        self.files = []
+
+
+class _StreamingFormParser:
+    def __init__(self, max_file_bytes: int, max_files: int, max_field_bytes: int = 64 * 1024):
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.max_field_bytes = max_field_bytes
+        self.form = ParsedForm()
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: dict[bytes, bytes] = {}
+        self._current_file: Optional[UploadedFile] = None
+        self._current_name = ""
+        self._current_value = bytearray()
+
+    # Колбэки python-multipart (вызываются синхронно во время parser.write)
+    def on_part_begin(self) -> None:
+        self._headers = {}
+        self._current_file = None
+        self._current_value = bytearray()
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise UploadFormatError("Multipart part without a field name")
+        self._current_name = options[b"name"].decode("utf-8", errors="replace")
+        if b"filename" in options:
+            if len(self.form.files) >= self.max_files:
+                raise UploadTooLargeError(f"Too many files (limit {self.max_files})")
+            content_type = self._headers.get(b"content-type", b"application/octet-stream").decode("latin-1")
+            self._current_file = UploadedFile(
+                field_name=self._current_name,
+                filename=options[b"filename"].decode("utf-8", errors="replace"),
+                content_type=content_type,
+                file=SpooledTemporaryFile(max_size=settings.upload_spool_bytes)
+            )
+            self.form.files.append(self._current_file)
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        chunk = data[start:end]
+        if self._current_file is not None:
+            self._current_file.size += len(chunk)
+            if self._current_file.size > self.max_file_bytes:
+                raise UploadTooLargeError(
+                    f"File '{self._current_file.filename}' exceeds {self.max_file_bytes} bytes"
+                )
+            self._current_file.file.write(chunk)
+        else:
+            self._current_value += chunk
+            if len(self._current_value) > self.max_field_bytes:
+                raise UploadTooLargeError(f"Field '{self._current_name}' is too large")
+
+    def on_part_end(self) -> None:
+        if self._current_file is not None:
+            self._current_file.file.seek(0)
+        else:
+            self.form.fields[self._current_name] = self._current_value.decode("utf-8", errors="replace")
+        self._current_file = None
+        self._current_value = bytearray()
+
+
+def check_content_length(request: Request, max_bytes: int) -> None:
+    """Reject a request whose declared Content-Length is already over max_bytes."""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise UploadTooLargeError(f"Request body exceeds {max_bytes} bytes")
+
+
+async def read_body(request: Request, max_bytes: Optional[int] = None) -> bytes:
+    """
+    Read a (small, non-multipart) request body into memory, raising
+    UploadTooLargeError as soon as it exceeds max_bytes.
+    """
+    max_bytes = max_bytes or settings.upload_max_request_bytes
+    check_content_length(request, max_bytes)
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            raise UploadTooLargeError(f"Request body exceeds {max_bytes} bytes")
+    return bytes(body)
+
+
+async def parse_urlencoded(request: Request, max_bytes: Optional[int] = None) -> ParsedForm:
+    """Read an application/x-www-form-urlencoded body within max_bytes into a ParsedForm."""
+    body = await read_body(request, max_bytes)
+    try:
+        pairs = parse_qsl(body.decode("utf-8"), keep_blank_values=True)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise UploadFormatError(f"Malformed form body: {str(e)}")
+    return ParsedForm(fields=dict(pairs))
+
+
+async def parse_multipart(
+    request: Request,
+    max_file_bytes: Optional[int] = None,
+    max_request_bytes: Optional[int] = None,
+    max_files: Optional[int] = None
+) -> ParsedForm:
+    """
+    Stream a multipart/form-data body into a ParsedForm.
+    Raises UploadTooLargeError as soon as a limit is exceeded.
+    """
+    max_file_bytes = max_file_bytes or settings.upload_max_file_bytes
+    max_request_bytes = max_request_bytes or settings.upload_max_request_bytes
+    max_files = max_files or settings.upload_max_files
+
+    # Отклоняем заведомо большие запросы еще до чтения тела
+    check_content_length(request, max_request_bytes)
+
+    _, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise UploadFormatError("Missing multipart boundary")
+
+    state = _StreamingFormParser(max_file_bytes, max_files)
+    parser = MultipartParser(boundary, {
+        "on_part_begin": state.on_part_begin,
+        "on_part_data": state.on_part_data,
+        "on_part_end": state.on_part_end,
+        "on_header_field": state.on_header_field,
+        "on_header_value": state.on_header_value,
+        "on_header_end": state.on_header_end,
+        "on_headers_finished": state.on_headers_finished,
+    })
+
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_request_bytes:
+                raise UploadTooLargeError(f"Request body exceeds {max_request_bytes} bytes")
+            if chunk:
+                parser.write(chunk)
+        parser.finalize()
+    except (UploadTooLargeError, UploadFormatError):
+        state.form.close()
+        raise
+    except Exception as e:
+        state.form.close()
+        raise UploadFormatError(f"Malformed multipart body: {str(e)}")
+
+    return state.form
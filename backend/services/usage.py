@@ -0,0 +1,74 @@
+"""
+Token accounting per call, prompt variant and model.
+
+Every completion records prompt, completion and cached prompt tokens from
+response.usage, so the effect of prompt changes is visible in
+/api/stats/tokens. Cached tokens stay at zero while the prompts are shorter
+than the 1024-token caching minimum.
+"""
+from typing import Any
+
+from services.metrics import MetricFamily, register_collector
+
+
+class TokenUsage:
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, usage: Any) -> None:
+        self.calls += 1
+        self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+        self.cached_tokens += cached_tokens(usage)
+
+    def snapshot(self) -> dict:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+            "avg_prompt_tokens": round(self.prompt_tokens / self.calls, 1) if self.calls else 0.0,
+            "avg_completion_tokens": round(self.completion_tokens / self.calls, 1) if self.calls else 0.0,
+        }
+
+
+def cached_tokens(usage: Any) -> int:
+    # prompt_tokens_details есть не у всех моделей и совместимых серверов
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+
+
+_usage: dict[str, TokenUsage] = {}
+
+
+def record_usage(label: str, model: str, usage: Any) -> None:
+    if usage is None:
+        return
+    key = f"{label}|{model}"
+    if key not in _usage:
+        _usage[key] = TokenUsage()
+    _usage[key].record(usage)
+
+
+def get_usage_stats() -> dict:
+    return {key: usage.snapshot() for key, usage in _usage.items()}
+
+
+def _collect_metrics() -> list[MetricFamily]:
+    samples = {}
+    for key, usage in _usage.items():
+        label, model = key.rsplit("|", 1)
+        samples[(label, model, "prompt")] = usage.prompt_tokens
+        samples[(label, model, "completion")] = usage.completion_tokens
+        samples[(label, model, "cached")] = usage.cached_tokens
+    return [
+        MetricFamily("bodyfat_llm_tokens_total", "counter", "Tokens by call, model and kind (prompt, completion, cached).",
+                     ("call", "model", "kind"), samples),
+    ]
+
+
+register_collector(_collect_metrics)
@@ -0,0 +1,189 @@
+"""
+Layout of a request's photos in the vision message.
+
+By default every prepared photo is attached as its own image_url part, and
+each part is billed as its own set of 512px tiles. Two optional settings
+trade detail for tokens:
+    image_detail=heuristic   per-photo detail: low for photos that fit in one
+                             tile or are soft (high detail adds tiles, not
+                             information), high for the sharpest
+                             image_high_detail_max photos, low for the rest
+    image_mosaic_enabled     compose the photos into one labelled mosaic,
+                             sized so the model does not rescale it and its
+                             edges fall on tile boundaries where possible;
+                             used only when it costs fewer tokens than the
+                             separate parts and every photo keeps at least
+                             image_mosaic_min_cell px on its long side
+Estimated vision tokens before and after the layout are counted.
+"""
+import math
+from dataclasses import dataclass
+from typing import Optional
+
+from config import settings
+from services.image_processing import BASE_TOKENS, TILE_SIZE, TILE_TOKENS, PreparedImage, estimate_vision_tokens
+from services.image_workers import build_mosaic
+from services.log import get_logger
+from services.metrics import MetricFamily, register_collector
+
+logger = get_logger("vision_layout")
+
+# Границы, к которым модель приводит high-detail изображение
+MAX_EDGE = 2048
+MAX_SHORT_SIDE = 768
+
+
+@dataclass
+class MosaicPlan:
+    cols: int
+    rows: int
+    width: int
+    height: int
+    tokens: int
+
+    @property
+    def cell_long_side(self) -> int:
+        return max(self.width // self.cols, self.height // self.rows)
+
+
+_stats = {
+    "requests": 0,
+    "mosaics": 0,
+    "parts_low": 0,
+    "parts_high": 0,
+    "parts_auto": 0,
+    "tokens_separate": 0,
+    "tokens_sent": 0,
+}
+
+
+def _sharpness(image: PreparedImage) -> float:
+    return image.quality.sharpness if image.quality is not None else 0.0
+
+
+def choose_details(prepared_images: list[PreparedImage]) -> list[Optional[str]]:
+    """Detail level of each photo's image_url part (None - the field is not sent)."""
+    mode = settings.image_detail
+    if mode == "default":
+        return [None] * len(prepared_images)
+    if mode != "heuristic":
+        return [mode] * len(prepared_images)
+
+    details = []
+    for image in prepared_images:
+        if not image.width:
+            # Фото не декодировалось - размер неизвестен, решает модель
+            details.append("auto")
+        elif max(image.width, image.height) <= TILE_SIZE:
+            # Помещается в один тайл: в high те же пиксели, но на 170 токенов дороже
+            details.append("low")
+        elif image.quality is not None and image.quality.sharpness < 2 * settings.photo_quality_min_sharpness:
+            # Мягкое фото: мелких деталей для тайлов в нем нет
+            details.append("low")
+        else:
+            details.append("high")
+
+    high = [index for index, detail in enumerate(details) if detail == "high"]
+    if len(high) > settings.image_high_detail_max:
+        # В high оставляем самые резкие фото, порядок загрузки при равной резкости
+        high.sort(key=lambda index: -_sharpness(prepared_images[index]))
+        for index in high[settings.image_high_detail_max:]:
+            details[index] = "low"
+    return details
+
+
+def _model_size(ratio: float) -> tuple[float, float]:
+    # Размер, к которому модель сама приведет изображение с отношением сторон ratio
+    if ratio >= 1:
+        width, height = MAX_SHORT_SIDE * ratio, MAX_SHORT_SIDE
+    else:
+        width, height = MAX_SHORT_SIDE, MAX_SHORT_SIDE / ratio
+    scale = min(1.0, MAX_EDGE / max(width, height))
+    return width * scale, height * scale
+
+
+def plan_mosaic(sizes: list[tuple[int, int]]) -> Optional[MosaicPlan]:
+    """
+    Cheapest grid for photos of the given sizes (in vision tokens) that keeps
+    every photo at least image_mosaic_min_cell px on its long side, or None.
+    Cells share the median aspect ratio of the photos.
+    """
+    count = len(sizes)
+    aspect = sorted(width / height for width, height in sizes)[count // 2]
+    longest = max(max(width, height) for width, height in sizes)
+    best = None
+    for cols in range(1, count + 1):
+        rows = math.ceil(count / cols)
+        if cols * rows - count >= cols:
+            # Пустая строка ячеек - тот же вариант с меньшим числом колонок
+            continue
+        width, height = _model_size(cols * aspect / rows)
+        candidates = [(width, height)]
+        # Подрезаем сторону до границы тайла: последний неполный тайл стоит столько же, сколько полный
+        for side in (width, height):
+            snapped = math.floor(side / TILE_SIZE) * TILE_SIZE
+            if TILE_SIZE <= snapped < side:
+                candidates.append((width * snapped / side, height * snapped / side))
+        for width, height in candidates:
+            # Фото в ячейке не увеличиваем сверх их размера
+            scale = min(1.0, longest / max(width / cols, height / rows))
+            plan_width, plan_height = int(width * scale), int(height * scale)
+            tiles = math.ceil(plan_width / TILE_SIZE) * math.ceil(plan_height / TILE_SIZE)
+            plan = MosaicPlan(cols, rows, plan_width, plan_height, BASE_TOKENS + TILE_TOKENS * tiles)
+            if plan.cell_long_side < settings.image_mosaic_min_cell:
+                continue
+            if best is None or (plan.tokens, -plan.width * plan.height) < (best.tokens, -best.width * best.height):
+                best = plan
+    return best
+
+
+async def arrange(prepared_images: list[PreparedImage]) -> tuple[list[PreparedImage], list[Optional[str]], bool]:
+    """
+    Lay out the photos of one vision request: returns the images to attach,
+    the detail level of each, and whether they were composed into a mosaic.
+    """
+    details = choose_details(prepared_images)
+    separate = sum(estimate_vision_tokens(image.width, image.height, detail or "high")
+                   for image, detail in zip(prepared_images, details))
+    _stats["requests"] += 1
+    _stats["tokens_separate"] += sum(image.estimated_tokens for image in prepared_images)
+
+    plan = None
+    if settings.image_mosaic_enabled and len(prepared_images) > 1 and all(image.width for image in prepared_images):
+        plan = plan_mosaic([(image.width, image.height) for image in prepared_images])
+    if plan is not None and plan.tokens < separate:
+        mosaic = await build_mosaic(prepared_images, plan.cols, plan.rows, plan.width, plan.height)
+        _stats["mosaics"] += 1
+        _stats["parts_high"] += 1
+        _stats["tokens_sent"] += mosaic.estimated_tokens
+        logger.debug("Photos composed into a mosaic", extra={
+            "photos": len(prepared_images), "grid": f"{plan.cols}x{plan.rows}",
+            "size": f"{plan.width}x{plan.height}", "tokens": plan.tokens, "tokens_separate": separate,
+        })
+        return [mosaic], ["high"], True
+
+    for detail in details:
+        key = f"parts_{detail}" if detail in ("low", "high") else "parts_auto"
+        _stats[key] += 1
+    _stats["tokens_sent"] += separate
+    return prepared_images, details, False
+
+
+def get_vision_layout_stats() -> dict:
+    return {
+        "detail": settings.image_detail,
+        "mosaic_enabled": settings.image_mosaic_enabled,
+        **_stats,
+        "tokens_saved": max(0, _stats["tokens_separate"] - _stats["tokens_sent"]),
+    }
+
+
+def _collect_metrics() -> list[MetricFamily]:
+    return [
+        MetricFamily("bodyfat_vision_layout_tokens_saved_total", "counter",
+                     "Estimated vision input tokens saved by per-photo detail levels and mosaics.",
+                     samples={(): max(0, _stats["tokens_separate"] - _stats["tokens_sent"])}),
+    ]
+
+
+register_collector(_collect_metrics)
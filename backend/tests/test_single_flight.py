@@ -0,0 +1,55 @@
+import asyncio
+
+from services.openai_client import _SingleFlight
+
+
+def test_call_abandoned_by_all_waiters_is_cancelled():
+    async def scenario():
+        flight = _SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def upstream():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flight.do("key", upstream)) for _ in range(3)]
+        await started.wait()
+        assert flight.snapshot()["coalesced_calls"] == 2
+
+        # Пока остается хотя бы один ожидающий, общий вызов продолжается
+        for waiter in waiters[:2]:
+            waiter.cancel()
+        await asyncio.sleep(0)
+        assert not cancelled.is_set()
+
+        waiters[2].cancel()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        await asyncio.gather(*waiters, return_exceptions=True)
+        assert flight.snapshot()["abandoned_calls"] == 1
+        assert flight.snapshot()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_finished_call_is_shared_and_not_cancelled():
+    async def scenario():
+        flight = _SingleFlight()
+        calls = 0
+
+        async def upstream():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 42
+
+        results = await asyncio.gather(*(flight.do("key", upstream) for _ in range(3)))
+        assert results == [42, 42, 42]
+        assert calls == 1
+        assert flight.snapshot()["abandoned_calls"] == 0
+
+    asyncio.run(scenario())